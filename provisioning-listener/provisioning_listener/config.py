@@ -2,6 +2,7 @@
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 
 from functools import lru_cache
+from typing import Optional
 
 from pydantic_settings import BaseSettings
 
@@ -17,6 +18,19 @@ class LdapProducerSettings(BaseSettings):
     nats_port: int
     # Maximum number of reconnect attempts to the NATS server
     nats_max_reconnect_attempts: int
+    # Seconds in which messages with the ID of an already published message are discarded from the LDAP stream
+    # (None: default of the NATS server)
+    nats_duplicate_window: Optional[float] = None
+    # Maximum number of LDAP changes waiting to be published, before the listener is blocked
+    publisher_queue_size: int = 1000
+    # Seconds to wait before a message that could not be published is published again
+    publisher_retry_delay: float = 5.0
+    # Maximum number of handed over LDAP changes that are not yet published, before the listener waits for them
+    publisher_flush_count: int = 100
+    # Maximum seconds since the oldest handed over LDAP change that is not yet published, before the listener waits
+    publisher_flush_interval: float = 1.0
+    # Seconds to wait for the handed over LDAP changes to be published when the listener exits
+    publisher_exit_timeout: float = 30.0
 
     @property
     def nats_server(self) -> str:
@@ -33,7 +33,7 @@
 
 import asyncio
 
-from provisioning_listener.service import ensure_stream, handle_changes
+from provisioning_listener.service import ensure_stream, flush_changes, handle_changes
 from univention.listener.handler import ListenerModuleHandler
 
 name = "provisioning_handler"
@@ -46,18 +46,26 @@ class LdapListener(ListenerModuleHandler):
 
     def create(self, dn, new):
         self.logger.info("[ create ] dn: %r", dn)
-        asyncio.run(handle_changes(new, {}))
+        handle_changes(new, {})
 
     def modify(self, dn, old, new, old_dn):
         self.logger.info("[ modify ] dn: %r", dn)
         if old_dn:
             self.logger.debug("it is (also) a move! old_dn: %r", old_dn)
         self.logger.debug("changed attributes: %r", self.diff(old, new))
-        asyncio.run(handle_changes(new, old))
+        handle_changes(new, old)
 
     def remove(self, dn, old):
         self.logger.info("[ remove ] dn: %r", dn)
-        asyncio.run(handle_changes({}, old))
+        handle_changes({}, old)
+
+    def post_run(self):
+        self.logger.debug("[ post_run ] publishing queued changes")
+        flush_changes()
+
+    def clean(self):
+        self.logger.info("[ clean ] publishing queued changes")
+        flush_changes()
 
     class Configuration(ListenerModuleHandler.Configuration):
         name = name
@@ -25,8 +25,14 @@ class LDAPProducerPort:
     async def __aexit__(self, *args):
         await self.mq_adapter.close()
 
-    async def add_message(self, stream: str, subject: str, message: Message):
-        await self.mq_adapter.add_message(stream, subject, message, binary_encoder=messagepack_encoder)
-
-    async def ensure_stream(self, stream: str, manual_delete: bool, subjects: Optional[List[str]] = None):
-        await self.mq_adapter.ensure_stream(stream, manual_delete, subjects)
+    async def add_message(self, stream: str, subject: str, message: Message, msg_id: Optional[str] = None):
+        await self.mq_adapter.add_message(stream, subject, message, binary_encoder=messagepack_encoder, msg_id=msg_id)
+
+    async def ensure_stream(
+        self,
+        stream: str,
+        manual_delete: bool,
+        subjects: Optional[List[str]] = None,
+        duplicate_window: Optional[float] = None,
+    ):
+        await self.mq_adapter.ensure_stream(stream, manual_delete, subjects, duplicate_window)
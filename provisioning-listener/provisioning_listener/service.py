@@ -1,9 +1,17 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 
+import asyncio
+import atexit
+import concurrent.futures
+import logging
+import threading
+import time
 from datetime import datetime
-from typing import Any, Dict
+from functools import lru_cache
+from typing import Any, Dict, Optional
 
+from provisioning_listener.config import LdapProducerSettings, ldap_producer_settings
 from provisioning_listener.port import LDAPProducerPort
 from univention.provisioning.models.queue import (
     LDAP_STREAM,
@@ -11,15 +19,117 @@ from univention.provisioning.models.queue import (
     Body,
     Message,
     PublisherName,
+    message_id,
 )
 
+logger = logging.getLogger(__name__)
+
+
+class MessagePublisher:
+    """
+    Publishes messages to the LDAP stream from a background thread.
+
+    The thread runs its own event loop with a persistent connection to NATS.
+    Messages are handed over through a bounded queue and published in order.
+    When a message cannot be published, the publisher reconnects and publishes it again after
+    `publisher_retry_delay` seconds, keeping the queued messages. Meanwhile `publish()` blocks once the queue is full,
+    and `flush()` until all messages were published.
+    The listener moves on as soon as a change is handed over, so `publish()` also waits until the queued messages
+    were published, when `publisher_flush_count` of them or some older than `publisher_flush_interval` seconds are
+    waiting. This limits the changes that are lost if the listener is killed. When it exits, the queued messages are
+    published by `flush_at_exit()`.
+    Each message is published with the ID of its LDAP change, so a message that is published again is stored once.
+    """
+
+    def __init__(self, settings: Optional[LdapProducerSettings] = None):
+        self.settings = settings or ldap_producer_settings()
+        self._loop = asyncio.new_event_loop()
+        self._queue: Optional[asyncio.Queue] = None
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="provisioning-publisher", daemon=True)
+        # Number of handed over messages since the last flush, and the time of the first one
+        self._unflushed = 0
+        self._unflushed_since = 0.0
+
+    def start(self):
+        self._thread.start()
+        self._started.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._publish_messages())
+
+    async def _publish_messages(self):
+        self._queue = asyncio.Queue(maxsize=self.settings.publisher_queue_size)
+        self._started.set()
+        pending = None
+        while True:
+            try:
+                async with LDAPProducerPort(self.settings) as ldap_port:
+                    while True:
+                        if pending is None:
+                            pending = await self._queue.get()
+                        message, msg_id = pending
+                        await ldap_port.add_message(LDAP_STREAM, LDAP_SUBJECT, message, msg_id)
+                        pending = None
+                        self._queue.task_done()
+            except Exception:
+                logger.exception(
+                    "Failed to publish messages to the LDAP stream, trying again in %s seconds (%d messages waiting).",
+                    self.settings.publisher_retry_delay,
+                    self._queue.qsize() + (pending is not None),
+                )
+                await asyncio.sleep(self.settings.publisher_retry_delay)
+
+    def _run_in_loop(self, coro, timeout: Optional[float] = None):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    def publish(self, message: Message, msg_id: Optional[str] = None):
+        """Hand over `message`, blocks while the queue is full or too many messages are waiting to be published."""
+        self._run_in_loop(self._queue.put((message, msg_id)))
+        now = time.monotonic()
+        if not self._unflushed:
+            self._unflushed_since = now
+        self._unflushed += 1
+        if (
+            self._unflushed >= self.settings.publisher_flush_count
+            or now - self._unflushed_since >= self.settings.publisher_flush_interval
+        ):
+            self.flush()
+
+    def flush(self, timeout: Optional[float] = None):
+        """Wait until all handed over messages have been published, or raise a TimeoutError after `timeout` seconds."""
+        self._run_in_loop(self._queue.join(), timeout)
+        self._unflushed = 0
+
+    def flush_at_exit(self):
+        """Publish the handed over messages before the process exits, waiting up to `publisher_exit_timeout` seconds."""
+        logger.info("Publishing the queued LDAP changes before exiting.")
+        try:
+            self.flush(self.settings.publisher_exit_timeout)
+        except concurrent.futures.TimeoutError:
+            logger.error(
+                "Failed to publish the queued LDAP changes within %s seconds before exiting.",
+                self.settings.publisher_exit_timeout,
+            )
+
+
+@lru_cache(maxsize=1)
+def message_publisher() -> MessagePublisher:
+    publisher = MessagePublisher()
+    publisher.start()
+    atexit.register(publisher.flush_at_exit)
+    return publisher
+
 
 async def ensure_stream():
     async with LDAPProducerPort() as ldap_port:
-        await ldap_port.ensure_stream(LDAP_STREAM, False, [LDAP_SUBJECT])
+        await ldap_port.ensure_stream(
+            LDAP_STREAM, False, [LDAP_SUBJECT], duplicate_window=ldap_port.settings.nats_duplicate_window
+        )
 
 
-async def handle_changes(new: Dict[str, Any], old: Dict[str, Any]):
+def handle_changes(new: Dict[str, Any], old: Dict[str, Any]):
     message = Message(
         publisher_name=PublisherName.ldif_producer,
         ts=datetime.now(),
@@ -27,6 +137,11 @@ async def handle_changes(new: Dict[str, Any], old: Dict[str, Any]):
         topic="ldap",
         body=Body(new=new, old=old),
     )
+    # Identifies the change, so a change that is handed over again is published only once
+    keys = message.body.ldap_change_keys
+    msg_id = message_id(PublisherName.ldif_producer, *keys) if keys else None
+    message_publisher().publish(message, msg_id)
 
-    async with LDAPProducerPort() as ldap_port:
-        await ldap_port.add_message(LDAP_STREAM, LDAP_SUBJECT, message)
+
+def flush_changes():
+    message_publisher().flush()
@@ -10,7 +10,7 @@ from typing import Any, Callable, Coroutine, List, Optional, Tuple, Union
 import msgpack
 from nats.aio.client import Client as NATS
 from nats.aio.msg import Msg
-from nats.js.api import ConsumerConfig, RetentionPolicy, StreamConfig
+from nats.js.api import ConsumerConfig, Header, RetentionPolicy, StreamConfig
 from nats.js.errors import (
     BucketNotFoundError,
     KeyNotFoundError,
@@ -156,15 +156,25 @@ class NatsMQAdapter(BaseMQAdapter):
         subject: str,
         message: BaseMessage,
         binary_encoder: Callable[[Any], bytes] = json_encoder,
+        msg_id: Optional[str] = None,
     ):
-        """Publish a message to a NATS subject."""
+        """
+        Publish a message to a NATS subject.
+
+        If a message with the same `msg_id` was already published to the stream within its duplicate window,
+        the message is discarded by the server.
+        """
         stream_name = NatsKeys.stream(stream)
 
-        await self._js.publish(
+        pub_ack = await self._js.publish(
             subject,
             binary_encoder(message.model_dump()),
             stream=stream_name,
+            headers={Header.MSG_ID: msg_id} if msg_id else None,
         )
+        if msg_id and pub_ack.duplicate:
+            logger.info("Message with the ID %r was already published to the stream: %r", msg_id, stream_name)
+            return
         logger.info(
             "Message was published to the stream: %r with the subject: %r",
             stream_name,
@@ -314,7 +324,13 @@ class NatsMQAdapter(BaseMQAdapter):
             return False
         return True
 
-    async def ensure_stream(self, stream: str, manual_delete: bool, subjects: Optional[List[str]] = None):
+    async def ensure_stream(
+        self,
+        stream: str,
+        manual_delete: bool,
+        subjects: Optional[List[str]] = None,
+        duplicate_window: Optional[float] = None,
+    ):
         stream_name = NatsKeys.stream(stream)
         stream_config = StreamConfig(
             name=stream_name,
@@ -322,10 +338,17 @@ class NatsMQAdapter(BaseMQAdapter):
             retention=RetentionPolicy.LIMITS if manual_delete else RetentionPolicy.WORK_QUEUE,
             # TODO: set to 3 after nats clustering is stable.
             num_replicas=1,
+            duplicate_window=duplicate_window,
         )
         try:
-            await self._js.stream_info(stream_name)
+            stream_info = await self._js.stream_info(stream_name)
             logger.info("A stream with the name '%s' already exists", stream_name)
+            if duplicate_window is None:
+                stream_config.duplicate_window = stream_info.config.duplicate_window
+            # Keep the storage, replication and limits set by the udm-transformer's stream policy.
+            for field in ("storage", "num_replicas", "max_bytes", "max_msgs", "max_age", "compression", "discard"):
+                if getattr(stream_info.config, field, None) is not None:
+                    setattr(stream_config, field, getattr(stream_info.config, field))
         except NotFoundError:
             await self._js.add_stream(stream_config)
             logger.info("A stream with the name '%s' was created", stream_name)
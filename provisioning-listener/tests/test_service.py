@@ -0,0 +1,162 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# SPDX-FileCopyrightText: 2024 Univention GmbH
+
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import List, Optional
+from unittest.mock import patch
+
+import pytest
+
+from provisioning_listener.config import LdapProducerSettings
+from provisioning_listener.service import message_publisher
+from univention.provisioning.models.queue import Body, Message, PublisherName
+
+
+class FakeLDAPProducerPort:
+    """Mock of LDAPProducerPort, which records the published messages"""
+
+    published: List[Message]
+    # Number of messages that fail to be published
+    failures: int
+    # Messages are published only while it is set
+    released: threading.Event
+
+    def __init__(self, settings: Optional[LdapProducerSettings] = None):
+        self.settings = settings
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def add_message(self, stream: str, subject: str, message: Message, msg_id: Optional[str] = None):
+        while not self.released.is_set():
+            await asyncio.sleep(0.001)
+        if self.failures:
+            type(self).failures -= 1
+            raise ConnectionError("NATS is not available")
+        self.published.append(message)
+
+
+def ldap_message(i: int) -> Message:
+    return Message(
+        publisher_name=PublisherName.ldif_producer,
+        ts=datetime.now(),
+        realm="ldap",
+        topic="ldap",
+        body=Body(new={"uid": [str(i).encode()]}, old={}),
+    )
+
+
+@pytest.fixture
+def port():
+    """The class of the LDAPProducerPort, with the messages published in this test"""
+    port = type("FakeLDAPProducerPort", (FakeLDAPProducerPort,), {})
+    port.published = []
+    port.failures = 0
+    port.released = threading.Event()
+    port.released.set()
+    with patch("provisioning_listener.service.LDAPProducerPort", port):
+        yield port
+
+
+@pytest.fixture
+def publisher_factory(port):
+    """Start a publisher with the given settings, return it and the handler that is called when the process exits"""
+    publishers = []
+
+    def factory(**kwargs):
+        settings = LdapProducerSettings(
+            nats_user="listener",
+            nats_password="password",
+            nats_host="localhost",
+            nats_port=4222,
+            nats_max_reconnect_attempts=1,
+            **kwargs,
+        )
+        with (
+            patch("provisioning_listener.service.ldap_producer_settings", return_value=settings),
+            patch("provisioning_listener.service.atexit") as atexit_mock,
+        ):
+            message_publisher.cache_clear()
+            publishers.append(message_publisher())
+        return publishers[-1], atexit_mock.register.call_args.args[0]
+
+    yield factory
+    message_publisher.cache_clear()
+    # Let the publishers of this test finish, so that they wait idle for messages
+    port.failures = 0
+    port.released.set()
+    for publisher in publishers:
+        publisher.flush(5)
+
+
+def test_exit_publishes_queued_messages(port, publisher_factory):
+    publisher, exit_handler = publisher_factory(publisher_flush_interval=60)
+    messages = [ldap_message(i) for i in range(5)]
+    port.released.clear()
+
+    for message in messages:
+        publisher.publish(message)
+    assert port.published == []
+
+    port.released.set()
+    exit_handler()
+
+    assert port.published == messages
+
+
+def test_exit_gives_up_after_timeout(port, publisher_factory, caplog):
+    publisher, exit_handler = publisher_factory(
+        publisher_flush_interval=60, publisher_retry_delay=0.01, publisher_exit_timeout=0.1
+    )
+    port.failures = 1000
+    publisher.publish(ldap_message(1))
+
+    with caplog.at_level(logging.ERROR):
+        exit_handler()
+
+    assert port.published == []
+    assert "Failed to publish the queued LDAP changes within 0.1 seconds before exiting." in caplog.text
+
+
+def test_publish_waits_after_flush_count(port, publisher_factory):
+    publisher, _ = publisher_factory(publisher_flush_count=3, publisher_flush_interval=60)
+    messages = [ldap_message(i) for i in range(3)]
+    port.released.clear()
+    threading.Timer(0.05, port.released.set).start()
+
+    for message in messages:
+        publisher.publish(message)
+
+    assert port.published == messages
+
+
+def test_publish_waits_after_flush_interval(port, publisher_factory):
+    publisher, _ = publisher_factory(publisher_flush_interval=0.05)
+    messages = [ldap_message(i) for i in range(2)]
+    port.released.clear()
+    threading.Timer(0.1, port.released.set).start()
+
+    publisher.publish(messages[0])
+    time.sleep(0.06)
+    publisher.publish(messages[1])
+
+    assert port.published == messages
+
+
+def test_failed_message_is_published_again(port, publisher_factory):
+    publisher, _ = publisher_factory(publisher_retry_delay=0.01)
+    messages = [ldap_message(i) for i in range(3)]
+    port.failures = 2
+
+    for message in messages:
+        publisher.publish(message)
+    publisher.flush()
+
+    assert port.published == messages
@@ -45,13 +45,23 @@ class BaseKVStoreAdapter(ABC):
         """
         pass
 
+    @abstractmethod
+    async def get_binary_value(self, key: str, bucket: Bucket) -> Optional[bytes]:
+        """
+        Retrieve the undecoded value at `key` in `bucket`.
+        Returns the value or None if key does not exist.
+        """
+        pass
+
     @abstractmethod
     async def put_value(
-        self, key: str, value: Union[str, dict, list], bucket: Bucket, revision: Optional[int] = None
+        self, key: str, value: Union[str, bytes, dict, list], bucket: Bucket, revision: Optional[int] = None
     ) -> None:
         """
         Store `value` at `key` in `bucket`.
+        Values of type `bytes` are stored as they are, all other values are stored UTF-8 encoded.
         If `revision` is None overwrite value in DB without a further check.
+        If `revision` is 0 and the key already exists, raise UpdateConflict.
         If `revision` is not None and the revision in the DB is different, raise UpdateConflict.
         """
         pass
@@ -75,6 +85,7 @@ class BaseMQAdapter(ABC):
         subject: str,
         message: BaseMessage,
         binary_encoder: Callable[[Any], bytes],
+        msg_id: Optional[str] = None,
     ):
         pass
 
@@ -110,5 +121,11 @@ class BaseMQAdapter(ABC):
         pass
 
     @abstractmethod
-    async def ensure_consumer(self, subject: str, deliver_subject: Optional[str] = None):
+    async def ensure_consumer(
+        self,
+        subject: str,
+        deliver_subject: Optional[str] = None,
+        filter_subject: Optional[str] = None,
+        max_ack_pending: int = 1,
+    ):
         pass
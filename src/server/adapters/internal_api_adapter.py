@@ -1,10 +1,16 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 
+from typing import Optional
+
 import aiohttp
 
+from server.tracing import inject_trace_context
 from univention.provisioning.models import FillQueueStatus, FillQueueStatusReport, Message
 
+# HTTP header with the ID of a message, messages with an already published ID are discarded
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+
 
 class InternalAPIAdapter:
     """
@@ -33,6 +39,7 @@ class InternalAPIAdapter:
         ):
             pass
 
-    async def send_event(self, message: Message):
-        async with self._session.post(f"{self.base_url}/v1/messages", json=message.model_dump()):
+    async def send_event(self, message: Message, msg_id: Optional[str] = None):
+        headers = inject_trace_context({IDEMPOTENCY_KEY_HEADER: msg_id} if msg_id else {}) or None
+        async with self._session.post(f"{self.base_url}/v1/messages", json=message.model_dump(), headers=headers):
             pass
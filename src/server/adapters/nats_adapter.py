@@ -2,15 +2,30 @@
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 
 import asyncio
+import dataclasses
 import json
 import logging
 import typing
-from typing import Any, AsyncGenerator, Awaitable, Callable, Coroutine, List, Optional, Tuple, Union
+from datetime import datetime
+from typing import Any, AsyncGenerator, Awaitable, Callable, Coroutine, List, Optional, Sequence, Tuple, Union
 
+import cachetools
 import msgpack
 from nats.aio.client import Client as NATS
 from nats.aio.msg import Msg
-from nats.js.api import ConsumerConfig, RetentionPolicy, StreamConfig
+from nats.errors import NoRespondersError
+from nats.errors import TimeoutError as NatsTimeoutError
+from nats.js.api import (
+    DEFAULT_PREFIX,
+    ConsumerConfig,
+    DeliverPolicy,
+    DiscardPolicy,
+    Header,
+    RetentionPolicy,
+    StorageType,
+    StoreCompression,
+    StreamConfig,
+)
 from nats.js.errors import (
     BucketNotFoundError,
     KeyNotFoundError,
@@ -20,7 +35,11 @@ from nats.js.errors import (
     ServerError,
 )
 from nats.js.kv import KV_DEL, KV_PURGE
+from opentelemetry.trace import SpanKind
 
+from server.metrics import KV_OPERATION_SECONDS, NATS_OPERATION_SECONDS, SUBSCRIPTION_QUEUE_DEPTH
+from server.stream_policy import StreamPolicy
+from server.tracing import extract_trace_context, inject_trace_context, trace_context_headers, tracer
 from univention.provisioning.models import BaseMessage, Bucket, MQMessage, ProvisioningMessage, Subscription
 
 from .base_adapters import BaseKVStoreAdapter, BaseMQAdapter
@@ -34,6 +53,11 @@ class Empty(Exception): ...
 
 logger = logging.getLogger(__name__)
 
+# Default number of published messages that may wait for their acknowledgement by the server
+PUBLISH_MAX_IN_FLIGHT = 64
+# Seconds for which a stream or consumer is known to be ensured, before the server is asked again
+ENSURED_CACHE_TTL = 300.0
+
 
 class NatsKeys:
     """A list of keys used in Nats for queueing messages."""
@@ -46,6 +70,11 @@ class NatsKeys:
     def durable_name(subject: str) -> str:
         return f"durable_name:{subject}"
 
+    @staticmethod
+    def subject_durable_name(subject: str) -> str:
+        """Name of a durable consumer that is filtered on `subject` (consumer names must not contain dots)."""
+        return f"durable_name:{subject.replace('.', '-')}"
+
 
 class NatsKVAdapter(BaseKVStoreAdapter):
     def __init__(self):
@@ -75,7 +104,8 @@ class NatsKVAdapter(BaseKVStoreAdapter):
 
     async def delete_kv_pair(self, key: str, bucket: Bucket):
         kv_store = await self._js.key_value(bucket.value)
-        await kv_store.delete(key)
+        with KV_OPERATION_SECONDS.labels("delete", bucket.value).time():
+            await kv_store.delete(key)
 
     async def get_value(self, key: str, bucket: Bucket) -> Optional[str]:
         """
@@ -92,17 +122,33 @@ class NatsKVAdapter(BaseKVStoreAdapter):
         """
         kv_store = await self._js.key_value(bucket.value)
         try:
-            result = await kv_store.get(key)
+            with KV_OPERATION_SECONDS.labels("get", bucket.value).time():
+                result = await kv_store.get(key)
             return result.value.decode("utf-8"), result.revision if result else None
         except KeyNotFoundError:
             pass
 
+    async def get_binary_value(self, key: str, bucket: Bucket) -> Optional[bytes]:
+        """
+        Retrieve the undecoded value at `key` in `bucket`.
+        Returns the value or None if key does not exist.
+        """
+        kv_store = await self._js.key_value(bucket.value)
+        try:
+            with KV_OPERATION_SECONDS.labels("get", bucket.value).time():
+                result = await kv_store.get(key)
+            return result.value if result else None
+        except KeyNotFoundError:
+            pass
+
     async def put_value(
-        self, key: str, value: Union[str, dict, list], bucket: Bucket, revision: Optional[int] = None
+        self, key: str, value: Union[str, bytes, dict, list], bucket: Bucket, revision: Optional[int] = None
     ) -> None:
         """
         Store `value` at `key` in `bucket`.
+        Values of type `bytes` are stored as they are, all other values are stored UTF-8 encoded.
         If `revision` is None overwrite value in DB without a further check.
+        If `revision` is 0 and the key already exists, raise UpdateConflict.
         If `revision` is not None and the revision in the DB is different, raise UpdateConflict.
         """
         kv_store = await self._js.key_value(bucket.value)
@@ -112,17 +158,23 @@ class NatsKVAdapter(BaseKVStoreAdapter):
             await self.delete_kv_pair(key, bucket)
             return
 
-        if not isinstance(value, str):
-            value = json.dumps(value)
-
-        if revision:
-            try:
-                await kv_store.update(key, value.encode("utf-8"), revision)
-            except KeyWrongLastSequenceError as exc:
-                raise UpdateConflict(str(exc)) from exc
+        if isinstance(value, bytes):
+            data = value
+        elif isinstance(value, str):
+            data = value.encode("utf-8")
         else:
-            await kv_store.put(key, value.encode("utf-8"))
-            return
+            data = json.dumps(value).encode("utf-8")
+
+        try:
+            with KV_OPERATION_SECONDS.labels("put", bucket.value).time():
+                if revision is None:
+                    await kv_store.put(key, data)
+                elif revision == 0:
+                    await kv_store.create(key, data)
+                else:
+                    await kv_store.update(key, data, revision)
+        except KeyWrongLastSequenceError as exc:
+            raise UpdateConflict(str(exc)) from exc
 
     async def get_keys(self, bucket: Bucket) -> List[str]:
         kv_store = await self._js.key_value(bucket.value)
@@ -186,7 +238,38 @@ class Acknowledgements(typing.NamedTuple):
     acknowledge_message_in_progress: Callable[[], Coroutine[Any, Any, None]]
 
 
+class OutgoingMessage(typing.NamedTuple):
+    stream: str
+    subject: str
+    message: BaseMessage
+    msg_id: Optional[str] = None
+
+
+class ConsumerState(typing.NamedTuple):
+    # Subject the consumer is filtered on, None for an unfiltered consumer
+    subject: Optional[str]
+    # Number of messages that were not yet delivered
+    num_pending: int
+    # Number of delivered messages that were not yet acknowledged
+    num_ack_pending: int
+    # Number of deliveries, including redeliveries
+    delivered: int
+
+
+class StreamStats(typing.NamedTuple):
+    # Number of stored messages of each subject
+    subject_messages: dict[str, int]
+    # When the oldest stored message was stored, None if the stream is empty
+    first_message_time: Optional[datetime]
+    consumers: List[ConsumerState]
+
+
 class NatsMQAdapter(BaseMQAdapter):
+    # The configurations of the streams and consumers ensured by this process, by the names of the streams (and
+    # consumers). They are shared by all adapters, as the REST API connects an adapter for each request.
+    _ensured_streams: cachetools.TTLCache = cachetools.TTLCache(maxsize=1024, ttl=ENSURED_CACHE_TTL)
+    _ensured_consumers: cachetools.TTLCache = cachetools.TTLCache(maxsize=8192, ttl=ENSURED_CACHE_TTL)
+
     def __init__(self):
         self._nats = NATS()
         self._js = self._nats.jetstream()
@@ -217,25 +300,92 @@ class NatsMQAdapter(BaseMQAdapter):
         subject: str,
         message: BaseMessage,
         binary_encoder: Callable[[Any], bytes] = json_encoder,
+        msg_id: Optional[str] = None,
     ):
-        """Publish a message to a NATS subject."""
-        stream_name = NatsKeys.stream(stream)
+        """
+        Publish a message to a NATS subject.
 
-        await self._js.publish(
-            subject,
-            binary_encoder(message.model_dump()),
-            stream=stream_name,
-        )
+        If a message with the same `msg_id` was already published to the stream within its duplicate window,
+        the message is discarded by the server.
+        The trace context of the current span is sent in the headers of the message.
+        """
+        await self._publish(NatsKeys.stream(stream), subject, binary_encoder(message.model_dump()), msg_id)
+
+    async def add_messages(
+        self,
+        messages: Sequence[OutgoingMessage],
+        binary_encoder: Callable[[Any], bytes] = json_encoder,
+        max_in_flight: int = PUBLISH_MAX_IN_FLIGHT,
+    ) -> List[Optional[Exception]]:
+        """
+        Publish multiple messages, without waiting for the acknowledgement of each message before sending the next.
+
+        The messages are sent in order, with up to `max_in_flight` messages waiting for their acknowledgement.
+        Returns the error of each message, in the order of `messages` (None for published messages).
+        As the following messages are sent before an error is known, they may be published after a failed message.
+        """
+        errors: List[Optional[Exception]] = [None] * len(messages)
+        in_flight = asyncio.Semaphore(max_in_flight)
+
+        async def publish(index: int, outgoing: OutgoingMessage):
+            try:
+                await self._publish(
+                    NatsKeys.stream(outgoing.stream),
+                    outgoing.subject,
+                    binary_encoder(outgoing.message.model_dump()),
+                    outgoing.msg_id,
+                )
+            except Exception as exc:
+                logger.error("Failed to publish message to the stream: %r: %s", outgoing.stream, exc)
+                errors[index] = exc
+            finally:
+                in_flight.release()
+
+        tasks = []
+        for index, outgoing in enumerate(messages):
+            await in_flight.acquire()
+            if index == 0:
+                # The first request sets up the NATS client's response subscription, the others can be pipelined.
+                await publish(index, outgoing)
+            else:
+                # Tasks start in the order of their creation, so the messages are sent in order.
+                tasks.append(asyncio.create_task(publish(index, outgoing)))
+        await asyncio.gather(*tasks)
+        return errors
+
+    async def _publish(self, stream_name: str, subject: str, data: bytes, msg_id: Optional[str]) -> None:
+        with tracer().start_as_current_span(
+            f"publish {stream_name}",
+            kind=SpanKind.PRODUCER,
+            attributes={"messaging.system": "nats", "messaging.destination.name": subject},
+        ):
+            headers = inject_trace_context({Header.MSG_ID: msg_id} if msg_id else {})
+            with NATS_OPERATION_SECONDS.labels("publish").time():
+                pub_ack = await self._js.publish(subject, data, stream=stream_name, headers=headers or None)
+        if msg_id and pub_ack.duplicate:
+            logger.info("Message with the ID %r was already published to the stream: %r", msg_id, stream_name)
+            return
         logger.debug(
             "Message was published to the stream: %r with the subject: %r",
             stream_name,
             subject,
         )
 
-    async def initialize_subscription(self, stream: str, manual_delete: bool, subject: Union[str, None]) -> None:
-        """Initializes a stream for a pull consumer, pull consumers can't define a deliver subject"""
-        await self.ensure_stream(stream, manual_delete, [subject] if subject else None)
-        await self.ensure_consumer(stream)
+    async def initialize_subscription(
+        self,
+        stream: str,
+        manual_delete: bool,
+        subject: Union[str, None],
+        max_ack_pending: int = 1,
+        policy: Optional[StreamPolicy] = None,
+    ) -> None:
+        """
+        Initializes a stream for a pull consumer, pull consumers can't define a deliver subject.
+
+        `max_ack_pending` is the number of messages that can be fetched at once (see `get_messages()`).
+        """
+        await self.ensure_stream(stream, manual_delete, [subject] if subject else None, policy=policy)
+        await self.ensure_consumer(stream, max_ack_pending=max_ack_pending)
 
         durable_name = NatsKeys.durable_name(stream)
         stream_name = NatsKeys.stream(stream)
@@ -245,12 +395,58 @@ class NatsMQAdapter(BaseMQAdapter):
             stream=stream_name,
         )
 
-    async def get_message(self, stream: str, subject: str, timeout: float, pop: bool) -> Optional[ProvisioningMessage]:
-        """Retrieve multiple messages from a NATS subject."""
+    async def get_message(
+        self, stream: str, subject: str, timeout: float, pop: bool, ack_wait: Optional[float] = None
+    ) -> Optional[ProvisioningMessage]:
+        """
+        Retrieve a message from a NATS subject, using a durable consumer that is filtered on that subject.
+
+        Unless `pop` is set, the message must be acknowledged within `ack_wait` seconds using the `ack_token` of the
+        returned message, or it will be delivered again.
+        """
+        delivery = await self._deliver_message(stream, subject, timeout, pop, ack_wait)
+        if not delivery:
+            return None
+        msg, trace_context = delivery
+        message = self.provisioning_message_from(msg)
+        message.trace_context = trace_context or message.trace_context
+        return message
+
+    async def get_message_json(
+        self, stream: str, subject: str, timeout: float, pop: bool, ack_wait: Optional[float] = None
+    ) -> Optional[bytes]:
+        """
+        Retrieve a message like `get_message()`, but return the JSON of the `ProvisioningMessage`.
 
+        The JSON is spliced together from the stored payload and the delivery metadata,
+        the payload is neither decoded nor validated.
+        """
+        delivery = await self._deliver_message(stream, subject, timeout, pop, ack_wait)
+        if not delivery:
+            return None
+        msg, trace_context = delivery
+        return self.provisioning_message_json_from(msg, trace_context or trace_context_headers(msg.headers))
+
+    async def get_message_msgpack(
+        self, stream: str, subject: str, timeout: float, pop: bool, ack_wait: Optional[float] = None
+    ) -> Optional[bytes]:
+        """Retrieve a message like `get_message_json()`, but return the MessagePack of the `ProvisioningMessage`."""
+        delivery = await self._deliver_message(stream, subject, timeout, pop, ack_wait)
+        if not delivery:
+            return None
+        msg, trace_context = delivery
+        return self.provisioning_message_msgpack_from(msg, trace_context or trace_context_headers(msg.headers))
+
+    async def _deliver_message(
+        self, stream: str, subject: str, timeout: float, pop: bool, ack_wait: Optional[float]
+    ) -> Optional[Tuple[Msg, Optional[dict[str, str]]]]:
+        """
+        Fetch a message from a NATS subject and acknowledge it if `pop` is set.
+
+        Returns the message and the trace context of its delivery, which the consumer continues.
+        """
         stream_name = NatsKeys.stream(stream)
-        # TODO: Why the stream and not the subject?
-        durable_name = NatsKeys.durable_name(stream)
+        durable_name = NatsKeys.subject_durable_name(subject)
 
         try:
             await self._js.stream_info(stream_name)
@@ -258,19 +454,82 @@ class NatsMQAdapter(BaseMQAdapter):
             logger.error("The stream was not found")
             return None
 
-        consumer = await self._js.consumer_info(stream_name, durable_name)
+        try:
+            await self._js.consumer_info(stream_name, durable_name)
+        except NotFoundError:
+            self._ensured_consumers.pop((stream_name, durable_name), None)
+            await self.ensure_consumer(stream, filter_subject=subject, ack_wait=ack_wait)
 
-        # TODO: Why is ConsumerInfo passed in as ConsumerConfig?
-        sub = await self._js.pull_subscribe(subject, durable=durable_name, stream=stream_name, config=consumer)
+        sub = await self._js.pull_subscribe_bind(durable=durable_name, stream=stream_name)
         try:
-            msgs = await sub.fetch(1, timeout)
+            with NATS_OPERATION_SECONDS.labels("fetch").time():
+                msgs = await sub.fetch(1, timeout)
         except asyncio.TimeoutError:
+            SUBSCRIPTION_QUEUE_DEPTH.labels(stream, subject).set(0)
+            return None
+        SUBSCRIPTION_QUEUE_DEPTH.labels(stream, subject).set(msgs[0].metadata.num_pending)
+
+        with tracer().start_as_current_span(
+            f"deliver {stream_name}",
+            context=extract_trace_context(msgs[0].headers),
+            kind=SpanKind.CONSUMER,
+            attributes={"messaging.system": "nats", "messaging.destination.name": subject},
+        ):
+            if pop:
+                with NATS_OPERATION_SECONDS.labels("ack").time():
+                    await msgs[0].ack()
+
+            return msgs[0], trace_context_headers(inject_trace_context())
+
+    async def get_subject_message_count(self, stream: str, subject: str) -> int:
+        """
+        Return the number of messages in `stream` stored under `subject`.
+
+        This is a single request to the stream state and does not wait for a message to arrive.
+        """
+        try:
+            stream_info = await self._js.stream_info(NatsKeys.stream(stream), subjects_filter=subject)
+        except NotFoundError:
+            return 0
+        return (stream_info.state.subjects or {}).get(subject, 0)
+
+    async def get_stream_stats(self, stream: str) -> Optional[StreamStats]:
+        """Return the number of messages per subject, the age and the consumers of `stream`, None if it is missing."""
+        stream_name = NatsKeys.stream(stream)
+        try:
+            stream_info = await self._js.stream_info(stream_name, subjects_filter=">")
+            consumers_info = await self._js.consumers_info(stream_name)
+        except NotFoundError:
             return None
+        first_message_time = None
+        if stream_info.state.messages:
+            first_message_time = await self._get_message_time(stream_name, stream_info.state.first_seq)
+        return StreamStats(
+            subject_messages=stream_info.state.subjects or {},
+            first_message_time=first_message_time,
+            consumers=[
+                ConsumerState(
+                    subject=info.config.filter_subject,
+                    num_pending=info.num_pending or 0,
+                    num_ack_pending=info.num_ack_pending or 0,
+                    delivered=info.delivered.consumer_seq if info.delivered else 0,
+                )
+                for info in consumers_info
+            ],
+        )
 
-        if pop:
-            await msgs[0].ack()
+    async def _get_message_time(self, stream_name: str, seq_num: int) -> Optional[datetime]:
+        """
+        Return when the message `seq_num` (or the next one) was stored in the stream.
 
-        return self.provisioning_message_from(msgs[0])
+        The JetStream client drops the time from the messages it gets from a stream, so the API is requested directly.
+        """
+        response = await self._nats.request(
+            f"{DEFAULT_PREFIX}.STREAM.MSG.GET.{stream_name}",
+            json.dumps({"seq": seq_num, "next_by_subj": ">"}).encode(),
+        )
+        message = json.loads(response.data).get("message")
+        return datetime.fromisoformat(message["time"]) if message else None
 
     async def get_one_message(
         self,
@@ -284,7 +543,8 @@ class NatsMQAdapter(BaseMQAdapter):
             )
 
         try:
-            messages = await self.pull_subscription.fetch(1, timeout=timeout)
+            with NATS_OPERATION_SECONDS.labels("fetch").time():
+                messages = await self.pull_subscription.fetch(1, timeout=timeout)
         except asyncio.TimeoutError:
             raise Empty()
 
@@ -295,6 +555,33 @@ class NatsMQAdapter(BaseMQAdapter):
             acknowledgements,
         )
 
+    async def get_messages(
+        self,
+        batch_size: int,
+        timeout: float = 10,
+        binary_decoder: Callable[[bytes], Any] = json_decoder,
+    ) -> List[Tuple[MQMessage, Acknowledgements]]:
+        """
+        Returns up to `batch_size` messages, in order, each with the Callables that acknowledge it.
+
+        Returns as soon as at least one message is available, waits up to `timeout` seconds otherwise.
+        """
+        if not self.pull_subscription:
+            raise ValueError(
+                "Subscription class attribute is empty, ensure that initialize_subscription() has been called."
+            )
+
+        try:
+            with NATS_OPERATION_SECONDS.labels("fetch").time():
+                messages = await self.pull_subscription.fetch(batch_size, timeout=timeout)
+        except asyncio.TimeoutError:
+            raise Empty()
+
+        return [
+            (self.mq_message_from(message, binary_decoder=binary_decoder), self.build_acknowledgements(message))
+            for message in messages
+        ]
+
     @staticmethod
     def provisioning_message_from(msg: Msg) -> ProvisioningMessage:
         data = json.loads(msg.data)
@@ -307,9 +594,39 @@ class NatsMQAdapter(BaseMQAdapter):
             realm=data["realm"],
             topic=data["topic"],
             body=data["body"],
+            ack_token=msg.reply,
+            trace_context=trace_context_headers(msg.headers),
         )
         return message
 
+    @staticmethod
+    def delivery_metadata(msg: Msg, trace_context: Optional[dict[str, str]]) -> dict[str, Any]:
+        """Return the fields of a `ProvisioningMessage` that describe the delivery of `msg`."""
+        return {
+            "sequence_number": int(msg.reply.split(".")[-4]),
+            "num_delivered": msg.metadata.num_delivered,
+            "ack_token": msg.reply,
+            "trace_context": trace_context,
+        }
+
+    @classmethod
+    def provisioning_message_json_from(cls, msg: Msg, trace_context: Optional[dict[str, str]]) -> bytes:
+        """Return the JSON of the `ProvisioningMessage` of `msg`, with the delivery metadata added to its payload."""
+        metadata = cls.delivery_metadata(msg, trace_context)
+        # The payload is the JSON object of a `Message`, the metadata is inserted before its closing brace.
+        return b"%s, %s" % (msg.data.rstrip()[:-1], json_encoder(metadata)[1:])
+
+    @classmethod
+    def provisioning_message_msgpack_from(cls, msg: Msg, trace_context: Optional[dict[str, str]]) -> bytes:
+        """
+        Return the MessagePack of the `ProvisioningMessage` of `msg`, with the delivery metadata added to its payload.
+
+        The payload is stored as JSON, so it is decoded once, but it is neither validated nor encoded as JSON again.
+        """
+        data = json_decoder(msg.data)
+        data.update(cls.delivery_metadata(msg, trace_context))
+        return messagepack_encoder(data)
+
     def nats_message_from(self, message: MQMessage) -> Msg:
         data = message.data
         msg = Msg(
@@ -337,12 +654,14 @@ class NatsMQAdapter(BaseMQAdapter):
 
     async def delete_stream(self, stream_name: str):
         """Delete the entire stream for a given name in NATS JetStream."""
+        self.forget_stream(NatsKeys.stream(stream_name))
         try:
             await self._js.delete_stream(NatsKeys.stream(stream_name))
         except NotFoundError:
             return None
 
     async def delete_consumer(self, subject: str):
+        self._ensured_consumers.pop((NatsKeys.stream(subject), NatsKeys.durable_name(subject)), None)
         try:
             await self._js.delete_consumer(NatsKeys.stream(subject), NatsKeys.durable_name(subject))
         except NotFoundError:
@@ -351,8 +670,14 @@ class NatsMQAdapter(BaseMQAdapter):
     async def cb(self, msg):
         await self._message_queue.put(msg)
 
-    async def subscribe_to_queue(self, subject: str, deliver_subject: str):
-        await self.ensure_stream(subject, False)
+    async def subscribe_to_queue(
+        self,
+        subject: str,
+        deliver_subject: str,
+        duplicate_window: Optional[float] = None,
+        policy: Optional[StreamPolicy] = None,
+    ):
+        await self.ensure_stream(subject, False, duplicate_window=duplicate_window, policy=policy)
         await self.ensure_consumer(subject, deliver_subject)
 
         await self._js.subscribe(
@@ -375,42 +700,220 @@ class NatsMQAdapter(BaseMQAdapter):
             return False
         return True
 
-    async def ensure_stream(self, stream: str, manual_delete: bool, subjects: Optional[List[str]] = None):
+    async def ensure_stream(
+        self,
+        stream: str,
+        manual_delete: bool,
+        subjects: Optional[List[str]] = None,
+        retention: Optional[RetentionPolicy] = None,
+        duplicate_window: Optional[float] = None,
+        policy: Optional[StreamPolicy] = None,
+    ):
+        """
+        Create or update a stream.
+
+        Without an explicit `retention`, messages are kept until they are deleted (`manual_delete`),
+        or until they are acknowledged by the one consumer of the stream.
+        Messages with an ID that was already published within `duplicate_window` seconds are discarded.
+        Without a `duplicate_window`, an existing stream keeps its window and a new stream uses the server's default.
+        The storage, replication and limits are set from `policy`. The storage of an existing stream cannot be changed.
+
+        An existing stream is only updated if its configuration differs, and a stream that this process already
+        ensured with the same arguments within `ENSURED_CACHE_TTL` seconds is not requested from the server at all.
+        """
         stream_name = NatsKeys.stream(stream)
+        policy = policy or StreamPolicy()
+        if not retention:
+            retention = RetentionPolicy.LIMITS if manual_delete else RetentionPolicy.WORK_QUEUE
         stream_config = StreamConfig(
             name=stream_name,
             subjects=subjects or [stream],
-            retention=RetentionPolicy.LIMITS if manual_delete else RetentionPolicy.WORK_QUEUE,
-            # TODO: set to 3 after nats clustering is stable.
-            num_replicas=1,
+            retention=retention,
+            duplicate_window=duplicate_window,
+            storage=StorageType(policy.storage),
+            num_replicas=policy.replicas,
+            max_bytes=policy.max_bytes or -1,
+            max_msgs=policy.max_messages or -1,
+            max_age=policy.max_age or 0,
+            compression=StoreCompression.S2 if policy.compression else StoreCompression.NONE,
+            discard=DiscardPolicy(policy.discard),
         )
+        if self._ensured_streams.get(stream_name) == stream_config:
+            return
+        ensured_config = dataclasses.replace(stream_config)
         try:
-            await self._js.stream_info(stream_name)
+            stream_info = await self._js.stream_info(stream_name)
             logger.info("A stream with the name %r already exists", stream_name)
+            if duplicate_window is None:
+                stream_config.duplicate_window = stream_info.config.duplicate_window
+            if stream_info.config.storage and stream_info.config.storage != stream_config.storage:
+                logger.warning(
+                    "The storage of the stream %r cannot be changed to %r, it must be deleted first.",
+                    stream_name,
+                    policy.storage,
+                )
+                stream_config.storage = stream_info.config.storage
         except NotFoundError:
             await self._js.add_stream(stream_config)
             logger.info("A stream with the name %r was created", stream_name)
         else:
-            await self._js.update_stream(stream_config)
-            logger.info("A stream with the name %r was updated", stream_name)
+            if self.stream_config_differs(stream_info.config, stream_config):
+                await self._js.update_stream(stream_config)
+                logger.info("A stream with the name %r was updated", stream_name)
+        # Only remember the stream if the server has the wanted configuration, which is not the case for its storage.
+        if stream_config.storage == ensured_config.storage:
+            self._ensured_streams[stream_name] = ensured_config
+
+    @staticmethod
+    def stream_config_differs(current: StreamConfig, wanted: StreamConfig) -> bool:
+        """Return whether the `current` configuration of a stream, as returned by the server, differs from `wanted`."""
+        if set(current.subjects or []) != set(wanted.subjects or []):
+            return True
+        # Servers before 2.10 do not report the compression of their (uncompressed) streams
+        if (current.compression or StoreCompression.NONE) != wanted.compression:
+            return True
+        fields = (
+            "retention",
+            "duplicate_window",
+            "storage",
+            "num_replicas",
+            "max_bytes",
+            "max_msgs",
+            "max_age",
+            "discard",
+        )
+        return any(getattr(current, field) != getattr(wanted, field) for field in fields)
+
+    def forget_stream(self, stream_name: str) -> None:
+        """Forget that the stream `stream_name` and its consumers were ensured, e.g. after they were deleted."""
+        self._ensured_streams.pop(stream_name, None)
+        for key in [key for key in self._ensured_consumers if key[0] == stream_name]:
+            self._ensured_consumers.pop(key, None)
+
+    async def ensure_subscription_stream(
+        self,
+        stream: str,
+        subjects: List[str],
+        ack_wait: Optional[float] = None,
+        duplicate_window: Optional[float] = None,
+        policy: Optional[StreamPolicy] = None,
+    ):
+        """
+        Create or update the stream of a subscription and its consumers.
+
+        Every subject gets its own durable consumer. The stream uses the interest retention policy,
+        so a message is removed as soon as the consumer of its subject acknowledged it.
 
-    async def ensure_consumer(self, stream: str, deliver_subject: Optional[str] = None):
+        Streams of older versions used the limits retention policy with a single unfiltered consumer
+        and had their messages deleted manually. They are migrated: the subject consumers are created
+        before the unfiltered consumer is removed, so that no message is lost when the retention policy
+        is changed.
+        """
+        if not await self.stream_exists(stream):
+            # The stream may have been deleted by another process since this one ensured it
+            self.forget_stream(NatsKeys.stream(stream))
+            await self.ensure_stream(
+                stream,
+                False,
+                subjects,
+                retention=RetentionPolicy.INTEREST,
+                duplicate_window=duplicate_window,
+                policy=policy,
+            )
+            for subject in subjects:
+                await self.ensure_consumer(stream, filter_subject=subject, ack_wait=ack_wait)
+            return
+
+        # A stream that this process ensured was already migrated.
+        migrated = NatsKeys.stream(stream) in self._ensured_streams
+        for subject in subjects:
+            await self.ensure_consumer(stream, filter_subject=subject, ack_wait=ack_wait)
+        # The unfiltered consumer would keep an interest in all messages, preventing their removal.
+        if not migrated:
+            await self.delete_consumer(stream)
+        await self.ensure_stream(
+            stream,
+            False,
+            subjects,
+            retention=RetentionPolicy.INTEREST,
+            duplicate_window=duplicate_window,
+            policy=policy,
+        )
+
+    async def ensure_consumer(
+        self,
+        stream: str,
+        deliver_subject: Optional[str] = None,
+        filter_subject: Optional[str] = None,
+        ack_wait: Optional[float] = None,
+        max_ack_pending: int = 1,
+    ):
         stream_name = NatsKeys.stream(stream)
-        durable_name = NatsKeys.durable_name(stream)
+        durable_name = (
+            NatsKeys.subject_durable_name(filter_subject) if filter_subject else NatsKeys.durable_name(stream)
+        )
+        consumer_config = ConsumerConfig(
+            durable_name=durable_name,
+            deliver_subject=deliver_subject,
+            filter_subject=filter_subject,
+            ack_wait=ack_wait,
+            max_ack_pending=max_ack_pending,
+        )
+        if self._ensured_consumers.get((stream_name, durable_name)) == consumer_config:
+            return
+        ensured_config = dataclasses.replace(consumer_config)
 
         try:
-            await self._js.consumer_info(stream_name, durable_name)
-            logger.info("A consumer with the name %r already exists", durable_name)
+            consumer_info = await self._js.consumer_info(stream_name, durable_name)
         except NotFoundError:
-            await self._js.add_consumer(
-                stream_name,
-                ConsumerConfig(
-                    durable_name=durable_name,
-                    deliver_subject=deliver_subject,
-                    max_ack_pending=1,
-                ),
-            )
+            if filter_subject:
+                await self._continue_unfiltered_consumer(stream_name, NatsKeys.durable_name(stream), consumer_config)
+            await self._js.add_consumer(stream_name, consumer_config)
             logger.info("A consumer with the name %r was created", durable_name)
+        else:
+            logger.info("A consumer with the name %r already exists", durable_name)
+            changes = self.consumer_config_changes(consumer_info.config, consumer_config)
+            if changes:
+                await self._js.add_consumer(stream_name, dataclasses.replace(consumer_info.config, **changes))
+                logger.info("Updated the consumer %r: %r", durable_name, changes)
+        self._ensured_consumers[(stream_name, durable_name)] = ensured_config
+
+    @staticmethod
+    def consumer_config_changes(current: ConsumerConfig, wanted: ConsumerConfig) -> dict[str, Any]:
+        """
+        Return the fields of the `current` configuration of a consumer that differ from `wanted`.
+
+        Fields that are not set in `wanted` keep their current value. The other fields of the consumer,
+        like its deliver policy, cannot be changed and are not compared.
+        """
+        fields = ("deliver_subject", "filter_subject", "ack_wait", "max_ack_pending")
+        return {
+            field: getattr(wanted, field)
+            for field in fields
+            if getattr(wanted, field) is not None and getattr(current, field) != getattr(wanted, field)
+        }
+
+    async def _continue_unfiltered_consumer(
+        self, stream_name: str, unfiltered_durable_name: str, consumer_config: ConsumerConfig
+    ) -> None:
+        """
+        Start a new subject consumer after the last message delivered by the unfiltered consumer of older versions.
+
+        The messages delivered by the unfiltered consumer may still be stored in the stream,
+        they must not be delivered again.
+        """
+        try:
+            unfiltered_info = await self._js.consumer_info(stream_name, unfiltered_durable_name)
+        except NotFoundError:
+            return
+        consumer_config.deliver_policy = DeliverPolicy.BY_START_SEQUENCE
+        consumer_config.opt_start_seq = unfiltered_info.delivered.stream_seq + 1
+        logger.info(
+            "The consumer %r continues after the message %d delivered by %r.",
+            consumer_config.durable_name,
+            unfiltered_info.delivered.stream_seq,
+            unfiltered_durable_name,
+        )
 
     def build_acknowledgements(self, message: Msg) -> Acknowledgements:
         return Acknowledgements(
@@ -421,7 +924,8 @@ class NatsMQAdapter(BaseMQAdapter):
 
     async def acknowledge_message(self, message: MQMessage):
         msg = self.nats_message_from(message)
-        await msg.ack()
+        with NATS_OPERATION_SECONDS.labels("ack").time():
+            await msg.ack()
 
     async def acknowledge_message_negatively(self, message: MQMessage):
         msg = self.nats_message_from(message)
@@ -440,5 +944,38 @@ class NatsMQAdapter(BaseMQAdapter):
         except (ServerError, NotFoundError) as exc:
             raise ValueError(exc.description)
 
+    def subscription_message_from(self, stream: str, seq_num: int, ack_token: str) -> Msg:
+        """
+        Recreate a message of a subscription's stream from the acknowledgement token that was delivered with it.
+
+        The token is the reply subject of the delivered message. It must belong to the stream and sequence number,
+        so that a subscription cannot acknowledge messages of other subscriptions.
+        """
+        prefix = f"$JS.ACK.{NatsKeys.stream(stream)}."
+        if not ack_token.startswith(prefix) or ack_token.split(".")[-4] != str(seq_num):
+            raise ValueError("The acknowledgement token does not match the message.")
+        return Msg(_client=self._nats, reply=ack_token)
+
+    async def acknowledge_subscription_message(self, stream: str, seq_num: int, ack_token: str) -> None:
+        """Acknowledge a message of a subscription's stream and wait for the confirmation of the server."""
+        msg = self.subscription_message_from(stream, seq_num, ack_token)
+        try:
+            with NATS_OPERATION_SECONDS.labels("ack").time():
+                await msg.ack_sync()
+        except (NoRespondersError, NatsTimeoutError) as exc:
+            raise ValueError(f"The message could not be acknowledged: {exc}") from exc
+
+    async def acknowledge_subscription_message_negatively(
+        self, stream: str, seq_num: int, ack_token: str, delay: Optional[float] = None
+    ) -> None:
+        """Request the redelivery of a message of a subscription's stream, optionally after `delay` seconds."""
+        msg = self.subscription_message_from(stream, seq_num, ack_token)
+        await msg.nak(delay=delay)
+
+    async def acknowledge_subscription_message_in_progress(self, stream: str, seq_num: int, ack_token: str) -> None:
+        """Reset the acknowledgement timeout of a message of a subscription's stream."""
+        msg = self.subscription_message_from(stream, seq_num, ack_token)
+        await msg.in_progress()
+
     async def purge_subject_from_messages(self, stream: str, subject: str):
         await self._js.purge_stream(NatsKeys.stream(stream), subject=subject)
@@ -0,0 +1,83 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# SPDX-FileCopyrightText: 2024 Univention GmbH
+
+import gzip
+import re
+from typing import Callable, Optional, Sequence
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .negotiation import negotiate
+
+try:
+    import zstandard
+except ImportError:
+    # zstd is only offered with the optional `zstandard` package
+    zstandard = None
+
+# Level of the gzip compression (1: fastest, 9: smallest)
+GZIP_LEVEL = 6
+# Level of the zstd compression (1: fastest, 22: smallest)
+ZSTD_LEVEL = 3
+
+
+def compressors() -> dict[str, Callable[[bytes], bytes]]:
+    """Return the functions that compress a response body, by their content coding."""
+    result: dict[str, Callable[[bytes], bytes]] = {}
+    if zstandard:
+        result["zstd"] = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress
+    result["gzip"] = lambda body: gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    return result
+
+
+class CompressionMiddleware:
+    """
+    Compress the responses of the requests to `paths` with zstd or gzip, as negotiated with `Accept-Encoding`.
+
+    Only bodies of at least `minimum_size` bytes are compressed, smaller ones are not worth the CPU time.
+    The response body is buffered, so the middleware must not be used for streamed responses.
+    """
+
+    def __init__(self, app: ASGIApp, paths: Sequence[str], minimum_size: int) -> None:
+        self.app = app
+        self.paths = re.compile("|".join(f"(?:{path})" for path in paths))
+        self.minimum_size = minimum_size
+        self.compressors = compressors()
+        self.encodings = ("identity", *self.compressors)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not self.paths.fullmatch(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding"), self.encodings)
+        if encoding == "identity":
+            await self.app(scope, receive, send)
+            return
+
+        start: Optional[Message] = None
+        body = []
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body" or start is None:
+                await send(message)
+                return
+            body.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+
+            content = b"".join(body)
+            headers = MutableHeaders(raw=start["headers"])
+            if len(content) >= self.minimum_size and "content-encoding" not in headers:
+                content = self.compressors[encoding](content)
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(content))
+            headers.add_vary_header("Accept-Encoding")
+            await send(start)
+            await send({"type": "http.response.body", "body": content})
+
+        await self.app(scope, receive, send_compressed)
@@ -2,9 +2,13 @@
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 
 from functools import lru_cache
+from typing import Optional
 
 from pydantic_settings import BaseSettings
 
+from server.stream_policy import StreamPolicy
+from server.tracing import TracesExporter
+
 
 class AppSettings(BaseSettings):
     # Python log level
@@ -16,6 +20,8 @@ class AppSettings(BaseSettings):
     root_path: str
     # FastAPI: disable CORS checks
     cors_all: bool
+    # Exporter of the traces of this service: none, console or otlp (configured with the OTEL_EXPORTER_OTLP_* variables)
+    traces_exporter: TracesExporter = "none"
 
     # Admin API: username
     admin_username: str
@@ -41,6 +47,23 @@ class AppSettings(BaseSettings):
     # Prefill: password
     prefill_password: str
 
+    # Consumer API: seconds a subscriber has to report the processing status of a message before it is redelivered
+    message_ack_wait: float = 30.0
+    # Consumer API: seconds a client instance holds the lease of a partition of a subscription without renewing it
+    partition_lease_ttl: float = 30.0
+    # Consumer API: validate the delivered messages with the message model instead of passing their stored JSON
+    # through unchanged (for debugging)
+    strict_message_validation: bool = False
+    # Consumer API: minimum size in bytes of the messages and subscription lists that are compressed (gzip or zstd)
+    compression_minimum_size: int = 1024
+    # Seconds in which messages with the ID of an already published message are discarded from subscription streams
+    # (None: default of the NATS server)
+    nats_duplicate_window: Optional[float] = None
+    # JetStream storage, replication and limits of the streams of the subscriptions (JSON, see stream_policy)
+    subscription_stream_policy: StreamPolicy = StreamPolicy()
+    # JetStream storage, replication and limits of the stream of the prefill requests (JSON, see stream_policy)
+    internal_stream_policy: StreamPolicy = StreamPolicy()
+
     # Events API: username
     events_username_udm: str
     # Events API: password
@@ -13,17 +13,23 @@ from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from fastapi_utils.timing import add_timing_middleware
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 from server.log import setup_logging
 from server.services.port import Port
+from server.services.subscriptions import SubscriptionService
+from server.tracing import setup_tracing
 from univention.provisioning.models.queue import PREFILL_STREAM
 
+from .compression import CompressionMiddleware
 from .config import app_settings
 from .messages import router as messages_api_router
+from .stats import router as stats_api_router
 from .subscriptions import router as subscriptions_api_router
 
 settings = app_settings()
 setup_logging(settings.log_level)
+setup_tracing("provisioning-api", settings.traces_exporter)
 logger = logging.getLogger(__name__)
 
 
@@ -36,6 +42,11 @@ app = FastAPI(
 )
 add_timing_middleware(app, record=logger.info)
 app.add_middleware(CorrelationIdMiddleware)
+app.add_middleware(
+    CompressionMiddleware,
+    paths=[r"/v1/subscriptions", r"/v1/subscriptions/[^/]+/messages/next"],
+    minimum_size=settings.compression_minimum_size,
+)
 
 if settings.cors_all:
     app.add_middleware(
@@ -48,6 +59,14 @@ if settings.cors_all:
 
 app.include_router(subscriptions_api_router)
 app.include_router(messages_api_router)
+app.include_router(stats_api_router)
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics() -> Response:
+    """Prometheus metrics of this process."""
+    # Set as header, as Starlette would append another charset to the `media_type`
+    return Response(generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
 
 
 def add_exception_handlers(_app: FastAPI):
@@ -78,7 +97,8 @@ async def startup_task():
 
     async with Port.port_context() as port:
         logger.info("Checking MQ connectivity...")
-        await port.ensure_stream(PREFILL_STREAM, False)
+        await port.ensure_stream(PREFILL_STREAM, False, policy=settings.internal_stream_policy)
+        await SubscriptionService(port).ensure_subscription_queues()
 
 
 @app.exception_handler(RequestValidationError)
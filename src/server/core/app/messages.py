@@ -1,14 +1,16 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 
-from typing import Annotated
+from typing import Annotated, Optional
 
 import fastapi
-from fastapi import Depends
+from fastapi import Depends, Header
 from fastapi.security import HTTPBasic
+from opentelemetry.trace import SpanKind
 
 from server.services.messages import MessageService
 from server.services.port import PortDependency
+from server.tracing import extract_trace_context, tracer
 from univention.provisioning.models import Message
 
 from .dependencies import authenticate_events_endpoint
@@ -20,12 +22,21 @@ security = HTTPBasic()
 @router.post("", status_code=fastapi.status.HTTP_202_ACCEPTED)
 async def create_new_message(
     msg: Message,
+    request: fastapi.Request,
     port: PortDependency,
     authentication: Annotated[None, Depends(authenticate_events_endpoint)],
+    idempotency_key: Optional[str] = Header(None),
 ):
-    """Publish a new message to the incoming queue."""
+    """
+    Publish a new message to the incoming queue.
+
+    A message with the `Idempotency-Key` of an already published message is discarded.
+    """
 
     # TODO: set publisher_name from authentication data
 
     msg_service = MessageService(port)
-    await msg_service.add_live_event(msg)
+    with tracer().start_as_current_span(
+        "receive event", context=extract_trace_context(request.headers), kind=SpanKind.SERVER
+    ):
+        await msg_service.add_live_event(msg, idempotency_key)
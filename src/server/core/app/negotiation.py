@@ -0,0 +1,27 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# SPDX-FileCopyrightText: 2024 Univention GmbH
+
+from typing import Optional, Sequence
+
+
+def negotiate(header: Optional[str], offered: Sequence[str]) -> str:
+    """
+    Return the value of `offered` with the highest quality in an `Accept` or `Accept-Encoding` header.
+
+    The first offered value is the default, for a missing header and for values that are not offered.
+    Of values with the same quality, the one listed first in the header is returned.
+    """
+    preferred, preferred_quality = offered[0], 0.0
+    for entry in (header or "").split(","):
+        value, *params = (part.strip() for part in entry.split(";"))
+        quality = 1.0
+        for param in params:
+            key, _, param_value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(param_value)
+                except ValueError:
+                    quality = 0.0
+        if value in offered and quality > preferred_quality:
+            preferred, preferred_quality = value, quality
+    return preferred
@@ -0,0 +1,25 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# SPDX-FileCopyrightText: 2024 Univention GmbH
+
+import fastapi
+from fastapi import Depends
+
+from server.services.port import PortDependency
+from server.services.subscriptions import SubscriptionService
+from univention.provisioning.models import SubscriptionStats
+
+from .dependencies import authenticate_admin
+
+router = fastapi.APIRouter(prefix="/v1/stats", tags=["stats"])
+
+
+@router.get("/subscriptions", status_code=fastapi.status.HTTP_200_OK, dependencies=[Depends(authenticate_admin)])
+async def get_subscriptions_stats(port: PortDependency) -> list[SubscriptionStats]:
+    """
+    Return the backlog of the queue of each subscription and how far its consumers lag behind.
+
+    The statistics are updated at most every few seconds.
+    """
+
+    service = SubscriptionService(port)
+    return await service.get_subscriptions_stats()
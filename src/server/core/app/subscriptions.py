@@ -6,24 +6,31 @@ import time
 from typing import Annotated, Optional
 
 import fastapi
-from fastapi import Depends, HTTPException, Response
+import msgpack
+from fastapi import Depends, Header, HTTPException, Response
 
-from server.services.messages import MessageService
+from server.services.messages import InvalidPartition, MessageService, PartitionNotLeased
 from server.services.port import PortDependency
 from server.services.subscriptions import SubscriptionService
 from univention.provisioning.models import (
+    MSGPACK_MEDIA_TYPE,
     FillQueueStatusReport,
     MessageProcessingStatusReport,
     NewSubscription,
+    PartitionLease,
     ProvisioningMessage,
     Subscription,
 )
 
 from .dependencies import AppSettingsDep, HttpBasicDep, authenticate_admin, authenticate_prefill
+from .negotiation import negotiate
 
 router = fastapi.APIRouter(prefix="/v1/subscriptions", tags=["subscriptions"])
 logger = logging.getLogger(__name__)
 
+# Media types of the delivered messages, the first one is the default
+MESSAGE_MEDIA_TYPES = ("application/json", MSGPACK_MEDIA_TYPE)
+
 
 @router.get("", status_code=fastapi.status.HTTP_200_OK, dependencies=[Depends(authenticate_admin)])
 async def get_subscriptions(port: PortDependency) -> list[Subscription]:
@@ -97,29 +104,103 @@ async def update_subscription_prefill_status(
         raise fastapi.HTTPException(fastapi.status.HTTP_404_NOT_FOUND, str(err))
 
 
-@router.get("/{name}/messages/next", status_code=fastapi.status.HTTP_200_OK)
+@router.post("/{name}/partitions/leases", status_code=fastapi.status.HTTP_200_OK)
+async def lease_partition(
+    name: str,
+    port: PortDependency,
+    credentials: HttpBasicDep,
+    settings: AppSettingsDep,
+    lease_id: Optional[str] = None,
+) -> PartitionLease:
+    """
+    Lease a partition of a partitioned subscription, or renew the lease `lease_id`.
+
+    The lease must be renewed before it expires. Otherwise its partition may be leased by another client instance.
+    """
+
+    service = SubscriptionService(port)
+    await service.authenticate_user(credentials, name)
+
+    try:
+        return await service.lease_partition(name, settings.partition_lease_ttl, lease_id)
+    except ValueError as err:
+        logger.debug("Failed to lease a partition: %s", err)
+        raise fastapi.HTTPException(fastapi.status.HTTP_404_NOT_FOUND, str(err))
+
+
+@router.delete("/{name}/partitions/leases/{lease_id}", status_code=fastapi.status.HTTP_200_OK)
+async def release_partition(name: str, lease_id: str, port: PortDependency, credentials: HttpBasicDep):
+    """Release a lease, so that its partition can be leased by another client instance."""
+
+    service = SubscriptionService(port)
+    await service.authenticate_user(credentials, name)
+    await service.release_partition(name, lease_id)
+
+
+@router.get(
+    "/{name}/messages/next",
+    status_code=fastapi.status.HTTP_200_OK,
+    responses={fastapi.status.HTTP_200_OK: {"content": {MSGPACK_MEDIA_TYPE: {}}}},
+)
 async def get_next_message(
-    name: str, port: PortDependency, credentials: HttpBasicDep, timeout: float = 5, pop: bool = False
+    name: str,
+    port: PortDependency,
+    credentials: HttpBasicDep,
+    settings: AppSettingsDep,
+    timeout: float = 5,
+    pop: bool = False,
+    partition: Optional[int] = None,
+    lease_id: Optional[str] = None,
+    accept: Optional[str] = Header(None),
 ) -> Optional[ProvisioningMessage]:
-    """Return the next pending message for the given subscription."""
+    """
+    Return the next pending message for the given subscription.
+
+    Messages of a partitioned subscription are read from the given `partition`, which must be leased first.
+    The `lease_id` of the lease is checked, so that each partition is read by a single client instance.
+    The message is encoded in MessagePack instead of JSON, if the `Accept` header prefers `application/msgpack`.
+    """
 
     t0 = time.perf_counter()
     sub_service = SubscriptionService(port)
     await sub_service.authenticate_user(credentials, name)
     td0 = time.perf_counter() - t0
 
+    as_msgpack = negotiate(accept, MESSAGE_MEDIA_TYPES) == MSGPACK_MEDIA_TYPE
     t0 = time.perf_counter()
     msg_service = MessageService(port)
-    msg = await msg_service.get_next_message(name, timeout, pop)
+    try:
+        msg = await msg_service.get_next_message(
+            name, timeout, pop, partition, settings.strict_message_validation, lease_id, as_msgpack
+        )
+    except InvalidPartition as err:
+        logger.debug("Failed to get the next message: %s", err)
+        raise fastapi.HTTPException(fastapi.status.HTTP_422_UNPROCESSABLE_ENTITY, str(err))
+    except PartitionNotLeased as err:
+        logger.debug("Failed to get the next message: %s", err)
+        raise fastapi.HTTPException(fastapi.status.HTTP_409_CONFLICT, str(err))
+    except ValueError as err:
+        logger.debug("Failed to get the next message: %s", err)
+        raise fastapi.HTTPException(fastapi.status.HTTP_404_NOT_FOUND, str(err))
     td1 = time.perf_counter() - t0
     timing = f"Auth: {td0 * 1000:.1f} ms, MQ: {td1 * 1000:.1f} ms"
-    msg_details = (
-        f"new message ({timing}). Publisher: {msg.publisher_name.value} TS: {msg.ts.isoformat()} Realm: {msg.realm} "
-        f"Topic: {msg.topic}"
-        if msg
-        else f"no message ({timing})."
-    )
+    if isinstance(msg, ProvisioningMessage):
+        msg_details = (
+            f"new message ({timing}). Publisher: {msg.publisher_name.value} TS: {msg.ts.isoformat()} "
+            f"Realm: {msg.realm} Topic: {msg.topic}"
+        )
+    else:
+        msg_details = f"new message ({timing})." if msg else f"no message ({timing})."
     logger.debug("Got %s", msg_details)
+
+    if as_msgpack:
+        if not isinstance(msg, bytes):
+            msg = msgpack.packb(msg.model_dump(mode="json") if msg else None)
+        # Otherwise the MessagePack of the stored message, built without validating it again
+        return Response(msg, media_type=MSGPACK_MEDIA_TYPE)
+    if isinstance(msg, bytes):
+        # The JSON of the stored message, returned without validating it again
+        return Response(msg, media_type="application/json")
     return msg
 
 
@@ -127,7 +208,12 @@ async def get_next_message(
 async def update_message_status(
     name: str, seq_num: int, report: MessageProcessingStatusReport, port: PortDependency, credentials: HttpBasicDep
 ):
-    """Report on the processing of the given message."""
+    """
+    Report on the processing of the given message.
+
+    `ok` acknowledges the message, `failed` requests its redelivery (optionally after `redelivery_delay` seconds)
+    and `in_progress` extends the time the subscriber has to report on the message.
+    """
 
     sub_service = SubscriptionService(port)
     await sub_service.authenticate_user(credentials, name)
@@ -135,7 +221,7 @@ async def update_message_status(
     msg_service = MessageService(port)
 
     try:
-        await msg_service.post_message_status(name, seq_num, report.status)
+        await msg_service.post_message_status(name, seq_num, report.status, report.ack_token, report.redelivery_delay)
     except ValueError as err:
         logger.debug("Failed to post message status: %s", err)
         raise fastapi.HTTPException(fastapi.status.HTTP_404_NOT_FOUND, str(err))
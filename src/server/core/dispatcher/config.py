@@ -1,10 +1,13 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 from functools import lru_cache
-from typing import Literal
+from typing import Literal, Optional
 
 from pydantic_settings import BaseSettings
 
+from server.stream_policy import StreamPolicy
+from server.tracing import TracesExporter
+
 Loglevel = Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
 
 
@@ -22,6 +25,15 @@ class DispatcherSettings(BaseSettings):
     nats_port: int
     # Maximum number of reconnect attempts to the NATS server
     nats_max_reconnect_attempts: int
+    # Seconds in which messages with the ID of an already published message are discarded from the incoming stream
+    # (None: default of the NATS server)
+    nats_duplicate_window: Optional[float] = None
+    # JetStream storage, replication and limits of the incoming stream (JSON, see stream_policy)
+    incoming_stream_policy: StreamPolicy = StreamPolicy()
+    # Port of the HTTP listener that serves the Prometheus metrics (0: disabled)
+    metrics_port: int = 9090
+    # Exporter of the traces of this service: none, console or otlp (configured with the OTEL_EXPORTER_OTLP_* variables)
+    traces_exporter: TracesExporter = "none"
 
     @property
     def nats_server(self) -> str:
@@ -9,6 +9,8 @@ from server.core.dispatcher.config import dispatcher_settings
 from server.core.dispatcher.port import DispatcherPort
 from server.core.dispatcher.service.dispatcher import DispatcherService
 from server.log import setup_logging
+from server.metrics import start_metrics_server
+from server.tracing import setup_tracing
 
 
 async def run_dispatcher():
@@ -25,4 +27,6 @@ def main():
 if __name__ == "__main__":
     dispatcher_settings = dispatcher_settings()
     setup_logging(dispatcher_settings.log_level)
+    start_metrics_server(dispatcher_settings.metrics_port)
+    setup_tracing("provisioning-dispatcher", dispatcher_settings.traces_exporter)
     main()
@@ -6,7 +6,7 @@ from __future__ import annotations
 import contextlib
 from typing import Any, AsyncGenerator, Awaitable, Callable, Optional
 
-from server.adapters.nats_adapter import NatsKVAdapter, NatsMQAdapter
+from server.adapters.nats_adapter import NatsKVAdapter, NatsMQAdapter, OutgoingMessage
 from univention.provisioning.models import Bucket, Message, MQMessage, Subscription
 
 from .config import DispatcherSettings, dispatcher_settings
@@ -46,11 +46,21 @@ class DispatcherPort:
         await self.mq_adapter.close()
         await self.kv_adapter.close()
 
-    async def send_message_to_subscription(self, stream: str, subject: str, message: Message) -> None:
-        await self.mq_adapter.add_message(stream, subject, message)
+    async def send_message_to_subscriptions(
+        self, streams_subjects: list[tuple[str, str]], message: Message, msg_id: Optional[str] = None
+    ) -> None:
+        """Publish `message` to the (stream, subject) pairs of multiple subscriptions. Raise the first error."""
+        errors = await self.mq_adapter.add_messages(
+            [OutgoingMessage(stream, subject, message, msg_id) for stream, subject in streams_subjects]
+        )
+        for error in errors:
+            if error:
+                raise error
 
     async def subscribe_to_queue(self, subject: str, deliver_subject: str) -> None:
-        await self.mq_adapter.subscribe_to_queue(subject, deliver_subject)
+        await self.mq_adapter.subscribe_to_queue(
+            subject, deliver_subject, self.settings.nats_duplicate_window, self.settings.incoming_stream_policy
+        )
 
     async def wait_for_event(self) -> MQMessage:
         return await self.mq_adapter.wait_for_event()
@@ -2,10 +2,16 @@
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 import asyncio
 import logging
+import zlib
+
+from opentelemetry.trace import SpanKind
 
 from server.core.dispatcher.port import DispatcherPort
+from server.metrics import DISPATCH_FANOUT
+from server.tracing import extract_trace_context, tracer
 from server.utils.old_message_ack_manager import MessageAckManager
 from univention.provisioning.models import (
+    DISPATCHER_PARTITION_SUBJECT_TEMPLATE,
     DISPATCHER_STREAM,
     DISPATCHER_SUBJECT_TEMPLATE,
     Message,
@@ -61,19 +67,49 @@ class DispatcherService:
         )
         logger.debug("Message content: %r", data)
 
-        validated_msg = Message.model_validate(data)
-
-        subscriptions = self._subscriptions.get(validated_msg.realm, {}).get(validated_msg.topic, [])
+        with tracer().start_as_current_span(
+            "dispatch", context=extract_trace_context(message.headers), kind=SpanKind.CONSUMER
+        ) as span:
+            validated_msg = Message.model_validate(data)
 
-        for sub in subscriptions:
-            logger.info("Sending message to %r", sub.name)
-            await self._port.send_message_to_subscription(
-                sub.name, DISPATCHER_SUBJECT_TEMPLATE.format(subscription=sub.name), validated_msg
+            subscriptions = self._subscriptions.get(validated_msg.realm, {}).get(validated_msg.topic, [])
+            DISPATCH_FANOUT.observe(len(subscriptions))
+            span.set_attributes(
+                {
+                    "provisioning.realm": validated_msg.realm,
+                    "provisioning.topic": validated_msg.topic,
+                    "provisioning.subscriptions": len(subscriptions),
+                }
             )
-        if not subscriptions:
-            logger.info("No consumers for message with realm: %r topic: %r.", validated_msg.realm, validated_msg.topic)
 
-        await self._port.acknowledge_message(message)
+            if subscriptions:
+                logger.info("Sending message to %r", [sub.name for sub in subscriptions])
+                # An ID of the incoming message is kept, so it is also stored only once in each subscription's stream.
+                await self._port.send_message_to_subscriptions(
+                    [(sub.name, self.subscription_subject(sub, validated_msg)) for sub in subscriptions],
+                    validated_msg,
+                    message.msg_id,
+                )
+            else:
+                logger.info(
+                    "No consumers for message with realm: %r topic: %r.", validated_msg.realm, validated_msg.topic
+                )
+
+            await self._port.acknowledge_message(message)
+
+    @staticmethod
+    def subscription_subject(sub: Subscription, message: Message) -> str:
+        """
+        Return the subject of the subscription's stream that `message` is stored under.
+
+        Messages of a partitioned subscription are distributed by the identity of their object,
+        so all messages about one object end up - in order - in the same partition.
+        """
+        if sub.partitions == 1:
+            return DISPATCHER_SUBJECT_TEMPLATE.format(subscription=sub.name)
+        key = message.body.object_key or ""
+        partition = zlib.crc32(key.encode("utf-8")) % sub.partitions
+        return DISPATCHER_PARTITION_SUBJECT_TEMPLATE.format(subscription=sub.name, partition=partition)
 
     async def update_subscriptions_mapping(self, *args, **kwargs) -> None:
         new_subscriptions_mapping: dict[str, dict[str, set[Subscription]]] = {}
@@ -6,6 +6,9 @@ from typing import Literal
 from pydantic import conint
 from pydantic_settings import BaseSettings
 
+from server.stream_policy import StreamPolicy
+from server.tracing import TracesExporter
+
 Loglevel = Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
 
 
@@ -31,6 +34,15 @@ class PrefillSettings(BaseSettings):
     # Prefill: maximum number of retries of a prefill request
     # -1 means infinite retries.
     max_prefill_attempts: conint(ge=-1)
+    # JetStream storage, replication and limits of the stream of the prefill requests (JSON, see stream_policy)
+    internal_stream_policy: StreamPolicy = StreamPolicy()
+    # JetStream storage, replication and limits of the stream of the failed prefill requests (JSON, see stream_policy)
+    prefill_failures_stream_policy: StreamPolicy = StreamPolicy()
+
+    # Port of the HTTP listener that serves the Prometheus metrics (0: disabled)
+    metrics_port: int = 9090
+    # Exporter of the traces of this service: none, console or otlp (configured with the OTEL_EXPORTER_OTLP_* variables)
+    traces_exporter: TracesExporter = "none"
 
     # UDM REST API: host
     udm_host: str
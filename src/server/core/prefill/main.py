@@ -9,6 +9,8 @@ from server.core.prefill.config import prefill_settings
 from server.core.prefill.port import PrefillPort
 from server.core.prefill.service.udm_prefill import UDMPreFill
 from server.log import setup_logging
+from server.metrics import start_metrics_server
+from server.tracing import setup_tracing
 
 
 async def run_prefill():
@@ -25,4 +27,6 @@ def main():
 if __name__ == "__main__":
     prefill_settings = prefill_settings()
     setup_logging(prefill_settings.log_level)
+    start_metrics_server(prefill_settings.metrics_port)
+    setup_tracing("provisioning-prefill", prefill_settings.traces_exporter)
     main()
@@ -7,6 +7,7 @@ from typing import Optional, Tuple
 from server.adapters.internal_api_adapter import InternalAPIAdapter
 from server.adapters.nats_adapter import Acknowledgements, NatsMQAdapter
 from server.adapters.udm_adapter import UDMAdapter
+from server.stream_policy import StreamPolicy
 from univention.provisioning.models import (
     FillQueueStatus,
     Message,
@@ -50,7 +51,9 @@ class PrefillPort:
         await self._internal_api_adapter.close()
 
     async def initialize_subscription(self, stream: str, manual_delete: bool, subject: str | None) -> None:
-        await self.mq_adapter.initialize_subscription(stream, manual_delete, subject)
+        await self.mq_adapter.initialize_subscription(
+            stream, manual_delete, subject, policy=self.settings.internal_stream_policy
+        )
 
     async def get_one_message(
         self,
@@ -75,8 +78,8 @@ class PrefillPort:
     async def add_request_to_prefill_failures(self, stream: str, subject: str, message: BaseMessage):
         await self.mq_adapter.add_message(stream, subject, message)
 
-    async def ensure_stream(self, subject: str, manual_delete: bool):
-        await self.mq_adapter.ensure_stream(subject, manual_delete)
+    async def ensure_stream(self, subject: str, manual_delete: bool, policy: Optional[StreamPolicy] = None):
+        await self.mq_adapter.ensure_stream(subject, manual_delete, policy=policy)
 
     async def delete_stream(self, stream_name: str):
         await self.mq_adapter.delete_stream(stream_name)
@@ -192,5 +192,7 @@ class UDMPreFill:
         )
 
     async def prepare_prefill_failures_queue(self):
-        await self._port.ensure_stream(self.PREFILL_FAILURES_STREAM, False)
+        await self._port.ensure_stream(
+            self.PREFILL_FAILURES_STREAM, False, self._port.settings.prefill_failures_stream_policy
+        )
         await self._port.ensure_consumer(self.PREFILL_FAILURES_STREAM)
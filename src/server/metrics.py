@@ -0,0 +1,65 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# SPDX-FileCopyrightText: 2024 Univention GmbH
+
+"""
+Prometheus metrics of the provisioning services.
+
+The REST API exposes them at `/metrics`, the daemons start their own HTTP listener with `start_metrics_server()`.
+"""
+
+import logging
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+logger = logging.getLogger(__name__)
+
+# Buckets for operations that take a few milliseconds, up to long polling requests
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+NATS_OPERATION_SECONDS = Histogram(
+    "provisioning_nats_operation_seconds",
+    "Duration of NATS JetStream operations (fetch, publish, ack)",
+    ["operation"],
+    buckets=LATENCY_BUCKETS,
+)
+KV_OPERATION_SECONDS = Histogram(
+    "provisioning_kv_operation_seconds",
+    "Duration of NATS key/value store operations (get, put, delete)",
+    ["operation", "bucket"],
+    buckets=LATENCY_BUCKETS,
+)
+BCRYPT_SECONDS = Histogram(
+    "provisioning_bcrypt_seconds",
+    "Duration of hashing and verifying passwords with bcrypt",
+    ["operation"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.5),
+)
+DISPATCH_FANOUT = Histogram(
+    "provisioning_dispatch_fanout",
+    "Number of subscriptions an incoming message is dispatched to",
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100),
+)
+SUBSCRIPTION_QUEUE_DEPTH = Gauge(
+    "provisioning_subscription_queue_depth",
+    "Messages waiting for delivery in a subject of a subscription, as of the last fetch",
+    ["subscription", "subject"],
+)
+TRANSFORMER_STAGE_SECONDS = Histogram(
+    "provisioning_transformer_stage_seconds",
+    "Duration of the stages of the udm-transformer (transform, retrieve, store, reload, publish)",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+TRANSFORMER_CACHE_LOOKUPS = Counter(
+    "provisioning_transformer_cache_lookups",
+    "Lookups in the in-memory cache of the udm-transformer",
+    ["result"],
+)
+
+
+def start_metrics_server(port: int) -> None:
+    """Serve the metrics of this process over HTTP on `port` (0: disabled)."""
+    if not port:
+        return
+    start_http_server(port)
+    logger.info("Serving metrics on port %d.", port)
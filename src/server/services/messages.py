@@ -4,9 +4,10 @@ import asyncio
 import logging
 import time
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Union
 
 from univention.provisioning.models import (
+    DISPATCHER_PARTITION_SUBJECT_TEMPLATE,
     DISPATCHER_STREAM,
     DISPATCHER_SUBJECT_TEMPLATE,
     PREFILL_STREAM,
@@ -26,6 +27,12 @@ from .subscriptions import SubscriptionService
 logger = logging.getLogger(__name__)
 
 
+class InvalidPartition(Exception): ...
+
+
+class PartitionNotLeased(Exception): ...
+
+
 class MessageService:
     _subscription_prefill_done: dict[str, bool] = {}
 
@@ -49,19 +56,29 @@ class MessageService:
         subscription_name: str,
         timeout: float,
         pop: bool,
-    ) -> Optional[ProvisioningMessage]:
+        partition: Optional[int] = None,
+        validate: bool = True,
+        lease_id: Optional[str] = None,
+        as_msgpack: bool = False,
+    ) -> Union[ProvisioningMessage, bytes, None]:
         """Retrieve the first message from the subscription's stream.
 
+        Messages from the prefill subject are delivered first. Once no more messages are stored under it, the
+        main subject is read instead. Whether the prefill subject still holds messages is determined from the
+        stream state, so switching to the main subject does not wait for an empty fetch to time out.
+
         :param str subscription_name: Name of the subscription.
         :param bool pop: If the message should be deleted after request.
         :param float timeout: Max duration of the request before it expires.
+        :param int partition: The partition to read from, required if the subscription is partitioned.
+        :param bool validate: Return the validated message, instead of its JSON as it is stored.
+        :param str lease_id: The lease of the `partition`, which must be held by the caller.
+        :param bool as_msgpack: Return the MessagePack of a message that is not validated, instead of its JSON.
         """
         timeout = max(timeout, 0.1)  # Timeout of 0 leads to internal server error
         t0 = time.perf_counter()
-        if self._subscription_prefill_done.get(subscription_name, False):
-            message = await self.get_messages_from_main_queue(subscription_name, timeout, pop)
-            queue = "main"
-        else:
+        await self.check_partition(subscription_name, partition, lease_id)
+        if not self._subscription_prefill_done.get(subscription_name, False):
             if await self.check_subscription_status(subscription_name, timeout) != FillQueueStatus.done:  # take ~1.5ms
                 logger.warning(
                     "Prefill status for subscription %r did not reach 'done' within the timeout period.",
@@ -69,14 +86,24 @@ class MessageService:
                 )
                 return None
 
-            message = await self.get_messages_from_prefill_queue(subscription_name, timeout, pop)
-            queue = "prefill"
-            if message is None:
+            if await self.prefill_queue_is_empty(subscription_name):
                 logger.info(
                     "All messages from the prefill subject for %r have been delivered. Will not check again.",
                     subscription_name,
                 )
                 self._subscription_prefill_done[subscription_name] = True
+            else:
+                message = await self.get_messages_from_prefill_queue(
+                    subscription_name, timeout, pop, validate, as_msgpack
+                )
+                queue = "prefill"
+
+        if self._subscription_prefill_done.get(subscription_name, False):
+            message = await self.get_messages_from_main_queue(
+                subscription_name, timeout, pop, partition, validate, as_msgpack
+            )
+            queue = "main" if partition is None else f"main (partition {partition})"
+
         logger.debug(
             "Retrieved%s message from %s queue for %r. (%.1f ms)",
             " a" if message else " no",
@@ -86,24 +113,90 @@ class MessageService:
         )
         return message
 
+    async def prefill_queue_is_empty(self, subscription: str) -> bool:
+        """
+        Check if all messages of the prefill subject have been processed.
+
+        Messages are deleted from the subscription's stream when they are popped or reported as processed,
+        so the prefill subject is empty when no message is stored under it anymore.
+        """
+        prefill_subject = PREFILL_SUBJECT_TEMPLATE.format(subscription=subscription)
+        return await self._port.get_subject_message_count(subscription, prefill_subject) == 0
+
+    async def check_partition(self, subscription_name: str, partition: Optional[int], lease_id: Optional[str]) -> None:
+        """
+        Check that `partition` is given if, and only if, the subscription is partitioned, that it exists,
+        and that the caller holds its lease `lease_id`, so that each partition is read by a single client instance.
+        """
+        sub_service = SubscriptionService(self._port)
+        partitions = await sub_service.get_subscription_partitions(subscription_name)
+
+        if partitions == 1 and partition is not None:
+            raise InvalidPartition("The subscription is not partitioned.")
+        if partitions > 1 and partition is None:
+            raise InvalidPartition("The subscription is partitioned, a partition must be given.")
+        if partition is not None and not 0 <= partition < partitions:
+            raise InvalidPartition(f"The subscription has {partitions} partitions, {partition} does not exist.")
+        if partition is not None and not await sub_service.is_partition_leased(subscription_name, partition, lease_id):
+            raise PartitionNotLeased(f"The partition {partition} is not leased with the given lease.")
+
     async def get_messages_from_main_queue(
-        self, subscription: str, timeout: float, pop: bool
-    ) -> Optional[ProvisioningMessage]:
-        main_subject = DISPATCHER_SUBJECT_TEMPLATE.format(subscription=subscription)
-        return await self._port.get_message(subscription, main_subject, timeout, pop)
+        self,
+        subscription: str,
+        timeout: float,
+        pop: bool,
+        partition: Optional[int] = None,
+        validate: bool = True,
+        as_msgpack: bool = False,
+    ) -> Union[ProvisioningMessage, bytes, None]:
+        if partition is None:
+            main_subject = DISPATCHER_SUBJECT_TEMPLATE.format(subscription=subscription)
+        else:
+            main_subject = DISPATCHER_PARTITION_SUBJECT_TEMPLATE.format(subscription=subscription, partition=partition)
+        return await self.get_message(subscription, main_subject, timeout, pop, validate, as_msgpack)
 
     async def get_messages_from_prefill_queue(
-        self, subscription: str, timeout: float, pop: bool
-    ) -> Optional[ProvisioningMessage]:
+        self, subscription: str, timeout: float, pop: bool, validate: bool = True, as_msgpack: bool = False
+    ) -> Union[ProvisioningMessage, bytes, None]:
         prefill_subject = PREFILL_SUBJECT_TEMPLATE.format(subscription=subscription)
-        return await self._port.get_message(subscription, prefill_subject, timeout, pop)
+        return await self.get_message(subscription, prefill_subject, timeout, pop, validate, as_msgpack)
+
+    async def get_message(
+        self, subscription: str, subject: str, timeout: float, pop: bool, validate: bool, as_msgpack: bool = False
+    ) -> Union[ProvisioningMessage, bytes, None]:
+        if validate:
+            return await self._port.get_message(subscription, subject, timeout, pop)
+        if as_msgpack:
+            return await self._port.get_message_msgpack(subscription, subject, timeout, pop)
+        return await self._port.get_message_json(subscription, subject, timeout, pop)
+
+    async def post_message_status(
+        self,
+        subscription_name: str,
+        seq_num: int,
+        status: MessageProcessingStatus,
+        ack_token: Optional[str] = None,
+        redelivery_delay: Optional[float] = None,
+    ):
+        """
+        Report the processing status of a message to the subscription's consumer.
 
-    async def post_message_status(self, subscription_name: str, seq_num: int, status: MessageProcessingStatus):
-        if status == MessageProcessingStatus.ok:
-            await self._port.delete_message(subscription_name, seq_num)
+        Without an `ack_token` (sent by clients of older versions) a processed message is deleted from the stream.
+        """
+        if not ack_token:
+            if status == MessageProcessingStatus.ok:
+                await self._port.delete_message(subscription_name, seq_num)
+            return
 
-    async def add_live_event(self, event: Message):
-        await self._port.add_message(DISPATCHER_STREAM, DISPATCHER_STREAM, event)
+        if status == MessageProcessingStatus.ok:
+            await self._port.acknowledge_message(subscription_name, seq_num, ack_token)
+        elif status == MessageProcessingStatus.failed:
+            await self._port.acknowledge_message_negatively(subscription_name, seq_num, ack_token, redelivery_delay)
+        elif status == MessageProcessingStatus.in_progress:
+            await self._port.acknowledge_message_in_progress(subscription_name, seq_num, ack_token)
+
+    async def add_live_event(self, event: Message, msg_id: Optional[str] = None):
+        await self._port.add_message(DISPATCHER_STREAM, DISPATCHER_STREAM, event, msg_id)
 
     async def send_request_to_prefill(self, subscription: NewSubscription):
         logger.info("Sending the requests to prefill")
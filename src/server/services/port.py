@@ -3,12 +3,13 @@
 
 import json
 from contextlib import asynccontextmanager
-from typing import Annotated, List, Optional, Union
+from typing import Annotated, List, Optional, Tuple, Union
 
 from fastapi import Depends
 
-from server.adapters.nats_adapter import NatsKVAdapter, NatsMQAdapter
+from server.adapters.nats_adapter import NatsKVAdapter, NatsMQAdapter, StreamStats
 from server.core.app.config import AppSettings, app_settings
+from server.stream_policy import StreamPolicy
 from univention.provisioning.models import (
     Bucket,
     Message,
@@ -52,22 +53,47 @@ class Port:
             server=self.settings.nats_server,
             user=self.settings.nats_user,
             password=self.settings.nats_password,
-            buckets=[Bucket.subscriptions, Bucket.credentials],
+            buckets=[Bucket.subscriptions, Bucket.credentials, Bucket.partition_leases],
         )
 
     async def close(self):
         await self.mq_adapter.close()
         await self.kv_adapter.close()
 
-    async def add_message(self, stream: str, subject: str, message: Union[Message, PrefillMessage]):
-        await self.mq_adapter.add_message(stream, subject, message)
+    async def add_message(
+        self, stream: str, subject: str, message: Union[Message, PrefillMessage], msg_id: Optional[str] = None
+    ):
+        await self.mq_adapter.add_message(stream, subject, message, msg_id=msg_id)
 
     async def get_message(self, stream: str, subject: str, timeout: float, pop: bool) -> Optional[ProvisioningMessage]:
-        return await self.mq_adapter.get_message(stream, subject, timeout, pop)
+        return await self.mq_adapter.get_message(stream, subject, timeout, pop, self.settings.message_ack_wait)
+
+    async def get_message_json(self, stream: str, subject: str, timeout: float, pop: bool) -> Optional[bytes]:
+        return await self.mq_adapter.get_message_json(stream, subject, timeout, pop, self.settings.message_ack_wait)
+
+    async def get_message_msgpack(self, stream: str, subject: str, timeout: float, pop: bool) -> Optional[bytes]:
+        return await self.mq_adapter.get_message_msgpack(stream, subject, timeout, pop, self.settings.message_ack_wait)
+
+    async def get_subject_message_count(self, stream: str, subject: str) -> int:
+        return await self.mq_adapter.get_subject_message_count(stream, subject)
+
+    async def get_stream_stats(self, stream: str) -> Optional[StreamStats]:
+        return await self.mq_adapter.get_stream_stats(stream)
 
     async def delete_message(self, stream: str, seq_num: int):
         await self.mq_adapter.delete_message(stream, seq_num)
 
+    async def acknowledge_message(self, stream: str, seq_num: int, ack_token: str):
+        await self.mq_adapter.acknowledge_subscription_message(stream, seq_num, ack_token)
+
+    async def acknowledge_message_negatively(
+        self, stream: str, seq_num: int, ack_token: str, delay: Optional[float] = None
+    ):
+        await self.mq_adapter.acknowledge_subscription_message_negatively(stream, seq_num, ack_token, delay)
+
+    async def acknowledge_message_in_progress(self, stream: str, seq_num: int, ack_token: str):
+        await self.mq_adapter.acknowledge_subscription_message_in_progress(stream, seq_num, ack_token)
+
     async def delete_stream(self, stream_name: str):
         await self.mq_adapter.delete_stream(stream_name)
 
@@ -75,6 +101,10 @@ class Port:
         result = await self.kv_adapter.get_value(name, bucket)
         return json.loads(result) if result else None
 
+    async def get_dict_value_with_revision(self, name: str, bucket: Bucket) -> Optional[Tuple[dict, int]]:
+        result = await self.kv_adapter.get_value_with_revision(name, bucket)
+        return (json.loads(result[0]), result[1]) if result else None
+
     async def get_list_value(self, key: str, bucket: Bucket) -> List[str]:
         result = await self.kv_adapter.get_value(key, bucket)
         return json.loads(result) if result else []
@@ -88,8 +118,14 @@ class Port:
     async def put_value(self, key: str, value: Union[str, dict, list], bucket: Bucket, revision: Optional[int] = None):
         await self.kv_adapter.put_value(key, value, bucket, revision)
 
-    async def ensure_stream(self, stream: str, manual_delete: bool, subjects: List[str] | None = None):
-        await self.mq_adapter.ensure_stream(stream, manual_delete, subjects)
+    async def ensure_stream(
+        self,
+        stream: str,
+        manual_delete: bool,
+        subjects: List[str] | None = None,
+        policy: Optional[StreamPolicy] = None,
+    ):
+        await self.mq_adapter.ensure_stream(stream, manual_delete, subjects, policy=policy)
 
     async def stream_exists(self, prefill_queue_name: str) -> bool:
         return await self.mq_adapter.stream_exists(prefill_queue_name)
@@ -100,8 +136,14 @@ class Port:
     async def get_bucket_keys(self, bucket: Bucket):
         return await self.kv_adapter.get_keys(bucket)
 
-    async def ensure_consumer(self, subject):
-        await self.mq_adapter.ensure_consumer(subject)
+    async def ensure_subscription_stream(self, stream: str, subjects: List[str]):
+        await self.mq_adapter.ensure_subscription_stream(
+            stream,
+            subjects,
+            self.settings.message_ack_wait,
+            self.settings.nats_duplicate_window,
+            self.settings.subscription_stream_policy,
+        )
 
 
 PortDependency = Annotated[Port, Depends(Port.port_dependency)]
@@ -1,21 +1,31 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 
+import asyncio
 import logging
+import time
+import uuid
+from datetime import datetime, timezone
 from typing import List, Optional
 
+import cachetools
 import cachetools.func
 from fastapi import HTTPException, status
 from fastapi.security import HTTPBasicCredentials
 from passlib.context import CryptContext
 
+from server.adapters.nats_adapter import UpdateConflict
+from server.metrics import BCRYPT_SECONDS
 from univention.provisioning.models import (
+    DISPATCHER_PARTITION_SUBJECT_TEMPLATE,
     DISPATCHER_SUBJECT_TEMPLATE,
     PREFILL_SUBJECT_TEMPLATE,
     Bucket,
     FillQueueStatus,
     NewSubscription,
+    PartitionLease,
     Subscription,
+    SubscriptionStats,
 )
 
 from .port import Port
@@ -24,6 +34,10 @@ REALM_TOPIC_TEMPLATE = "{realm}:{topic}"
 logger = logging.getLogger(__name__)
 password_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 PASSWORD_CACHE_TTL = 30.0
+PARTITION_LEASE_ATTEMPTS = 5
+STATS_CACHE_TTL = 5.0
+PARTITIONS_CACHE_TTL = 10.0
+LEASE_CHECK_CACHE_TTL = 5.0
 
 
 @cachetools.func.ttl_cache(maxsize=32, ttl=PASSWORD_CACHE_TTL)
@@ -36,10 +50,23 @@ def verify_and_update_password(
     Caches all hits and exceptions!
     But the caller (SubscriptionService.authenticate_user()) will delete negative hits, so we cache only positive hits.
     """
-    return password_context.verify_and_update(cleartext_pw, hashed_pw)  # takes ~200ms
+    with BCRYPT_SECONDS.labels("verify").time():
+        return password_context.verify_and_update(cleartext_pw, hashed_pw)  # takes ~200ms
 
 
 class SubscriptionService:
+    # Statistics of all subscriptions, shared by the requests of this process until they expire
+    _stats_cache: cachetools.TTLCache = cachetools.TTLCache(maxsize=1, ttl=STATS_CACHE_TTL)
+    _stats_lock = asyncio.Lock()
+    # Number of deliveries and time of the previous statistics of each subscription, to compute the delivery rate
+    _delivery_samples: dict[str, tuple[int, float]] = {}
+    # Number of partitions of each subscription, shared by the requests of this process until they expire, so that
+    # a subscription that was registered again by another process is not checked with its old partitions for long
+    _partitions_cache: cachetools.TTLCache = cachetools.TTLCache(maxsize=1024, ttl=PARTITIONS_CACHE_TTL)
+    # Expiry of the checked partition leases by (subscription, partition, lease_id), so that fetching messages does
+    # not read the leases for each message. A lease released by another process is still accepted until it expires.
+    _leases_cache: cachetools.TTLCache = cachetools.TTLCache(maxsize=4096, ttl=LEASE_CHECK_CACHE_TTL)
+
     def __init__(self, port: Port):
         self._port = port
 
@@ -58,7 +85,8 @@ class SubscriptionService:
 
     @staticmethod
     def hash_password(password: str) -> str:
-        return password_context.hash(password)
+        with BCRYPT_SECONDS.labels("hash").time():
+            return password_context.hash(password)
 
     async def is_subscriptions_matching(self, new_sub: NewSubscription, existing_sub: Subscription) -> bool:
         """
@@ -71,8 +99,12 @@ class SubscriptionService:
         if new_sub.realms_topics != existing_sub.realms_topics:
             return False
 
+        if new_sub.partitions != existing_sub.partitions:
+            return False
+
         hashed_password = await self._port.get_str_value(new_sub.name, Bucket.credentials)
-        valid = password_context.verify(new_sub.password, hashed_password)
+        with BCRYPT_SECONDS.labels("verify").time():
+            valid = password_context.verify(new_sub.password, hashed_password)
         if not valid:
             return False
 
@@ -91,11 +123,13 @@ class SubscriptionService:
             return False
         else:
             logger.info(
-                "Registering new subscription (name: %r realms_topics: %r request_prefill: %r).",
+                "Registering new subscription (name: %r realms_topics: %r request_prefill: %r partitions: %r).",
                 new_sub.name,
                 new_sub.realms_topics,
                 new_sub.request_prefill,
+                new_sub.partitions,
             )
+            self._partitions_cache.pop(new_sub.name, None)
             encrypted_password = self.hash_password(new_sub.password)
             await self._port.put_value(new_sub.name, encrypted_password, Bucket.credentials)
             await self.prepare_and_store_subscription_info(new_sub)
@@ -113,17 +147,34 @@ class SubscriptionService:
             realms_topics=new_sub.realms_topics,
             request_prefill=new_sub.request_prefill,
             prefill_queue_status=prefill_queue_status,
+            partitions=new_sub.partitions,
         )
         await self.set_sub_info(new_sub.name, sub_info)
-        await self._port.ensure_stream(
-            new_sub.name,
-            True,
-            [
-                DISPATCHER_SUBJECT_TEMPLATE.format(subscription=new_sub.name),
-                PREFILL_SUBJECT_TEMPLATE.format(subscription=new_sub.name),
-            ],
+        await self.ensure_subscription_queue(new_sub.name, new_sub.partitions)
+
+    async def ensure_subscription_queue(self, name: str, partitions: int = 1):
+        """
+        Create or update the stream of a subscription and its consumers.
+
+        There is one consumer per subject, so that the prefill subject can be read before the main subject.
+        The main subject of a partitioned subscription is split into one subject per partition.
+        """
+        if partitions > 1:
+            main_subjects = [
+                DISPATCHER_PARTITION_SUBJECT_TEMPLATE.format(subscription=name, partition=partition)
+                for partition in range(partitions)
+            ]
+        else:
+            main_subjects = [DISPATCHER_SUBJECT_TEMPLATE.format(subscription=name)]
+        await self._port.ensure_subscription_stream(
+            name, [*main_subjects, PREFILL_SUBJECT_TEMPLATE.format(subscription=name)]
         )
-        await self._port.ensure_consumer(new_sub.name)
+
+    async def ensure_subscription_queues(self):
+        """Bring the streams and consumers of all subscriptions up to date, e.g. after an update."""
+        for name in await self.get_subscription_names():
+            sub_info = await self.get_subscription_info(name)
+            await self.ensure_subscription_queue(name, sub_info.partitions if sub_info else 1)
 
     async def get_subscription(self, name: str) -> Subscription:
         """
@@ -134,6 +185,14 @@ class SubscriptionService:
         else:
             raise ValueError("Subscription was not found.")
 
+    async def get_subscription_partitions(self, name: str) -> int:
+        """Get the number of partitions of a registered subscription, cached for `PARTITIONS_CACHE_TTL` seconds."""
+        partitions = self._partitions_cache.get(name)
+        if partitions is None:
+            partitions = (await self.get_subscription(name)).partitions
+            self._partitions_cache[name] = partitions
+        return partitions
+
     async def get_subscription_info(self, name: str) -> Optional[Subscription]:
         result = await self._port.get_dict_value(name, Bucket.subscriptions)
         return Subscription.model_validate(result) if result else result
@@ -171,12 +230,163 @@ class SubscriptionService:
 
         await self._port.delete_kv_pair(name, Bucket.credentials)
         await self.delete_sub_info(name)
+        self._partitions_cache.pop(name, None)
+        await self._port.delete_kv_pair(name, Bucket.partition_leases)
         await self._port.delete_stream(name)
         await self._port.delete_consumer(name)
 
     async def delete_sub_info(self, name: str):
         await self._port.delete_kv_pair(name, Bucket.subscriptions)
 
+    async def lease_partition(self, name: str, ttl: float, lease_id: Optional[str] = None) -> PartitionLease:
+        """
+        Lease a free partition of a subscription to a client instance, or renew the lease `lease_id`.
+
+        A lease expires after `ttl` seconds unless it is renewed. A renewed lease keeps its partition,
+        if the lease expired in the meantime, it gets its partition back if it is still free.
+        The leases of a subscription are stored together, concurrent changes are detected using the revision.
+        """
+        sub_info = await self.get_subscription(name)
+        if sub_info.partitions == 1:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="The subscription is not partitioned.",
+            )
+        for _ in range(PARTITION_LEASE_ATTEMPTS):
+            result = await self._port.get_dict_value_with_revision(name, Bucket.partition_leases)
+            leases, revision = result if result else ({}, 0)
+            now = time.time()
+
+            taken = {
+                int(partition)
+                for partition, lease in leases.items()
+                if lease["expires"] > now and lease["lease_id"] != lease_id
+            }
+            previous = [
+                int(partition) for partition, lease in leases.items() if lease_id and lease["lease_id"] == lease_id
+            ]
+            free = [p for p in previous if p not in taken] + [p for p in range(sub_info.partitions) if p not in taken]
+            if not free:
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail="All partitions of the subscription are leased.",
+                )
+
+            partition = free[0]
+            lease = {"lease_id": lease_id or uuid.uuid4().hex, "expires": now + ttl}
+            leases = {p: _lease for p, _lease in leases.items() if _lease["lease_id"] != lease["lease_id"]}
+            leases[str(partition)] = lease
+            try:
+                await self._port.put_value(name, leases, Bucket.partition_leases, revision)
+            except UpdateConflict:
+                logger.debug("Concurrent change of the partition leases of %r, retrying.", name)
+                continue
+
+            return PartitionLease(
+                partition=partition,
+                lease_id=lease["lease_id"],
+                expires=datetime.fromtimestamp(lease["expires"], tz=timezone.utc),
+            )
+
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="The partition leases of the subscription are changed concurrently, please try again.",
+        )
+
+    async def is_partition_leased(self, name: str, partition: int, lease_id: Optional[str]) -> bool:
+        """
+        Check that `partition` of a subscription is leased with the lease `lease_id`, which has not expired.
+
+        A valid lease is remembered for `LEASE_CHECK_CACHE_TTL` seconds, or until it expires.
+        """
+        if not lease_id:
+            return False
+        key = (name, partition, lease_id)
+        expires = self._leases_cache.get(key)
+        if expires is None:
+            leases = await self._port.get_dict_value(name, Bucket.partition_leases) or {}
+            lease = leases.get(str(partition))
+            if not lease or lease["lease_id"] != lease_id:
+                return False
+            expires = lease["expires"]
+            self._leases_cache[key] = expires
+        return expires > time.time()
+
+    async def release_partition(self, name: str, lease_id: str):
+        """Release the lease `lease_id`, so that its partition can be leased by another client instance."""
+        for _ in range(PARTITION_LEASE_ATTEMPTS):
+            result = await self._port.get_dict_value_with_revision(name, Bucket.partition_leases)
+            if not result:
+                return
+            leases, revision = result
+            released = [partition for partition, lease in leases.items() if lease["lease_id"] == lease_id]
+            if not released:
+                return
+            for partition in released:
+                # Keep the entry, so that the key is not deleted while other client instances update it.
+                leases[partition]["expires"] = 0
+            try:
+                await self._port.put_value(name, leases, Bucket.partition_leases, revision)
+                for partition in released:
+                    self._leases_cache.pop((name, int(partition), lease_id), None)
+                return
+            except UpdateConflict:
+                logger.debug("Concurrent change of the partition leases of %r, retrying.", name)
+
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="The partition leases of the subscription are changed concurrently, please try again.",
+        )
+
+    async def get_subscriptions_stats(self) -> List[SubscriptionStats]:
+        """
+        Return the backlog and the lag of the queues of all subscriptions.
+
+        The statistics are cached for `STATS_CACHE_TTL` seconds, so that frequent polling by a monitoring system
+        does not query the streams of all subscriptions each time.
+        """
+        async with self._stats_lock:
+            stats = self._stats_cache.get("stats")
+            if stats is None:
+                names = await self.get_subscription_names()
+                stats = [await self.get_subscription_stats(name) for name in names]
+                for name in set(self._delivery_samples) - set(names):
+                    del self._delivery_samples[name]
+                self._stats_cache["stats"] = stats
+        return stats
+
+    async def get_subscription_stats(self, name: str) -> SubscriptionStats:
+        """Return the backlog and the lag of the queue of a subscription, computed from the state of its stream."""
+        stream_stats = await self._port.get_stream_stats(name)
+        now = time.monotonic()
+        subject_messages = stream_stats.subject_messages if stream_stats else {}
+        consumers = stream_stats.consumers if stream_stats else []
+        first_message_time = stream_stats.first_message_time if stream_stats else None
+
+        prefill_subject = PREFILL_SUBJECT_TEMPLATE.format(subscription=name)
+        delivered = sum(consumer.delivered for consumer in consumers)
+        delivery_rate = None
+        if previous := self._delivery_samples.get(name):
+            previous_delivered, previous_time = previous
+            # The counts start again at 0 when the consumers are recreated.
+            if delivered >= previous_delivered and now > previous_time:
+                delivery_rate = (delivered - previous_delivered) / (now - previous_time)
+        self._delivery_samples[name] = (delivered, now)
+
+        return SubscriptionStats(
+            name=name,
+            pending_messages=sum(consumer.num_pending for consumer in consumers),
+            unacknowledged_messages=sum(consumer.num_ack_pending for consumer in consumers),
+            prefill_backlog=subject_messages.get(prefill_subject, 0),
+            main_backlog=sum(count for subject, count in subject_messages.items() if subject != prefill_subject),
+            oldest_message_age=(
+                max((datetime.now(timezone.utc) - first_message_time).total_seconds(), 0.0)
+                if first_message_time
+                else None
+            ),
+            delivery_rate=delivery_rate,
+        )
+
     @staticmethod
     def handle_authentication_error(message: str):
         raise HTTPException(
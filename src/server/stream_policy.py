@@ -0,0 +1,31 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# SPDX-FileCopyrightText: 2024 Univention GmbH
+
+"""
+Storage, replication and limits of the JetStream streams, configured per class of stream.
+
+The classes are the internal streams (LDAP and LDIF changes, prefill requests), the incoming stream of the dispatcher,
+the streams of the subscriptions and the stream of the failed prefill requests. The policies are set in the settings of
+the service that creates the streams of a class, as JSON, e.g. `INCOMING_STREAM_POLICY='{"replicas": 3}'`.
+"""
+
+from typing import Literal, Optional
+
+from pydantic import BaseModel, Field
+
+
+class StreamPolicy(BaseModel):
+    # Storage of the messages: file, or memory (faster, but lost when the NATS server restarts)
+    storage: Literal["file", "memory"] = "file"
+    # Number of copies of each message in the NATS cluster
+    replicas: int = Field(1, ge=1, le=5)
+    # Maximum size of the stream in bytes (None: unlimited)
+    max_bytes: Optional[int] = Field(None, gt=0)
+    # Maximum number of messages in the stream (None: unlimited)
+    max_messages: Optional[int] = Field(None, gt=0)
+    # Maximum age of the messages in seconds (None: unlimited)
+    max_age: Optional[float] = Field(None, gt=0)
+    # Compress the stored messages with S2 (requires NATS server 2.10)
+    compression: bool = False
+    # When a limit is reached: discard the oldest messages, or refuse new messages
+    discard: Literal["old", "new"] = "old"
@@ -0,0 +1,77 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# SPDX-FileCopyrightText: 2024 Univention GmbH
+
+"""
+Tracing of messages through the provisioning services with OpenTelemetry.
+
+The trace context of a message travels in the headers of its NATS messages and of the HTTP requests between the
+services (W3C `traceparent` and `tracestate`), so the spans of all stages that handle one change form one trace.
+Without `setup_tracing()` no spans are recorded and no trace context is added to messages.
+"""
+
+import logging
+from typing import Literal, Mapping, Optional
+
+from opentelemetry import propagate, trace
+from opentelemetry.context import Context
+from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SpanExporter
+
+logger = logging.getLogger(__name__)
+
+TracesExporter = Literal["none", "console", "otlp"]
+
+# Headers that carry the trace context
+TRACE_CONTEXT_HEADERS = ("traceparent", "tracestate")
+
+
+def tracer() -> trace.Tracer:
+    return trace.get_tracer("provisioning")
+
+
+def setup_tracing(service_name: str, exporter: TracesExporter) -> None:
+    """
+    Record the spans of this process and export them with `exporter`.
+
+    The `otlp` exporter requires the `opentelemetry-exporter-otlp-proto-http` package and is configured with the
+    standard `OTEL_EXPORTER_OTLP_*` environment variables.
+    """
+    if exporter == "none":
+        return
+
+    span_exporter: SpanExporter
+    if exporter == "console":
+        span_exporter = ConsoleSpanExporter()
+    else:
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except ImportError as exc:
+            raise RuntimeError(
+                "Exporting traces with OTLP requires the package 'opentelemetry-exporter-otlp-proto-http'."
+            ) from exc
+        span_exporter = OTLPSpanExporter()
+
+    provider = TracerProvider(resource=Resource.create({SERVICE_NAME: service_name}))
+    provider.add_span_processor(BatchSpanProcessor(span_exporter))
+    trace.set_tracer_provider(provider)
+    logger.info("Exporting traces of %r to %r.", service_name, exporter)
+
+
+def inject_trace_context(headers: Optional[dict[str, str]] = None) -> dict[str, str]:
+    """Add the trace context of the current span to `headers` (a new dict if None) and return them."""
+    headers = {} if headers is None else headers
+    propagate.inject(headers)
+    return headers
+
+
+def extract_trace_context(headers: Optional[Mapping[str, str]]) -> Context:
+    """Return a context with the trace context from `headers`, to start the spans of the next stage in."""
+    return propagate.extract(headers or {})
+
+
+def trace_context_headers(headers: Optional[Mapping[str, str]]) -> Optional[dict[str, str]]:
+    """Return the headers of `headers` that carry the trace context, or None if there are none."""
+    if not headers:
+        return None
+    return {key: value for key, value in headers.items() if key in TRACE_CONTEXT_HEADERS} or None
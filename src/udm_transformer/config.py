@@ -5,6 +5,8 @@ from typing import Literal
 
 from pydantic_settings import BaseSettings
 
+from server.stream_policy import StreamPolicy
+from server.tracing import TracesExporter
 from univention.provisioning.models.queue import PublisherName
 
 Loglevel = Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
@@ -24,6 +26,27 @@ class UDMTransformerSettings(BaseSettings):
     nats_port: int
     # Enables toggling between `ldif-producer` and `udm-listener`
     ldap_publisher_name: PublisherName
+    # Maximum number of LDAP messages that are fetched, transformed and acknowledged together
+    batch_size: int = 1
+    # Publish the UDM messages directly to the incoming stream, instead of sending them to the Events API
+    direct_publish: bool = False
+    # Number of threads that transform LDAP objects to UDM objects concurrently, each with its own LDAP connection
+    transform_workers: int = 1
+    # Store objects in the cache as zlib compressed MessagePack instead of JSON. Entries in either format are read,
+    # so existing JSON entries are migrated when their object changes. Enable once no older instances run anymore.
+    compact_cache: bool = False
+    # Number of objects of the cache bucket that are additionally kept in memory (0: disabled).
+    # Enable only if a single udm-transformer is running, otherwise outdated objects are used.
+    cache_size: int = 0
+    # Seconds without further changes to extended attributes, UDM hooks etc. after which the UDM modules are reloaded.
+    # They are reloaded earlier when an object has to be transformed.
+    udm_reload_delay: float = 5.0
+    # JetStream storage, replication and limits of the stream of the LDAP or LDIF changes (JSON, see stream_policy)
+    internal_stream_policy: StreamPolicy = StreamPolicy()
+    # Port of the HTTP listener that serves the Prometheus metrics (0: disabled)
+    metrics_port: int = 9090
+    # Exporter of the traces of this service: none, console or otlp (configured with the OTEL_EXPORTER_OTLP_* variables)
+    traces_exporter: TracesExporter = "none"
 
     # Events API: username
     events_username_udm: str
@@ -1,11 +1,17 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 
+import asyncio
 import logging
+from typing import Optional
 
+from opentelemetry import trace
+from opentelemetry.context import Context
+from opentelemetry.trace import Link, SpanKind
 from pydantic import ValidationError
 
 from server.adapters.nats_adapter import Acknowledgements, Empty
+from server.tracing import extract_trace_context, tracer
 from server.utils.message_ack_manager import MessageAckManager
 from udm_transformer.port import UDMTransformerPort
 from udm_transformer.service.udm import UDMMessagingService
@@ -16,6 +22,7 @@ from univention.provisioning.models.queue import (
     LDIF_SUBJECT,
     Message,
     PublisherName,
+    message_id,
 )
 
 STREAM = {
@@ -37,33 +44,83 @@ class UDMTransformerController:
         # TODO: This needs to be tuned better!
         self.ack_manager = MessageAckManager(ack_wait=30, ack_threshold=5)
         self.ldap_publisher_name = port.settings.ldap_publisher_name
+        self.batch_size = port.settings.batch_size
+
+    async def handle_messages(self, messages: list[tuple[Message, Acknowledgements, Optional[str], Context]]) -> None:
+        """
+        Transform a batch of LDAP messages, then publish the results and acknowledge the messages.
+
+        The messages are transformed and published in order. The new object of each message is stored in the cache
+        after the message was published, so a message that is redelivered is transformed against the cache state
+        it was transformed against before.
+        If a message fails, the messages published before it are acknowledged and the others are redelivered.
+        Each result is published with an ID derived from its LDAP change, so a redelivered message is not
+        dispatched twice.
+        Each message gets a span in the trace it was received with, the transformation of the batch is traced in
+        the span of the first message and linked to the others.
+        """
+        published = 0
+        spans = [
+            tracer().start_span("handle ldap change", context=context, kind=SpanKind.CONSUMER)
+            for _, _, _, context in messages
+        ]
+
+        async def transform_and_publish():
+            nonlocal published
+            with tracer().start_as_current_span(
+                "transform",
+                context=trace.set_span_in_context(spans[0]),
+                links=[Link(span.get_span_context()) for span in spans[1:]],
+                attributes={"provisioning.batch_size": len(messages)},
+            ):
+                changes = await self._udm_service.transform_batch(
+                    [(message.body.new, message.body.old) for message, _, _, _ in messages]
+                )
+            for (new, old), (message, _, msg_id, _), span in zip(changes, messages, spans):
+                with trace.use_span(span):
+                    await self._udm_service.send_event(new, old, message.ts, msg_id)
+                    if new:
+                        await self._udm_service.store(new)
+                published += 1
+
+        async def acknowledge_in_progress():
+            await asyncio.gather(*(acks.acknowledge_message_in_progress() for _, acks, _, _ in messages))
 
-    async def handle_message(self, message: Message, acknowledgements: Acknowledgements) -> None:
-        message_handler = self._udm_service.handle_changes(
-            message.body.new,
-            message.body.old,
-            message.ts,
-        )
         try:
             await self.ack_manager.process_message_with_ack_wait_extension(
-                message_handler,
-                acknowledgements.acknowledge_message_in_progress,
+                transform_and_publish(),
+                acknowledge_in_progress,
             )
         except Exception:
-            await acknowledgements.acknowledge_message_negatively()
+            await asyncio.gather(
+                *(acks.acknowledge_message() for _, acks, _, _ in messages[:published]),
+                *(acks.acknowledge_message_negatively() for _, acks, _, _ in messages[published:]),
+            )
             raise
+        finally:
+            for span in spans:
+                span.end()
+
+        await asyncio.gather(*(acks.acknowledge_message() for _, acks, _, _ in messages))
 
     async def transform_events(self) -> None:
         await self._port.initialize_subscription(
             STREAM[self.ldap_publisher_name],
             False,
             SUBJECT[self.ldap_publisher_name],
+            self.batch_size,
         )
 
         while True:
             logger.debug("listening for new LDAP messages")
             try:
-                message, acknowledgements = await self._port.get_one_message(timeout=10)
+                batch = await self._port.get_messages(self.batch_size, timeout=10)
+            except Empty:
+                logger.debug("No new LDAP messages found in the queue, continuing to wait.")
+                continue
+
+            messages = []
+            for message, acknowledgements in batch:
                 data = message.data
                 logger.info(
                     "Received message to handle (Publisher: %r Realm: %r Topic: %r TS: %s).",
@@ -73,17 +130,16 @@ class UDMTransformerController:
                     data.get("ts"),
                 )
                 logger.debug("Message content: %r", data)
-            except Empty:
-                logger.debug("No new LDAP messages found in the queue, continuing to wait.")
-                continue
-            try:
-                validated_message = Message.model_validate(data)
-            except ValidationError:
-                logger.error("Failed to parse the ldap message.")
-                raise
+                try:
+                    validated_message = Message.model_validate(data)
+                except ValidationError:
+                    logger.error("Failed to parse the ldap message.")
+                    raise
+                keys = validated_message.body.ldap_change_keys
+                msg_id = message_id(self.ldap_publisher_name, *keys) if keys else None
+                messages.append((validated_message, acknowledgements, msg_id, extract_trace_context(message.headers)))
             try:
-                await self.handle_message(validated_message, acknowledgements)
+                await self.handle_messages(messages)
             except Exception:
                 logger.exception("Failed to transform message")
                 raise
-            await acknowledgements.acknowledge_message()
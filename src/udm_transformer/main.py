@@ -7,6 +7,8 @@ import logging
 from daemoniker import Daemonizer
 
 from server.log import setup_logging
+from server.metrics import start_metrics_server
+from server.tracing import setup_tracing
 from udm_transformer.config import udm_transformer_settings
 from udm_transformer.controller import UDMTransformerController
 from udm_transformer.port import UDMTransformerPort
@@ -30,4 +32,6 @@ if __name__ == "__main__":
     root_logger.handlers.clear()
     udm_transformer_settings = udm_transformer_settings()
     setup_logging(udm_transformer_settings.log_level)
+    start_metrics_server(udm_transformer_settings.metrics_port)
+    setup_tracing("provisioning-udm-transformer", udm_transformer_settings.traces_exporter)
     asyncio.run(main())
@@ -3,7 +3,10 @@
 
 import contextlib
 import json
-from typing import Optional
+import zlib
+from typing import Any, Optional
+
+import msgpack
 
 from server.adapters.internal_api_adapter import InternalAPIAdapter
 from server.adapters.nats_adapter import (
@@ -12,11 +15,27 @@ from server.adapters.nats_adapter import (
     NatsMQAdapter,
     messagepack_decoder,
 )
-from univention.provisioning.models import Bucket, Message
+from univention.provisioning.models import DISPATCHER_STREAM, Bucket, Message
 from univention.provisioning.models.queue import MQMessage
 
 from .config import UDMTransformerSettings, udm_transformer_settings
 
+# Prefix of compact cache entries: a zlib compressed MessagePack document.
+# Legacy cache entries are JSON documents and thus never start with this byte.
+COMPACT_CACHE_ENTRY_PREFIX = b"\x01"
+
+
+def cache_entry_encoder(data: Any, compact: bool = True) -> bytes:
+    if not compact:
+        return json.dumps(data).encode("utf-8")
+    return COMPACT_CACHE_ENTRY_PREFIX + zlib.compress(msgpack.packb(data))
+
+
+def cache_entry_decoder(data: bytes) -> Any:
+    if data.startswith(COMPACT_CACHE_ENTRY_PREFIX):
+        return msgpack.unpackb(zlib.decompress(data[len(COMPACT_CACHE_ENTRY_PREFIX) :]))
+    return json.loads(data)
+
 
 class UDMTransformerPort:
     def __init__(self, settings: Optional[UDMTransformerSettings] = None):
@@ -57,18 +76,34 @@ class UDMTransformerPort:
         await self._internal_api_adapter.close()
         await self.mq_adapter.close()
 
-    async def initialize_subscription(self, stream: str, manual_delete: bool, subject: str):
-        return await self.mq_adapter.initialize_subscription(stream, manual_delete, subject)
+    async def initialize_subscription(self, stream: str, manual_delete: bool, subject: str, max_ack_pending: int = 1):
+        return await self.mq_adapter.initialize_subscription(
+            stream, manual_delete, subject, max_ack_pending, self.settings.internal_stream_policy
+        )
 
     async def get_one_message(self, timeout: float) -> tuple[MQMessage, Acknowledgements]:
         return await self.mq_adapter.get_one_message(timeout=timeout, binary_decoder=messagepack_decoder)
 
+    async def get_messages(self, batch_size: int, timeout: float) -> list[tuple[MQMessage, Acknowledgements]]:
+        return await self.mq_adapter.get_messages(batch_size, timeout=timeout, binary_decoder=messagepack_decoder)
+
     async def retrieve(self, url: str, bucket: Bucket) -> dict:
-        result = await self.kv_adapter.get_value(url, bucket)
-        return json.loads(result) if result else {}
+        """Retrieve an object from the cache, stored in either the compact or the legacy JSON format."""
+        result = await self.kv_adapter.get_binary_value(url, bucket)
+        return cache_entry_decoder(result) if result else {}
+
+    async def store(self, url: str, new_obj: dict, bucket: Bucket):
+        """Store an object in the cache, in the compact format unless `compact_cache` is disabled."""
+        await self.kv_adapter.put_value(url, cache_entry_encoder(new_obj, self.settings.compact_cache), bucket)
 
-    async def store(self, url: str, new_obj: str, bucket: Bucket):
-        await self.kv_adapter.put_value(url, new_obj, bucket)
+    async def send_event(self, message: Message, msg_id: Optional[str] = None):
+        """
+        Send a message to the dispatcher.
 
-    async def send_event(self, message: Message):
-        await self._internal_api_adapter.send_event(message)
+        With `direct_publish` the message is published to the incoming stream, otherwise it is sent to the Events API.
+        Either way, a message with the same `msg_id` is published to the incoming stream only once.
+        """
+        if self.settings.direct_publish:
+            await self.mq_adapter.add_message(DISPATCHER_STREAM, DISPATCHER_STREAM, message, msg_id=msg_id)
+        else:
+            await self._internal_api_adapter.send_event(message, msg_id)
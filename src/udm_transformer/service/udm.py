@@ -1,12 +1,20 @@
 # Callable | NoneSPDX-License-Identifier: AGPL-3.0-only
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 
+import asyncio
+import copy
 import importlib
-import json
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Optional
+
+import cachetools
 
 import univention.admin.uldap
+from server.metrics import TRANSFORMER_CACHE_LOOKUPS, TRANSFORMER_STAGE_SECONDS
 from udm_transformer.port import UDMTransformerPort
 from univention.admin.rest.module import Object
 from univention.management.console.log import MODULE
@@ -44,6 +52,9 @@ UDM_MODULES_RELOAD_TRIGGER = {
     "settings/udm_syntax",
 }
 
+# Number of cache lookups after which the hit rate of the local cache is logged
+CACHE_STATS_LOG_INTERVAL = 1000
+
 
 class UDMMessagingService(univention.admin.uldap.access):
     def __init__(self, port: UDMTransformerPort):
@@ -59,24 +70,132 @@ class UDMMessagingService(univention.admin.uldap.access):
         self.ldap_publisher_name = port.settings.ldap_publisher_name
 
         self._messaging_port = port
+        # `ldap_to_udm()` is executed in worker threads, each with its own LDAP connection
+        self._executor = ThreadPoolExecutor(
+            max_workers=port.settings.transform_workers, thread_name_prefix="ldap-to-udm"
+        )
+        self._thread_local = threading.local()
+        # UDM modules with their LDAP connection by object type and id of the connection, cleared when the UDM modules
+        # are reloaded. The connection is kept, so that its id is not reused by another connection.
+        self._modules: dict[tuple[str, int], tuple[univention.admin.uldap.access, UDM_Module]] = {}
+        # Local copy of the most recently used objects of the cache bucket, by entryUUID.
+        # The cache bucket is only written by this process, in the order of the LDAP stream,
+        # so the local copy is never outdated.
+        self._cache = cachetools.LRUCache(maxsize=port.settings.cache_size) if port.settings.cache_size else None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Reloads of the UDM modules are delayed until no further change triggers a reload for `udm_reload_delay`
+        # seconds, or until an object has to be transformed
+        self._udm_reload_delay = port.settings.udm_reload_delay
+        self._udm_reload_requests = 0
+        self._udm_reload_task: Optional[asyncio.Task] = None
+        self._transformation_lock = asyncio.Lock()
+        self.udm_reloads = 0
+        self.udm_reload_duration = 0.0
 
-    @staticmethod
-    def reload_udm(obj: dict):
+    def _thread_ldap_connection(self) -> tuple[univention.admin.uldap.access, univention.admin.uldap.position]:
+        connection = getattr(self._thread_local, "connection", None)
+        if not connection:
+            settings = self._messaging_port.settings
+            connection = univention.admin.uldap.access(
+                host=settings.ldap_host,
+                port=settings.ldap_port,
+                start_tls=2 if settings.ldap_tls_mode.lower() == "on" else 0,
+                base=settings.ldap_base_dn,
+                binddn=settings.ldap_bind_dn,
+                bindpw=settings.ldap_bind_pw,
+            )
+            self._thread_local.connection = connection
+            self._thread_local.position = univention.admin.uldap.position(settings.ldap_base_dn)
+        return connection, self._thread_local.position
+
+    def request_udm_reload(self, obj: dict):
+        """Request a reload of the UDM modules, if `obj` changes them. Repeated requests are coalesced."""
         if obj.get("objectType") not in UDM_MODULES_RELOAD_TRIGGER:
             return
 
-        logger.info("Reload of UDM modules triggered after creating/updating/deleting %r object.", obj["objectType"])
+        logger.info("Reload of UDM modules requested after creating/updating/deleting %r object.", obj["objectType"])
+        self._udm_reload_requests += 1
+        if self._udm_reload_task:
+            self._udm_reload_task.cancel()
+        self._udm_reload_task = asyncio.create_task(self._reload_udm_later())
+
+    async def _reload_udm_later(self):
+        await asyncio.sleep(self._udm_reload_delay)
+        async with self._transformation_lock:
+            self._udm_reload_task = None
+            self.reload_udm()
+
+    def reload_udm(self):
+        """Reload the UDM modules, if requested."""
+        requests = self._udm_reload_requests
+        if not requests:
+            return
+        if self._udm_reload_task:
+            self._udm_reload_task.cancel()
+            self._udm_reload_task = None
+
+        start = time.perf_counter()
         importlib.reload(univention.management.console.modules.udm.udm_ldap)
+        self._modules.clear()
+        duration = time.perf_counter() - start
+        TRANSFORMER_STAGE_SECONDS.labels("reload").observe(duration)
+
+        self.udm_reloads += 1
+        self.udm_reload_duration += duration
+        logger.info(
+            "Reloaded UDM modules for %d request(s) in %.3fs (reloads: %d, total duration: %.3fs).",
+            requests,
+            duration,
+            self.udm_reloads,
+            self.udm_reload_duration,
+        )
+        # Requests during the reload are kept, they are handled by another reload
+        self._udm_reload_requests -= requests
+
+    @property
+    def cache_hit_rate(self) -> float:
+        lookups = self.cache_hits + self.cache_misses
+        return self.cache_hits / lookups if lookups else 0.0
+
+    def _count_cache_lookup(self, hit: bool):
+        TRANSFORMER_CACHE_LOOKUPS.labels("hit" if hit else "miss").inc()
+        if hit:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+        if (self.cache_hits + self.cache_misses) % CACHE_STATS_LOG_INTERVAL == 0:
+            logger.info(
+                "Local cache: hits: %d misses: %d hit rate: %.1f%% size: %d",
+                self.cache_hits,
+                self.cache_misses,
+                self.cache_hit_rate * 100,
+                self._cache.currsize,
+            )
 
     async def retrieve(self, dn: str) -> dict:
+        if self._cache is not None:
+            if obj := self._cache.get(dn):
+                logger.debug("Retrieved object from local cache")
+                self._count_cache_lookup(True)
+                # A copy, so that changes of the caller do not change the cached object
+                return copy.deepcopy(obj)
+            self._count_cache_lookup(False)
+
         logger.debug("Retrieving object from cache")
-        return await self._messaging_port.retrieve(dn, Bucket.cache)
+        obj = await self._messaging_port.retrieve(dn, Bucket.cache)
+        if obj and self._cache is not None:
+            self._cache[dn] = copy.deepcopy(obj)
+        return obj
 
     async def store(self, new_obj: dict):
         logger.debug("Storing object to cache with dn: %r", new_obj.get("dn"))
-        await self._messaging_port.store(new_obj["uuid"], json.dumps(new_obj), Bucket.cache)
+        with TRANSFORMER_STAGE_SECONDS.labels("store").time():
+            await self._messaging_port.store(new_obj["uuid"], new_obj, Bucket.cache)
+        if self._cache is not None:
+            self._cache[new_obj["uuid"]] = copy.deepcopy(new_obj)
 
-    async def send_event(self, new_obj: dict, old_obj: dict, ts: datetime):
+    async def send_event(self, new_obj: dict, old_obj: dict, ts: datetime, msg_id: Optional[str] = None):
         if not (new_obj or old_obj):
             return
 
@@ -95,34 +214,54 @@ class UDMMessagingService(univention.admin.uldap.access):
             body=Body(old=old_obj, new=new_obj),
         )
         logger.debug("Sending the message with body: %r", message.body)
-        await self._messaging_port.send_event(message)
+        with TRANSFORMER_STAGE_SECONDS.labels("publish").time():
+            await self._messaging_port.send_event(message, msg_id)
         logger.info("The message was sent")
 
-    def _get_module(self, object_type):
-        module = UDM_Module(object_type, ldap_connection=self, ldap_position=self._my_ldap_position)
+    def _get_module(self, object_type, lo: univention.admin.uldap.access, position: univention.admin.uldap.position):
+        key = (object_type, id(lo))
+        if cached := self._modules.get(key):
+            return cached[1]
+
+        module = UDM_Module(object_type, ldap_connection=lo, ldap_position=position)
         if not module or not module.module:
             raise ModuleNotFound
+        self._modules[key] = (lo, module)
         return module
 
-    def ldap_to_udm(self, entry: dict) -> dict:
+    @staticmethod
+    def ldap_object_type(entry: dict) -> Optional[str]:
         object_types = entry.get("univentionObjectType", [])
         if not isinstance(object_types, list) or len(object_types) < 1:
+            return None
+        return object_types[0].decode("utf-8")
+
+    def ldap_to_udm(
+        self,
+        entry: dict,
+        lo: Optional[univention.admin.uldap.access] = None,
+        position: Optional[univention.admin.uldap.position] = None,
+    ) -> dict:
+        """Transform an LDAP object to a UDM object, using the LDAP connection `lo` (default: this one)."""
+        lo = lo or self
+        position = position or self._my_ldap_position
+        object_type = self.ldap_object_type(entry)
+        if not object_type:
             MODULE.warn("ReadControl response is missing `univentionObjectType`!")
             return {}
 
-        object_type = object_types[0].decode("utf-8")
         try:
-            module = self._get_module(object_type)
+            module = self._get_module(object_type, lo, position)
             module_obj = module.module.object(
                 co=None,
-                lo=self,
-                position=self._my_ldap_position,
+                lo=lo,
+                position=position,
                 dn=entry["entryDN"][0],
                 superordinate=None,
                 attributes=entry,
             )
             module_obj.open()
-            return Object.get_representation(module, module_obj, ["*"], self, False)
+            return Object.get_representation(module, module_obj, ["*"], lo, False)
         except ModuleNotFound:
             MODULE.error("ReadControl response has object type %r, but the module was not found!" % object_type)
             return {}
@@ -137,17 +276,82 @@ class UDMMessagingService(univention.admin.uldap.access):
                 entry,
             )
 
+    def _ldap_to_udm_in_thread(self, entry: dict) -> dict:
+        return self.ldap_to_udm(entry, *self._thread_ldap_connection())
+
+    async def ldap_to_udm_in_executor(self, entries: list[dict]) -> list[dict]:
+        """Transform LDAP objects to UDM objects concurrently in the worker threads, keeping their order."""
+        loop = asyncio.get_running_loop()
+        with TRANSFORMER_STAGE_SECONDS.labels("transform").time():
+            return await asyncio.gather(
+                *(loop.run_in_executor(self._executor, self._ldap_to_udm_in_thread, entry) for entry in entries)
+            )
+
+    async def transform_changes(self, new_obj, old_obj) -> tuple[dict, dict]:
+        """Transform the LDAP objects of a change to UDM objects and update the cache. Return (new, old)."""
+        new, old = (await self.transform_batch([(new_obj, old_obj)]))[0]
+        if new:
+            await self.store(new)
+        return new, old
+
+    async def transform_batch(self, changes: list[tuple[dict, dict]]) -> list[tuple[dict, dict]]:
+        """
+        Transform the LDAP objects of multiple changes to UDM objects. Return [(new, old), ..].
+
+        The new objects are transformed concurrently. The cache is not updated, the caller stores each new object
+        with `store()` once its change was published, so that a change that is redelivered after a failure is
+        transformed against the same cache state again. The old objects of later changes in the batch are
+        taken from the new objects of earlier ones.
+        A requested reload of the UDM modules is executed before the next object that is not itself a trigger of
+        reloads is transformed, so that object and the following ones are transformed with the reloaded modules.
+        """
+        async with self._transformation_lock:
+            results = []
+            transformed = {}
+            group = []
+            group_requests_reload = False
+            for new_obj, old_obj in changes:
+                object_type = self.ldap_object_type(new_obj or old_obj or {})
+                if object_type in UDM_MODULES_RELOAD_TRIGGER:
+                    group_requests_reload = True
+                elif group_requests_reload or self._udm_reload_requests:
+                    results.extend(await self._transform_group(group, transformed))
+                    self.reload_udm()
+                    group = []
+                    group_requests_reload = False
+                group.append((new_obj, old_obj))
+
+            results.extend(await self._transform_group(group, transformed))
+            return results
+
+    async def _transform_group(
+        self, changes: list[tuple[dict, dict]], transformed: dict[str, dict]
+    ) -> list[tuple[dict, dict]]:
+        """Transform a group of changes, `transformed` holds the new objects of the batch by UUID."""
+        new_objs = await self.ldap_to_udm_in_executor([new_obj for new_obj, _ in changes if new_obj])
+        new_objs.reverse()
+        results = []
+        for new_obj, old_obj in changes:
+            old = {}
+            if old_obj:
+                uuid = old_obj["entryUUID"][0].decode()
+                if uuid in transformed:
+                    old = transformed[uuid]
+                else:
+                    with TRANSFORMER_STAGE_SECONDS.labels("retrieve").time():
+                        old = await self.retrieve(uuid)
+            new = {}
+            if new_obj:
+                new = new_objs.pop() or {}
+                if new:
+                    transformed[new["uuid"]] = new
+
+            self.request_udm_reload(new or old)
+            results.append((new, old))
+        return results
+
     async def handle_changes(self, new_obj, old_obj, ts: datetime):
-        old = {}
-        if old_obj:
-            old = await self.retrieve(old_obj["entryUUID"][0].decode())
-        new = {}
-        if new_obj:
-            new = self.ldap_to_udm(new_obj)
-            if new:
-                await self.store(new)
-
-        self.reload_udm(new or old)
+        new, old = await self.transform_changes(new_obj, old_obj)
         await self.send_event(new, old, ts)
 
 
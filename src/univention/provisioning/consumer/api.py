@@ -5,16 +5,23 @@ import asyncio
 import inspect
 import logging
 import time
+from datetime import datetime, timezone
 from typing import Any, Callable, Coroutine, Optional
 
 import aiohttp
+import msgpack
 from jsondiff import diff
+from opentelemetry import propagate, trace
+from opentelemetry.trace import SpanKind
 
 from univention.provisioning.models import (
+    MSGPACK_MEDIA_TYPE,
     Event,
     Message,
     MessageProcessingStatus,
+    MessageProcessingStatusReport,
     NewSubscription,
+    PartitionLease,
     ProvisioningMessage,
     RealmTopic,
     Subscription,
@@ -29,6 +36,11 @@ from .config import (
 
 logger = logging.getLogger(__name__)
 
+# seconds before the lease of a partition expires, when it is renewed (leases are valid for 30s by default)
+LEASE_RENEWAL_THRESHOLD = 15
+# seconds to wait for the acknowledgements of handled messages, when the prefetching message handler stops
+ACKNOWLEDGEMENT_DRAIN_TIMEOUT = 10
+
 
 # TODO: the subscription part will be delegated to an admin using an admin API
 class ProvisioningConsumerClient:
@@ -54,6 +66,7 @@ class ProvisioningConsumerClient:
         password: str,
         realms_topics: list[RealmTopic],
         request_prefill: bool = False,
+        partitions: int = 1,
     ):
         logger.info("Creating subscription for %r", realms_topics)
         subscription = NewSubscription(
@@ -61,6 +74,7 @@ class ProvisioningConsumerClient:
             realms_topics=realms_topics,
             request_prefill=request_prefill,
             password=password,
+            partitions=partitions,
         )
 
         logger.debug(subscription.model_dump())
@@ -79,17 +93,72 @@ class ProvisioningConsumerClient:
         name: str,
         timeout: Optional[float] = None,
         pop: Optional[bool] = None,
+        partition: Optional[int] = None,
+        lease_id: Optional[str] = None,
     ) -> Optional[ProvisioningMessage]:
-        _params = {"timeout": timeout, "pop": pop}
+        """
+        Return the next message of the subscription, or None if no message arrived within `timeout` seconds.
+
+        The messages of a partitioned subscription are read from the `partition` leased with `lease_id`.
+
+        The message is fetched in the configured `message_format`, but the format of the response is decoded,
+        so that servers that only send JSON are supported.
+        """
+        _params = {"timeout": timeout, "pop": pop, "partition": partition, "lease_id": lease_id}
         params = {k: v for k, v in _params.items() if v is not None}
+        headers = {"Accept": MSGPACK_MEDIA_TYPE} if self.settings.message_format == "msgpack" else {}
 
-        response = await self.session.get(f"{self.settings.subscriptions_messages_url(name)}/next", params=params)
-        msg = await response.json()
+        response = await self.session.get(
+            f"{self.settings.subscriptions_messages_url(name)}/next", params=params, headers=headers
+        )
+        if response.content_type == MSGPACK_MEDIA_TYPE:
+            msg = msgpack.unpackb(await response.read())
+        else:
+            msg = await response.json()
         return ProvisioningMessage.model_validate(msg) if msg else msg
 
-    async def set_message_status(self, name: str, seq_num: int, status: MessageProcessingStatus):
+    async def lease_partition(self, name: str, lease_id: Optional[str] = None) -> PartitionLease:
+        """Lease a partition of a partitioned subscription, or renew the lease `lease_id`."""
+        params = {"lease_id": lease_id} if lease_id else {}
+        response = await self.session.post(f"{self.settings.subscriptions_url}/{name}/partitions/leases", params=params)
+        data = await response.json()
+        return PartitionLease.model_validate(data)
+
+    async def release_partition(self, name: str, lease_id: str):
+        return await self.session.delete(f"{self.settings.subscriptions_url}/{name}/partitions/leases/{lease_id}")
+
+    async def set_message_status(
+        self,
+        name: str,
+        seq_num: int,
+        status: MessageProcessingStatus,
+        ack_token: Optional[str] = None,
+        redelivery_delay: Optional[float] = None,
+    ):
+        report = MessageProcessingStatusReport(status=status, ack_token=ack_token, redelivery_delay=redelivery_delay)
         return await self.session.patch(
-            f"{self.settings.subscriptions_messages_url(name)}/{seq_num}/status", json={"status": status.value}
+            f"{self.settings.subscriptions_messages_url(name)}/{seq_num}/status",
+            json=report.model_dump(mode="json", exclude_none=True),
+        )
+
+    async def acknowledge_message(self, name: str, message: ProvisioningMessage):
+        """Report that the message was processed, it will not be delivered again."""
+        return await self.set_message_status(
+            name, message.sequence_number, MessageProcessingStatus.ok, message.ack_token
+        )
+
+    async def acknowledge_message_negatively(
+        self, name: str, message: ProvisioningMessage, redelivery_delay: Optional[float] = None
+    ):
+        """Report that the message could not be processed, it will be delivered again after `redelivery_delay`."""
+        return await self.set_message_status(
+            name, message.sequence_number, MessageProcessingStatus.failed, message.ack_token, redelivery_delay
+        )
+
+    async def acknowledge_message_in_progress(self, name: str, message: ProvisioningMessage):
+        """Report that the message is still being processed, postponing its redelivery."""
+        return await self.set_message_status(
+            name, message.sequence_number, MessageProcessingStatus.in_progress, message.ack_token
         )
 
     # TODO: move this method to the AdminClient
@@ -127,6 +196,10 @@ class MessageHandler:
                 primarily to facilitate testing.
             pop_after_handling: If False, messages are acknowledged immediately upon reception
                 rather than after all callbacks for the message have been successfully executed.
+
+        If `settings.partitioned` is set, a partition of the subscription is leased and only its messages are handled.
+        This allows running multiple instances of the consumer, while the messages about each object are still
+        handled in order. The lease is renewed before each request for a message.
         """
         if not callbacks:
             raise ValueError("Callback functions can't be empty")
@@ -136,11 +209,14 @@ class MessageHandler:
         self.callbacks = callbacks
         self.pop_after_handling = pop_after_handling
         self.message_limit = message_limit
+        self.partition_lease: Optional[PartitionLease] = None
 
-    async def acknowledge_message(self, message_seq_num: int) -> bool:
+    async def acknowledge_message(self, message_seq_num: int, ack_token: Optional[str] = None) -> bool:
         logger.debug("Acknowledging message with sequence number: %r", message_seq_num)
         try:
-            await self.client.set_message_status(self.subscription_name, message_seq_num, MessageProcessingStatus.ok)
+            await self.client.set_message_status(
+                self.subscription_name, message_seq_num, MessageProcessingStatus.ok, ack_token
+            )
             return True
         except (
             aiohttp.ClientError,
@@ -152,7 +228,7 @@ class MessageHandler:
 
     async def acknowledge_message_with_retries(self, message):
         for retries in range(self.settings.max_acknowledgement_retries + 1):
-            if await self.acknowledge_message(message.sequence_number):
+            if await self.acknowledge_message(message.sequence_number, message.ack_token):
                 logger.info("Message %r was acknowledged.", message.sequence_number)
                 return
 
@@ -166,6 +242,26 @@ class MessageHandler:
             self.settings.max_acknowledgement_retries,
         )
 
+    async def renew_partition_lease(self) -> int:
+        """Lease a partition, or renew the current lease shortly before it expires. Return the partition."""
+        lease = self.partition_lease
+        if not lease or (lease.expires - datetime.now(timezone.utc)).total_seconds() < LEASE_RENEWAL_THRESHOLD:
+            self.partition_lease = await self.client.lease_partition(
+                self.subscription_name, lease.lease_id if lease else None
+            )
+            if not lease or lease.partition != self.partition_lease.partition:
+                logger.info("Leased partition %d of the subscription.", self.partition_lease.partition)
+        return self.partition_lease.partition
+
+    async def release_partition_lease(self) -> None:
+        if not self.partition_lease:
+            return
+        try:
+            await self.client.release_partition(self.subscription_name, self.partition_lease.lease_id)
+        except aiohttp.ClientError as exc:
+            logger.warning("Failed to release the lease of partition %d. - %r", self.partition_lease.partition, exc)
+        self.partition_lease = None
+
     async def run(
         self,
     ):
@@ -174,19 +270,160 @@ class MessageHandler:
         or using `asyncio.run()`.
         It continuously listens for messages, either indefinitely or until a specified message limit is reached, and
         invokes a series of callbacks for each message.
+
+        If `settings.prefetch_count` is set, the next messages are requested while the current one is handled,
+        and messages are acknowledged in the background.
+
+        If `settings.workers` is larger than 1, messages of a partitioned subscription are handled concurrently
+        by that many workers, each of which leases its own partition. Messages about the same object (by UUID or DN)
+        are in the same partition, so they are still handled - and acknowledged - one after the other.
+        The `message_limit` applies to each worker.
         """
+        if self.settings.workers > 1:
+            await self._run_workers()
+            return
+
+        try:
+            if self.settings.prefetch_count:
+                await self._run_prefetching()
+            else:
+                await self._run()
+        finally:
+            await self.release_partition_lease()
+
+    async def _run_workers(self):
+        subscription = await self.client.get_subscription(self.subscription_name)
+        if subscription.partitions == 1:
+            logger.warning("The subscription is not partitioned, its messages are handled by a single worker.")
+            settings = self.settings.model_copy(update={"workers": 1})
+            await MessageHandler(
+                self.client, self.callbacks, settings, self.pop_after_handling, self.message_limit
+            ).run()
+            return
+
+        workers = min(self.settings.workers, subscription.partitions)
+        logger.info("Handling the messages of %d partitions with %d workers.", subscription.partitions, workers)
+        settings = self.settings.model_copy(update={"workers": 1, "partitioned": True})
+        tasks = [
+            asyncio.create_task(
+                MessageHandler(self.client, self.callbacks, settings, self.pop_after_handling, self.message_limit).run()
+            )
+            for _ in range(workers)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _run(self):
         counter = 0
 
         while True:
-            message = await self.client.get_subscription_message(
-                self.subscription_name,
-                timeout=10,
-                # TODO: pop is broken serverside at the moment
-                # pop= not pop_after_handling,
-            )
+            message = await self.get_next_message()
             if not message:
                 continue
-            logger.debug(self.debug_msg(message))
+            await self.handle_message(message)
+            if self.pop_after_handling:
+                await self.acknowledge_message_with_retries(message)
+
+            if self.message_limit:
+                counter += 1
+                if counter >= self.message_limit:
+                    return
+
+    async def _run_prefetching(self):
+        """
+        Handle messages from a bounded buffer, that is filled by a background task.
+
+        The callbacks are executed strictly in the order of the messages.
+        Acknowledgements are sent in the same order by another background task.
+        When the handler stops, because of an error or because it was cancelled, the messages that were handled
+        are still acknowledged, so that they are not delivered again.
+        """
+        buffer: asyncio.Queue[ProvisioningMessage] = asyncio.Queue(maxsize=self.settings.prefetch_count)
+        acknowledgements: asyncio.Queue[ProvisioningMessage] = asyncio.Queue()
+        prefetching = asyncio.create_task(self.prefetch_messages(buffer))
+        acknowledging = asyncio.create_task(self.acknowledge_messages(acknowledgements))
+
+        try:
+            counter = 0
+            while not self.message_limit or counter < self.message_limit:
+                message = await self.get_prefetched_message(buffer, prefetching)
+                await self.handle_message(message)
+                if self.pop_after_handling:
+                    acknowledgements.put_nowait(message)
+                counter += 1
+            await acknowledgements.join()
+        finally:
+            prefetching.cancel()
+            try:
+                await asyncio.wait_for(acknowledgements.join(), ACKNOWLEDGEMENT_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.error(
+                    "%d handled messages were not acknowledged in time, they will be redelivered later.",
+                    acknowledgements.qsize(),
+                )
+            finally:
+                acknowledging.cancel()
+
+    @staticmethod
+    async def get_prefetched_message(buffer: asyncio.Queue, prefetching: asyncio.Task) -> ProvisioningMessage:
+        """Get the next message from `buffer`, raising the exception of the `prefetching` task if it failed."""
+        getting = asyncio.ensure_future(buffer.get())
+        done, _ = await asyncio.wait({getting, prefetching}, return_when=asyncio.FIRST_COMPLETED)
+        if getting in done:
+            return getting.result()
+        getting.cancel()
+        prefetching.result()
+        return await buffer.get()
+
+    async def prefetch_messages(self, buffer: asyncio.Queue):
+        counter = 0
+        while not self.message_limit or counter < self.message_limit:
+            if message := await self.get_next_message():
+                await buffer.put(message)
+                counter += 1
+
+    async def acknowledge_messages(self, acknowledgements: asyncio.Queue):
+        while True:
+            message = await acknowledgements.get()
+            try:
+                await self.acknowledge_message_with_retries(message)
+            finally:
+                acknowledgements.task_done()
+
+    async def get_next_message(self) -> Optional[ProvisioningMessage]:
+        """Request the next message, from the leased partition if `settings.partitioned` is set."""
+        kwargs = {}
+        if self.settings.partitioned:
+            try:
+                kwargs["partition"] = await self.renew_partition_lease()
+                kwargs["lease_id"] = self.partition_lease.lease_id
+            except aiohttp.ClientResponseError as exc:
+                if exc.status != 409:
+                    raise
+                logger.info("All partitions of the subscription are leased. Waiting for one to be released.")
+                self.partition_lease = None
+                await asyncio.sleep(LEASE_RENEWAL_THRESHOLD)
+                return None
+        return await self.client.get_subscription_message(
+            self.subscription_name,
+            timeout=10,
+            # TODO: pop is broken serverside at the moment
+            # pop= not pop_after_handling,
+            **kwargs,
+        )
+
+    async def handle_message(self, message: ProvisioningMessage):
+        """Run the callbacks in a span that continues the trace of the message, if the application records traces."""
+        logger.debug(self.debug_msg(message))
+        with trace.get_tracer(__name__).start_as_current_span(
+            f"handle {message.realm}:{message.topic}",
+            context=propagate.extract(message.trace_context or {}),
+            kind=SpanKind.CONSUMER,
+            attributes={"provisioning.subscription": self.subscription_name},
+        ):
             for callback in self.callbacks:
                 t0 = time.perf_counter()
                 await callback(message)
@@ -195,13 +432,6 @@ class MessageHandler:
                     getattr(inspect.getmodule(callback).__spec__, "name", "__main__"),
                     (time.perf_counter() - t0) * 1000,
                 )
-            if self.pop_after_handling:
-                await self.acknowledge_message_with_retries(message)
-
-            if self.message_limit:
-                counter += 1
-                if counter >= self.message_limit:
-                    return
 
     @staticmethod
     def debug_msg(message: Message) -> str:
@@ -9,6 +9,7 @@ from pydantic import conint
 from pydantic_settings import BaseSettings
 
 Loglevel = Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+MessageFormat = Literal["json", "msgpack"]
 
 
 class ProvisioningConsumerClientSettings(BaseSettings):
@@ -16,6 +17,8 @@ class ProvisioningConsumerClientSettings(BaseSettings):
     provisioning_api_username: str
     provisioning_api_password: str
     log_level: Loglevel
+    # Format in which messages are fetched: json or msgpack (smaller and faster to decode for large objects)
+    message_format: MessageFormat = "json"
 
     @cached_property
     def subscriptions_url(self) -> str:
@@ -31,6 +34,12 @@ class ProvisioningConsumerClientSettings(BaseSettings):
 
 class MessageHandlerSettings(BaseSettings):
     max_acknowledgement_retries: conint(ge=0, le=10)
+    # Lease a partition of the (partitioned) subscription and consume only its messages
+    partitioned: bool = False
+    # Number of messages to request ahead while handling the current one (0 disables prefetching)
+    prefetch_count: conint(ge=0, le=100) = 0
+    # Number of partitions of the (partitioned) subscription that are handled concurrently
+    workers: conint(ge=1, le=64) = 1
 
 
 @lru_cache(maxsize=1)
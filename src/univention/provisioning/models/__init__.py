@@ -2,12 +2,14 @@
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 
 from .api import (  # noqa: F401
+    MSGPACK_MEDIA_TYPE,
     Event,
     MessageProcessingStatus,
     MessageProcessingStatusReport,
     NewSubscription,
 )
 from .queue import (  # noqa: F401
+    DISPATCHER_PARTITION_SUBJECT_TEMPLATE,
     DISPATCHER_STREAM,
     DISPATCHER_SUBJECT_TEMPLATE,
     PREFILL_STREAM,
@@ -21,11 +23,14 @@ from .queue import (  # noqa: F401
     PrefillMessage,
     ProvisioningMessage,
     PublisherName,
+    message_id,
 )
 from .subscription import (  # noqa: F401
     Bucket,
     FillQueueStatus,
     FillQueueStatusReport,
+    PartitionLease,
     RealmTopic,
     Subscription,
+    SubscriptionStats,
 )
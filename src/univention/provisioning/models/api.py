@@ -2,12 +2,15 @@
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 
 import enum
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 
 from .subscription import BaseSubscription
 
+# Media type of messages delivered in the MessagePack format instead of JSON
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
 
 class NewSubscription(BaseSubscription):
     """Request to register a subscription."""
@@ -31,9 +34,27 @@ class Event(BaseModel):
 class MessageProcessingStatus(str, enum.Enum):
     # The message was processed successfully.
     ok = "ok"
+    # The message could not be processed and should be delivered again.
+    failed = "failed"
+    # The message is still being processed, the deadline for reporting its status is extended.
+    in_progress = "in_progress"
 
 
 class MessageProcessingStatusReport(BaseModel):
     """A subscriber reporting whether a message was processed."""
 
     status: MessageProcessingStatus = Field(description="Whether the message was processed by the subscriber.")
+    ack_token: Optional[str] = Field(
+        None,
+        description="The `ack_token` of the message. "
+        "Required for all status values but `ok`, which deletes the message when the token is missing.",
+    )
+    redelivery_delay: Optional[float] = Field(
+        None, ge=0, description="Seconds to wait before delivering a `failed` message again."
+    )
+
+    @model_validator(mode="after")
+    def check_ack_token(self) -> "MessageProcessingStatusReport":
+        if self.status != MessageProcessingStatus.ok and not self.ack_token:
+            raise ValueError(f"The status {self.status.value!r} requires an 'ack_token'.")
+        return self
@@ -1,6 +1,7 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 
+import hashlib
 from datetime import datetime
 from enum import Enum
 from typing import Any, ClassVar, Dict, List, Optional
@@ -13,6 +14,7 @@ from .subscription import RealmTopic
 PREFILL_SUBJECT_TEMPLATE = "{subscription}.prefill"
 PREFILL_STREAM = "prefill"
 DISPATCHER_SUBJECT_TEMPLATE = "{subscription}.main"
+DISPATCHER_PARTITION_SUBJECT_TEMPLATE = "{subscription}.main.{partition}"
 DISPATCHER_STREAM = "incoming"
 LDIF_STREAM = "ldif-producer"
 LDIF_SUBJECT = "ldif-producer-subject"
@@ -29,6 +31,18 @@ class PublisherName(str, Enum):
     consumer_client_test = "consumer_client_test"
 
 
+def message_id(publisher_name: PublisherName, *keys: str) -> str:
+    """Deterministic ID of a message, derived from the identity of its change, to discard duplicates (`Nats-Msg-Id`)."""
+    digest = hashlib.sha256("\0".join(keys).encode("utf-8")).hexdigest()
+    return f"{publisher_name.value}:{digest}"
+
+
+def _first_ldap_value(entry: Dict[str, Any], attribute: str) -> str:
+    values = entry.get(attribute) or [b""]
+    value = values[0] if isinstance(values, list) else values
+    return value.decode("utf-8") if isinstance(value, bytes) else str(value)
+
+
 class BaseMessage(BaseModel):
     """The common header properties of each message."""
 
@@ -51,6 +65,27 @@ class Body(BaseModel):
     def set_empty_dict(cls, v: Optional[Dict[str, Any]]) -> Dict[str, Any]:
         return v or {}
 
+    @property
+    def object_key(self) -> Optional[str]:
+        """Identity of the changed object: its UUID, which is stable across moves, or else its DN."""
+        for key in ("uuid", "dn"):
+            if value := self.new.get(key) or self.old.get(key):
+                return value
+        return None
+
+    @property
+    def ldap_change_keys(self) -> Optional[tuple[str, str, str]]:
+        """
+        Identity of a change of LDAP objects: the entryUUID and the entryCSNs after and before the change.
+        None if the LDAP objects have no entryUUID or entryCSN.
+        """
+        uuid = _first_ldap_value(self.new or self.old, "entryUUID")
+        new_csn = _first_ldap_value(self.new, "entryCSN")
+        old_csn = _first_ldap_value(self.old, "entryCSN")
+        if not uuid or not (new_csn or old_csn):
+            return None
+        return uuid, new_csn, old_csn
+
 
 class LDIFProducerBody(Body):
     ldap_request_type: Literal["ADD", "MODIFY", "MODRDN", "DELETE"] = Field(description="The LDAP operation.")
@@ -121,7 +156,19 @@ class MQMessage(BaseModel):
     sequence_number: int
     headers: Optional[Dict[str, str]] = None
 
+    @property
+    def msg_id(self) -> Optional[str]:
+        """ID of the message, by which duplicates are discarded (`Nats-Msg-Id` header)."""
+        return (self.headers or {}).get("Nats-Msg-Id")
+
 
 class ProvisioningMessage(Message):
     sequence_number: int = Field(description="The sequence number associated with the message.")
     num_delivered: int = Field(description="The number of times that this message has been delivered.")
+    ack_token: Optional[str] = Field(
+        None, description="Opaque token that must be sent back when reporting the processing status of the message."
+    )
+    trace_context: Optional[Dict[str, str]] = Field(
+        None,
+        description="W3C trace context (`traceparent` and `tracestate`) of the message, for distributed tracing.",
+    )
@@ -2,7 +2,8 @@
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 
 import enum
-from typing import List
+from datetime import datetime
+from typing import List, Optional
 
 from pydantic import BaseModel, Field
 
@@ -40,6 +41,13 @@ class BaseSubscription(BaseModel):
         'e.g. [{"realm": "udm", "topic": "users/user"}].'
     )
     request_prefill: bool = Field(description="Whether pre-filling of the queue was requested.")
+    partitions: int = Field(
+        1,
+        ge=1,
+        le=64,
+        description="Number of ordered partitions the messages are distributed to, by the identity of their object. "
+        "Each partition can be consumed by a different client instance.",
+    )
 
     def __eq__(self, other: "BaseSubscription") -> bool:
         if not super().__eq__(other):
@@ -65,7 +73,32 @@ class Subscription(BaseSubscription):
         return hash(self.name)
 
 
+class PartitionLease(BaseModel):
+    """The exclusive right of a client instance to consume one partition of a subscription."""
+
+    partition: int = Field(description="The leased partition.")
+    lease_id: str = Field(description="Identifier of the lease, used to renew and release it.")
+    expires: datetime = Field(description="When the lease expires unless it is renewed.")
+
+
+class SubscriptionStats(BaseModel):
+    """The backlog of a subscription's queue and how far its consumers lag behind."""
+
+    name: str = Field(description="The identifier of the subscription.")
+    pending_messages: int = Field(description="Number of messages that were not yet delivered.")
+    unacknowledged_messages: int = Field(description="Number of delivered messages that were not yet acknowledged.")
+    prefill_backlog: int = Field(description="Number of messages from the pre-fill in the queue.")
+    main_backlog: int = Field(description="Number of messages from LDAP changes in the queue.")
+    oldest_message_age: Optional[float] = Field(
+        description="Seconds since the oldest message in the queue was stored, null if the queue is empty."
+    )
+    delivery_rate: Optional[float] = Field(
+        description="Messages delivered per second since the previous statistics, null for the first statistics."
+    )
+
+
 class Bucket(str, enum.Enum):
     subscriptions = "SUBSCRIPTIONS"
     credentials = "CREDENTIALS"
     cache = "CACHE"
+    partition_leases = "PARTITION_LEASES"
@@ -0,0 +1,376 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# SPDX-FileCopyrightText: 2024 Univention GmbH
+
+"""
+Throughput benchmark of the provisioning pipeline against a local NATS server.
+
+Starts `nats-server` with JetStream in a temporary directory and runs the REST API (in-process with uvicorn),
+the dispatcher and consumer clients in this process. Synthetic `users/user` events pass three stages,
+one after another, so the CPU time of this process can be attributed to each stage:
+
+- publish: the events are sent to the Events API.
+- dispatch: the dispatcher stores the events in the streams of all subscriptions.
+- consume: one consumer client per subscription fetches and acknowledges the events.
+
+For each stage, messages/sec, p50/p99 latency, the CPU seconds of this process and of the NATS server are reported.
+The results can be saved and compared to a previous run:
+
+    PYTHONPATH=src python -m tests.benchmark.pipeline --messages 1000 --subscribers 1 4 --payload-sizes 1024 65536 \\
+        --output results.json --compare baseline.json
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import AsyncIterator, Optional
+
+import aiohttp
+import nats
+import uvicorn
+
+from .results import compare_results, latency_stats, load_results, save_results
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+NATS_USER = "bench"
+NATS_PASSWORD = "benchpass"
+ADMIN_USERNAME = "admin"
+ADMIN_PASSWORD = "provisioning"
+EVENTS_USERNAME = "udm"
+EVENTS_PASSWORD = "udmpass"
+SUBSCRIBER_PASSWORD = "subscriberpass"
+TOPIC = "users/user"
+
+NATS_CONFIG = """
+port: {port}
+jetstream {{
+  store_dir: "{store_dir}"
+}}
+authorization {{
+  user: "{user}"
+  password: "{password}"
+}}
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def configure_environment(nats_port: int, api_port: int):
+    """Configure the API, the dispatcher and the consumer client through the environment, before they are imported."""
+    os.environ.update(
+        {
+            "log_level": "WARNING",
+            "debug": "false",
+            "root_path": "",
+            "cors_all": "false",
+            "admin_username": ADMIN_USERNAME,
+            "admin_password": ADMIN_PASSWORD,
+            "nats_user": NATS_USER,
+            "nats_password": NATS_PASSWORD,
+            "nats_host": "127.0.0.1",
+            "nats_port": str(nats_port),
+            "nats_max_reconnect_attempts": "2",
+            "admin_nats_user": NATS_USER,
+            "admin_nats_password": NATS_PASSWORD,
+            "prefill_username": "prefill",
+            "prefill_password": "prefillpass",
+            "events_username_udm": EVENTS_USERNAME,
+            "events_password_udm": EVENTS_PASSWORD,
+            "provisioning_api_base_url": f"http://127.0.0.1:{api_port}",
+            "provisioning_api_username": ADMIN_USERNAME,
+            "provisioning_api_password": ADMIN_PASSWORD,
+            "max_acknowledgement_retries": "3",
+        }
+    )
+
+
+@asynccontextmanager
+async def nats_server(binary: str, port: int) -> AsyncIterator[subprocess.Popen]:
+    with tempfile.TemporaryDirectory(prefix="provisioning-benchmark-") as tmp_dir:
+        config = os.path.join(tmp_dir, "nats.conf")
+        with open(config, "w") as fd:
+            fd.write(
+                NATS_CONFIG.format(
+                    port=port, store_dir=os.path.join(tmp_dir, "jetstream"), user=NATS_USER, password=NATS_PASSWORD
+                )
+            )
+        process = subprocess.Popen([binary, "-c", config], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            for _ in range(50):
+                try:
+                    _, writer = await asyncio.open_connection("127.0.0.1", port)
+                except OSError:
+                    await asyncio.sleep(0.1)
+                    continue
+                writer.close()
+                break
+            else:
+                raise RuntimeError("nats-server did not start")
+            yield process
+        finally:
+            process.terminate()
+            process.wait()
+
+
+@asynccontextmanager
+async def api_server(port: int) -> AsyncIterator[None]:
+    from server.core.app.main import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.05)
+    try:
+        yield
+    finally:
+        server.should_exit = True
+        await task
+
+
+def synthetic_event(index: int, payload_size: int) -> dict:
+    """Return a `users/user` event whose JSON body has about `payload_size` bytes."""
+    new = {
+        "dn": f"uid=bench{index},cn=users,dc=example,dc=org",
+        "objectType": TOPIC,
+        "uuid": str(uuid.UUID(int=index)),
+        "properties": {"username": f"bench{index}", "description": ""},
+        "sent": 0.0,
+    }
+    padding = max(0, payload_size - len(str(new)))
+    new["properties"]["description"] = "x" * padding
+    return {
+        "publisher_name": "udm-listener",
+        "ts": datetime.now().isoformat(),
+        "realm": "udm",
+        "topic": TOPIC,
+        "body": {"old": {}, "new": new},
+    }
+
+
+class CPUTimer:
+    """Measures the CPU seconds of this process and of the NATS server."""
+
+    def __init__(self, nats_pid: int):
+        self._nats_process = psutil.Process(nats_pid) if psutil else None
+
+    def _nats_cpu(self) -> Optional[float]:
+        if not self._nats_process:
+            return None
+        times = self._nats_process.cpu_times()
+        return times.user + times.system
+
+    def __enter__(self):
+        self._start = time.process_time()
+        self._nats_start = self._nats_cpu()
+        return self
+
+    def __exit__(self, *args):
+        self.cpu_seconds = time.process_time() - self._start
+        nats_end = self._nats_cpu()
+        self.nats_cpu_seconds = nats_end - self._nats_start if nats_end is not None else None
+
+
+def stage_result(count: int, duration: float, latencies: list[float], cpu: CPUTimer) -> dict[str, float]:
+    result = {
+        "messages_per_second": count / duration,
+        **latency_stats(latencies),
+        "cpu_seconds": cpu.cpu_seconds,
+    }
+    if cpu.nats_cpu_seconds is not None:
+        result["nats_cpu_seconds"] = cpu.nats_cpu_seconds
+    return result
+
+
+async def stream_messages(js, stream: str) -> int:
+    from server.adapters.nats_adapter import NatsKeys
+
+    return (await js.stream_info(NatsKeys.stream(stream))).state.messages
+
+
+async def publish_stage(api_url: str, events: list[dict]) -> tuple[float, list[float]]:
+    latencies = []
+    auth = aiohttp.BasicAuth(EVENTS_USERNAME, EVENTS_PASSWORD)
+    async with aiohttp.ClientSession(auth=auth, raise_for_status=True) as session:
+        start = time.perf_counter()
+        for event in events:
+            tic = time.perf_counter()
+            event["body"]["new"]["sent"] = time.time()
+            async with session.post(f"{api_url}/v1/messages", json=event):
+                pass
+            latencies.append(time.perf_counter() - tic)
+    return time.perf_counter() - start, latencies
+
+
+async def dispatch_stage(js, subscriptions: list[str], count: int) -> tuple[float, list[float]]:
+    from server.core.dispatcher.port import DispatcherPort
+    from server.core.dispatcher.service.dispatcher import DispatcherService
+    from univention.provisioning.models import DISPATCHER_STREAM, MQMessage
+
+    latencies = []
+
+    class TimedDispatcherService(DispatcherService):
+        async def handle_message(self, message: MQMessage):
+            tic = time.perf_counter()
+            await super().handle_message(message)
+            latencies.append(time.perf_counter() - tic)
+
+    async def run_dispatcher():
+        async with DispatcherPort.port_context() as port:
+            await TimedDispatcherService(port).dispatch_events()
+
+    start = time.perf_counter()
+    task = asyncio.create_task(run_dispatcher())
+    try:
+        while True:
+            if task.done():
+                task.result()
+            counts = [await stream_messages(js, name) for name in subscriptions]
+            if all(c >= count for c in counts) and not await stream_messages(js, DISPATCHER_STREAM):
+                break
+            await asyncio.sleep(0.01)
+        duration = time.perf_counter() - start
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    return duration, latencies
+
+
+async def consume_stage(subscriptions: list[str], count: int) -> tuple[float, list[float], list[float]]:
+    from univention.provisioning.consumer import ProvisioningConsumerClient, ProvisioningConsumerClientSettings
+
+    latencies = []
+    ages = []
+    settings = ProvisioningConsumerClientSettings()
+
+    async def consume(name: str):
+        subscriber_settings = settings.model_copy(
+            update={"provisioning_api_username": name, "provisioning_api_password": SUBSCRIBER_PASSWORD}
+        )
+        async with ProvisioningConsumerClient(subscriber_settings) as client:
+            for _ in range(count):
+                tic = time.perf_counter()
+                message = await client.get_subscription_message(name, timeout=10)
+                if not message:
+                    raise RuntimeError(f"Subscription {name!r} did not receive all messages")
+                await client.acknowledge_message(name, message)
+                latencies.append(time.perf_counter() - tic)
+                ages.append(time.time() - message.body.new["sent"])
+
+    start = time.perf_counter()
+    await asyncio.gather(*(consume(name) for name in subscriptions))
+    return time.perf_counter() - start, latencies, ages
+
+
+async def benchmark_run(
+    api_url: str, js, nats_pid: int, messages: int, subscribers: int, payload_size: int
+) -> dict[str, dict[str, float]]:
+    from univention.provisioning.consumer import ProvisioningConsumerClient
+    from univention.provisioning.models import RealmTopic
+
+    run = f"subscribers={subscribers} payload={payload_size}"
+    subscriptions = [f"bench-{uuid.uuid4()}" for _ in range(subscribers)]
+    events = [synthetic_event(i, payload_size) for i in range(messages)]
+    results = {}
+
+    async with ProvisioningConsumerClient() as admin_client:
+        for name in subscriptions:
+            await admin_client.create_subscription(
+                name, SUBSCRIBER_PASSWORD, [RealmTopic(realm="udm", topic=TOPIC)], request_prefill=False
+            )
+        try:
+            with CPUTimer(nats_pid) as cpu:
+                duration, latencies = await publish_stage(api_url, events)
+            results[f"{run} publish"] = stage_result(messages, duration, latencies, cpu)
+
+            with CPUTimer(nats_pid) as cpu:
+                duration, latencies = await dispatch_stage(js, subscriptions, messages)
+            results[f"{run} dispatch"] = stage_result(messages, duration, latencies, cpu)
+
+            with CPUTimer(nats_pid) as cpu:
+                duration, latencies, ages = await consume_stage(subscriptions, messages)
+            results[f"{run} consume"] = stage_result(messages * subscribers, duration, latencies, cpu)
+            # Age of the messages when they were received, which includes the time spent waiting in the streams
+            results[f"{run} consume"].update({f"age_{k}": v for k, v in latency_stats(ages).items()})
+        finally:
+            for name in subscriptions:
+                await admin_client.cancel_subscription(name)
+
+    for stage, metrics in results.items():
+        print(f"{stage:<40} " + " ".join(f"{k}={v:.2f}" for k, v in metrics.items()))
+    return results
+
+
+async def main(args: argparse.Namespace) -> int:
+    nats_port = free_port()
+    api_port = free_port()
+    configure_environment(nats_port, api_port)
+    api_url = f"http://127.0.0.1:{api_port}"
+
+    results = {}
+    async with nats_server(args.nats_server, nats_port) as nats_process, api_server(api_port):
+        nc = await nats.connect(f"nats://127.0.0.1:{nats_port}", user=NATS_USER, password=NATS_PASSWORD)
+        try:
+            for subscribers in args.subscribers:
+                for payload_size in args.payload_sizes:
+                    results.update(
+                        await benchmark_run(
+                            api_url, nc.jetstream(), nats_process.pid, args.messages, subscribers, payload_size
+                        )
+                    )
+        finally:
+            await nc.close()
+
+    if args.output:
+        save_results(
+            args.output,
+            "pipeline",
+            {"messages": args.messages, "subscribers": args.subscribers, "payload_sizes": args.payload_sizes},
+            results,
+        )
+    if args.compare:
+        regressions = compare_results(results, load_results(args.compare), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} metric(s) regressed by more than {args.threshold:.0%}.")
+            return 1
+    return 0
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1000, help="number of events per run")
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[1], help="numbers of subscriptions to test")
+    parser.add_argument("--payload-sizes", type=int, nargs="+", default=[1024], help="sizes of the events in bytes")
+    parser.add_argument("--nats-server", default=shutil.which("nats-server"), help="path of the nats-server binary")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="compare the results to those in this JSON file")
+    parser.add_argument(
+        "--threshold", type=float, default=0.1, help="relative change that is reported as regression (default: 0.1)"
+    )
+    args = parser.parse_args(argv)
+    if not args.nats_server:
+        parser.error("nats-server was not found, use --nats-server")
+    return args
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(asyncio.run(main(parse_args())))
@@ -0,0 +1,78 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# SPDX-FileCopyrightText: 2024 Univention GmbH
+
+"""Storage and comparison of benchmark results."""
+
+import json
+import platform
+import statistics
+from datetime import datetime
+from typing import Any, Optional
+
+# Metrics for which a higher value is better, all others are better when lower
+HIGHER_IS_BETTER = {"messages_per_second", "operations_per_second"}
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """Return the `percent` percentile of `values`, interpolating between the two closest values."""
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[int(percent) - 1]
+
+
+def latency_stats(durations: list[float]) -> dict[str, float]:
+    """Return the p50 and p99 of `durations` (in seconds) in milliseconds."""
+    return {
+        "p50_ms": percentile(durations, 50) * 1000,
+        "p99_ms": percentile(durations, 99) * 1000,
+    }
+
+
+def save_results(path: str, benchmark: str, parameters: dict[str, Any], results: dict[str, dict[str, float]]):
+    """
+    Save `results` to `path` as JSON.
+
+    `results` maps the name of a measurement (e.g. a stage of a run) to its metrics.
+    """
+    with open(path, "w") as fd:
+        json.dump(
+            {
+                "benchmark": benchmark,
+                "date": datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "parameters": parameters,
+                "results": results,
+            },
+            fd,
+            indent=2,
+        )
+
+
+def load_results(path: str) -> dict[str, dict[str, float]]:
+    with open(path) as fd:
+        return json.load(fd)["results"]
+
+
+def compare_results(
+    results: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]], threshold: float
+) -> list[str]:
+    """
+    Print the relative change of all metrics in `results` to those in `baseline`.
+
+    Returns the metrics that got worse by more than `threshold` (e.g. 0.1 for 10%).
+    """
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            base: Optional[float] = baseline.get(name, {}).get(metric)
+            if not base:
+                continue
+            change = (value - base) / base
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            marker = ""
+            if worse > threshold:
+                marker = "  REGRESSION"
+                regressions.append(f"{name} {metric}")
+            print(f"{name:<48} {metric:<22} {base:>12.3f} -> {value:>12.3f} ({change:+.1%}){marker}")
+    return regressions
@@ -0,0 +1,145 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# SPDX-FileCopyrightText: 2024 Univention GmbH
+
+"""
+Microbenchmarks of the serialization and validation of messages.
+
+Measures the encoders and decoders of the NATS adapter, the validation and serialization of the message models
+and the decoding of messages fetched from NATS, for `users/user` and `groups/group` bodies.
+The group is benchmarked with growing numbers of members:
+
+    PYTHONPATH=src python -m tests.benchmark.serialization --members 10 1000 10000 --output results.json \\
+        --compare baseline.json
+"""
+
+import argparse
+import json
+import sys
+import timeit
+from copy import deepcopy
+from datetime import datetime
+from typing import Any, Callable, Optional
+
+from nats.aio.msg import Msg
+
+from server.adapters.nats_adapter import (
+    NatsMQAdapter,
+    json_decoder,
+    json_encoder,
+    messagepack_decoder,
+    messagepack_encoder,
+)
+from udm_transformer.port import cache_entry_decoder, cache_entry_encoder
+from univention.provisioning.models import Message, ProvisioningMessage, PublisherName
+
+from ..mock_data import GROUP_OBJECT, MSG, USER_OBJECT
+from .results import compare_results, load_results, save_results
+
+
+def group_object(members: int) -> dict:
+    group = deepcopy(GROUP_OBJECT)
+    group["properties"]["users"] = [
+        f"uid=user{i},cn=users,dc=univention-organization,dc=intranet" for i in range(members)
+    ]
+    return group
+
+
+def message(obj: dict) -> Message:
+    return Message(
+        publisher_name=PublisherName.udm_listener,
+        ts=datetime(2024, 1, 1),
+        realm="udm",
+        topic=obj["objectType"],
+        body={"old": obj, "new": obj},
+    )
+
+
+def benchmarks(obj: dict) -> dict[str, Callable[[], Any]]:
+    """Return the operations to measure on a message about `obj`."""
+    msg = message(obj)
+    data = msg.model_dump()
+    json_data = json_encoder(data)
+    msgpack_data = messagepack_encoder(data)
+    cache_data = cache_entry_encoder(obj)
+    nats_msg = Msg(_client="nats", subject=MSG.subject, reply=MSG.reply, data=json_data, _metadata=MSG._metadata)
+
+    return {
+        "json_encoder": lambda: json_encoder(data),
+        "json_decoder": lambda: json_decoder(json_data),
+        "messagepack_encoder": lambda: messagepack_encoder(data),
+        "messagepack_decoder": lambda: messagepack_decoder(msgpack_data),
+        "cache_entry_encoder": lambda: cache_entry_encoder(obj),
+        "cache_entry_decoder": lambda: cache_entry_decoder(cache_data),
+        "Message.model_validate": lambda: Message.model_validate(data),
+        "Message.model_dump": msg.model_dump,
+        "Message.model_dump_json": msg.model_dump_json,
+        "ProvisioningMessage.model_validate": lambda: ProvisioningMessage.model_validate(
+            {**data, "sequence_number": 1, "num_delivered": 1}
+        ),
+        "provisioning_message_from": lambda: NatsMQAdapter.provisioning_message_from(nats_msg),
+        "provisioning_message_json_from": lambda: NatsMQAdapter.provisioning_message_json_from(nats_msg, None),
+        # MessagePack responses: the stored payload is JSON, so building them costs one JSON decode,
+        # compared to decoding the spliced JSON response or validating and dumping the message model
+        "provisioning_message_msgpack_from": lambda: NatsMQAdapter.provisioning_message_msgpack_from(nats_msg, None),
+        "msgpack from provisioning_message_json_from": lambda: messagepack_encoder(
+            json_decoder(NatsMQAdapter.provisioning_message_json_from(nats_msg, None))
+        ),
+        "msgpack from provisioning_message_from": lambda: messagepack_encoder(
+            NatsMQAdapter.provisioning_message_from(nats_msg).model_dump(mode="json")
+        ),
+        "mq_message_from": lambda: NatsMQAdapter.mq_message_from(nats_msg),
+    }
+
+
+def measure(operation: Callable[[], Any], repeat: int) -> dict[str, float]:
+    """Return the operations per second of the best of `repeat` runs."""
+    timer = timeit.Timer(operation)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+    return {"operations_per_second": 1 / best, "us_per_operation": best * 1_000_000}
+
+
+def main(args: argparse.Namespace) -> int:
+    objects = {"users/user": USER_OBJECT}
+    objects.update({f"groups/group members={members}": group_object(members) for members in args.members})
+
+    results = {}
+    for name, obj in objects.items():
+        size = len(json.dumps(obj))
+        for operation, function in benchmarks(obj).items():
+            if args.filter and args.filter not in operation:
+                continue
+            key = f"{name} {operation}"
+            results[key] = measure(function, args.repeat)
+            print(
+                f"{key:<64} {results[key]['operations_per_second']:>12.1f} ops/s "
+                f"{results[key]['us_per_operation']:>12.1f} us/op  (object: {size} bytes)"
+            )
+
+    if args.output:
+        save_results(args.output, "serialization", {"members": args.members, "repeat": args.repeat}, results)
+    if args.compare:
+        regressions = compare_results(results, load_results(args.compare), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} metric(s) regressed by more than {args.threshold:.0%}.")
+            return 1
+    return 0
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--members", type=int, nargs="+", default=[10, 1000, 10000], help="numbers of members of the group"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed runs, the best is reported")
+    parser.add_argument("--filter", help="only run the operations containing this string")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="compare the results to those in this JSON file")
+    parser.add_argument(
+        "--threshold", type=float, default=0.1, help="relative change that is reported as regression (default: 0.1)"
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
@@ -3,7 +3,12 @@
 
 
 import pytest
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
 
+from server.adapters.nats_adapter import NatsMQAdapter
 from server.core.app.main import app
 from server.services.port import Port
 
@@ -37,3 +42,20 @@ def override_dependencies():
     yield  # This will ensure the setup is done before tests and cleanup after
     # Clear the overrides after the tests
     app.dependency_overrides.clear()
+
+
+@pytest.fixture(autouse=True)
+def forget_ensured_streams():
+    """Every test starts without streams and consumers that are known to be ensured."""
+    NatsMQAdapter._ensured_streams.clear()
+    NatsMQAdapter._ensured_consumers.clear()
+
+
+@pytest.fixture
+def span_exporter(monkeypatch) -> InMemorySpanExporter:
+    """Record the spans of the test, they are returned by `span_exporter.get_finished_spans()`."""
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    monkeypatch.setattr(trace, "get_tracer_provider", lambda: provider)
+    return exporter
@@ -5,7 +5,7 @@ import aiohttp
 import pytest
 
 from univention.admin.rest.client import UDM, UnprocessableEntity
-from univention.provisioning.consumer import ProvisioningConsumerClient
+from univention.provisioning.consumer import ProvisioningConsumerClient, ProvisioningConsumerClientSettings
 
 from .conftest import E2ETestSettings
 from .helpers import (
@@ -45,6 +45,20 @@ async def test_send_message(
     assert response.body == data
 
 
+async def test_send_message_in_msgpack(
+    client_settings: ProvisioningConsumerClientSettings,
+    dummy_subscription: str,
+    test_settings: E2ETestSettings,
+):
+    data = create_message_via_events_api(test_settings)
+
+    settings = client_settings.model_copy(update={"message_format": "msgpack"})
+    async with ProvisioningConsumerClient(settings) as client:
+        response = await client.get_subscription_message(name=dummy_subscription, timeout=10)
+
+    assert response.body == data
+
+
 @pytest.mark.xfail()
 async def test_pop_message(provisioning_client: ProvisioningConsumerClient, dummy_subscription: str):
     response = await provisioning_client.get_subscription_message(name=dummy_subscription, timeout=1, pop=True)
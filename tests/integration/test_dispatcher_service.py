@@ -16,14 +16,14 @@ from ..mocks import MockNatsKVAdapter, MockNatsMQAdapter
 
 
 @pytest.fixture
-async def dispatcher_mock() -> DispatcherPort:
+async def dispatcher_mock(monkeypatch) -> DispatcherPort:
     port = DispatcherPort(DispatcherSettings(nats_user="dispatcher", nats_password="dispatcherpass"))
     port.mq_adapter = MockNatsMQAdapter()
     port.kv_adapter = MockNatsKVAdapter()
     port.mq_adapter._message_queue.get = AsyncMock(side_effect=[MSG, Exception("Stop waiting for the new event")])
     port.watch_for_subscription_changes = AsyncMock()
-    Msg.in_progress = AsyncMock()
-    Msg.ack = AsyncMock()
+    monkeypatch.setattr(Msg, "in_progress", AsyncMock())
+    monkeypatch.setattr(Msg, "ack", AsyncMock())
 
     return port
 
@@ -69,4 +69,5 @@ class TestDispatcher:
             self.main_subject,
             FLAT_MESSAGE_ENCODED,
             stream=f"stream:{SUBSCRIPTION_NAME}",
+            headers=None,
         )
@@ -1,11 +1,13 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 
+from unittest.mock import ANY, patch
 
 import httpx
 import pytest
 
 from server.core.app.config import app_settings
+from server.services.messages import MessageService
 
 from ..mock_data import FLAT_MESSAGE
 
@@ -21,3 +23,15 @@ class TestInternalApi:
             auth=(self.settings.events_username_udm, self.settings.events_password_udm),
         )
         assert response.status_code == 202
+
+    async def test_add_event_with_idempotency_key(self, client: httpx.AsyncClient):
+        with patch.object(MessageService, "add_live_event") as add_live_event:
+            response = await client.post(
+                "/v1/messages",
+                json=FLAT_MESSAGE,
+                headers={"Idempotency-Key": "ldif-producer:42"},
+                auth=(self.settings.events_username_udm, self.settings.events_password_udm),
+            )
+
+        assert response.status_code == 202
+        add_live_event.assert_called_once_with(ANY, "ldif-producer:42")
@@ -0,0 +1,16 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# SPDX-FileCopyrightText: 2024 Univention GmbH
+
+import httpx
+import pytest
+from prometheus_client import CONTENT_TYPE_LATEST
+
+
+@pytest.mark.anyio
+async def test_metrics(client: httpx.AsyncClient):
+    response = await client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == CONTENT_TYPE_LATEST
+    assert "provisioning_nats_operation_seconds" in response.text
+    assert "provisioning_bcrypt_seconds" in response.text
@@ -0,0 +1,35 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# SPDX-FileCopyrightText: 2024 Univention GmbH
+
+import httpx
+import pytest
+
+from server.core.app.config import app_settings
+from server.services.subscriptions import SubscriptionService
+
+from ..mock_data import SUBSCRIPTION_NAME
+
+
+@pytest.mark.anyio
+class TestStatsRoute:
+    settings = app_settings()
+    stats_url = "/v1/stats/subscriptions"
+
+    async def test_get_subscriptions_stats(self, client: httpx.AsyncClient):
+        SubscriptionService._stats_cache.clear()
+
+        response = await client.get(self.stats_url, auth=(self.settings.admin_username, self.settings.admin_password))
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data[0]["name"] == SUBSCRIPTION_NAME
+        assert data[0]["pending_messages"] == 0
+        assert data[0]["unacknowledged_messages"] == 1
+        assert data[0]["main_backlog"] == 1
+        assert data[0]["prefill_backlog"] == 0
+        assert data[0]["oldest_message_age"] > 0
+
+    async def test_get_subscriptions_stats_requires_admin(self, client: httpx.AsyncClient):
+        response = await client.get(self.stats_url, auth=(SUBSCRIPTION_NAME, "password"))
+
+        assert response.status_code == 401
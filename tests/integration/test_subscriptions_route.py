@@ -3,11 +3,16 @@
 
 
 import uuid
+from unittest.mock import AsyncMock
 
 import httpx
+import msgpack
 import pytest
 
 from server.core.app.config import app_settings
+from server.core.app.main import app
+from server.services.subscriptions import SubscriptionService
+from univention.provisioning.models import MSGPACK_MEDIA_TYPE, ProvisioningMessage
 from univention.provisioning.models.subscription import FillQueueStatus
 
 from ..mock_data import (
@@ -19,6 +24,7 @@ from ..mock_data import (
     MESSAGE_PROCESSING_STATUS,
     PUBLISHER_NAME,
     REALM,
+    REPLY,
     SUBSCRIPTION_NAME,
     GROUPS_REALMS_TOPICS_as_dicts,
 )
@@ -118,6 +124,74 @@ class TestSubscriptionsRoute:
         assert data["body"] == FLAT_BODY
         assert data["publisher_name"] == PUBLISHER_NAME
         assert data["sequence_number"] == 1
+        assert data["ack_token"] == REPLY
+
+    async def test_get_message_with_strict_validation(self, client: httpx.AsyncClient):
+        app.dependency_overrides[app_settings] = lambda: self.settings.model_copy(
+            update={"strict_message_validation": True}
+        )
+        try:
+            response = await client.get(
+                f"{self.subscriptions_url}/{SUBSCRIPTION_NAME}/messages/next",
+                auth=(SUBSCRIPTION_NAME, CONSUMER_PASSWORD),
+            )
+        finally:
+            del app.dependency_overrides[app_settings]
+        assert response.status_code == 200
+        assert response.json()["body"] == FLAT_BODY
+        assert response.json()["sequence_number"] == 1
+
+    @pytest.mark.parametrize(
+        "accept,content_type",
+        (
+            (MSGPACK_MEDIA_TYPE, MSGPACK_MEDIA_TYPE),
+            (f"application/json;q=0.5, {MSGPACK_MEDIA_TYPE}", MSGPACK_MEDIA_TYPE),
+            (f"application/json, {MSGPACK_MEDIA_TYPE};q=0.5", "application/json"),
+            ("*/*", "application/json"),
+        ),
+    )
+    async def test_get_message_negotiates_format(self, client: httpx.AsyncClient, accept, content_type):
+        response = await client.get(
+            f"{self.subscriptions_url}/{SUBSCRIPTION_NAME}/messages/next",
+            headers={"Accept": accept},
+            auth=(SUBSCRIPTION_NAME, CONSUMER_PASSWORD),
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"] == content_type
+        data = msgpack.unpackb(response.content) if content_type == MSGPACK_MEDIA_TYPE else response.json()
+        assert ProvisioningMessage.model_validate(data).body.model_dump() == FLAT_BODY
+        assert data["sequence_number"] == 1
+
+    async def test_get_message_from_partition_of_unpartitioned_subscription(self, client: httpx.AsyncClient):
+        response = await client.get(
+            f"{self.subscriptions_url}/{SUBSCRIPTION_NAME}/messages/next",
+            params={"partition": 1},
+            auth=(SUBSCRIPTION_NAME, CONSUMER_PASSWORD),
+        )
+        assert response.status_code == 422
+
+    async def test_get_message_from_partition_not_leased(self, client: httpx.AsyncClient, monkeypatch):
+        monkeypatch.setattr(SubscriptionService, "get_subscription_partitions", AsyncMock(return_value=4))
+        response = await client.get(
+            f"{self.subscriptions_url}/{SUBSCRIPTION_NAME}/messages/next",
+            params={"partition": 1, "lease_id": "lease"},
+            auth=(SUBSCRIPTION_NAME, CONSUMER_PASSWORD),
+        )
+        assert response.status_code == 409
+
+    async def test_lease_partition_of_unpartitioned_subscription(self, client: httpx.AsyncClient):
+        response = await client.post(
+            f"{self.subscriptions_url}/{SUBSCRIPTION_NAME}/partitions/leases",
+            auth=(SUBSCRIPTION_NAME, CONSUMER_PASSWORD),
+        )
+        assert response.status_code == 422
+
+    async def test_release_partition(self, client: httpx.AsyncClient):
+        response = await client.delete(
+            f"{self.subscriptions_url}/{SUBSCRIPTION_NAME}/partitions/leases/lease",
+            auth=(SUBSCRIPTION_NAME, CONSUMER_PASSWORD),
+        )
+        assert response.status_code == 200
 
     async def test_update_messages_status(self, client: httpx.AsyncClient):
         response = await client.patch(
@@ -126,3 +200,19 @@ class TestSubscriptionsRoute:
             auth=(SUBSCRIPTION_NAME, CONSUMER_PASSWORD),
         )
         assert response.status_code == 200
+
+    async def test_update_messages_status_with_ack_token(self, client: httpx.AsyncClient):
+        response = await client.patch(
+            f"{self.subscriptions_url}/{SUBSCRIPTION_NAME}/messages/{MESSAGE_PROCESSING_SEQ_ID}/status",
+            json={"status": "failed", "ack_token": REPLY, "redelivery_delay": 5},
+            auth=(SUBSCRIPTION_NAME, CONSUMER_PASSWORD),
+        )
+        assert response.status_code == 200
+
+    async def test_update_messages_status_without_ack_token(self, client: httpx.AsyncClient):
+        response = await client.patch(
+            f"{self.subscriptions_url}/{SUBSCRIPTION_NAME}/messages/{MESSAGE_PROCESSING_SEQ_ID}/status",
+            json={"status": "in_progress"},
+            auth=(SUBSCRIPTION_NAME, CONSUMER_PASSWORD),
+        )
+        assert response.status_code == 422
@@ -7,6 +7,7 @@ from datetime import datetime
 
 from fastapi.security import HTTPBasicCredentials
 from nats.aio.msg import Msg
+from nats.js.api import ConsumerInfo, StreamInfo
 from nats.js.kv import KeyValue
 
 from univention.provisioning.models import (
@@ -47,6 +48,7 @@ SUBSCRIPTION_INFO = {
     "name": SUBSCRIPTION_NAME,
     "realms_topics": GROUPS_REALMS_TOPICS,
     "request_prefill": True,
+    "partitions": 1,
     "prefill_queue_status": "done",
 }
 SUBSCRIPTION_INFO_dumpable = deepcopy(SUBSCRIPTION_INFO)
@@ -72,6 +74,7 @@ PROVISIONING_MESSAGE = ProvisioningMessage(
     body=BODY,
     sequence_number=1,
     num_delivered=1,
+    ack_token=REPLY,
 )
 
 FLAT_BASE_MESSAGE = {
@@ -93,6 +96,11 @@ FLAT_PREFILL_MESSAGE_MULTIPLE_TOPICS["realms_topics"] = [
     RealmTopic(realm=REALM, topic=USERS_TOPIC),
 ]
 
+# W3C trace context of a message that is traced
+TRACE_ID = 0x0AF7651916CD43DD8448EB211C80319C
+SPAN_ID = 0xB7AD6B7169203331
+TRACE_CONTEXT = {"traceparent": f"00-{TRACE_ID:032x}-{SPAN_ID:016x}-01"}
+
 MSG = Msg(
     _client="nats",
     reply=REPLY,
@@ -140,6 +148,63 @@ MSG_PREFILL_REDELIVERED = Msg(
     ),
 )
 
+STREAM_INFO = StreamInfo.from_response(
+    {
+        "config": {"name": f"stream:{SUBSCRIPTION_NAME}"},
+        "state": {
+            "messages": 1,
+            "bytes": 340,
+            "first_seq": 1,
+            "last_seq": 1,
+            "consumer_count": 2,
+            "subjects": {f"{SUBSCRIPTION_NAME}.main": 1},
+        },
+    }
+)
+
+CONSUMER_INFO = ConsumerInfo.from_response(
+    {
+        "name": f"durable_name:{SUBSCRIPTION_NAME}",
+        "stream_name": f"stream:{SUBSCRIPTION_NAME}",
+        "config": {
+            "durable_name": f"durable_name:{SUBSCRIPTION_NAME}",
+            "ack_wait": 30_000_000_000,
+            "max_ack_pending": 1,
+        },
+        "delivered": {"consumer_seq": 0, "stream_seq": 0},
+        "num_ack_pending": 0,
+        "num_pending": 0,
+    }
+)
+
+CONSUMERS_INFO = [
+    ConsumerInfo.from_response(
+        {
+            "name": f"durable_name:{SUBSCRIPTION_NAME}-main",
+            "stream_name": f"stream:{SUBSCRIPTION_NAME}",
+            "config": {"filter_subject": f"{SUBSCRIPTION_NAME}.main"},
+            "delivered": {"consumer_seq": 7, "stream_seq": 6},
+            "num_ack_pending": 1,
+            "num_pending": 0,
+        }
+    ),
+    ConsumerInfo.from_response(
+        {
+            "name": f"durable_name:{SUBSCRIPTION_NAME}-prefill",
+            "stream_name": f"stream:{SUBSCRIPTION_NAME}",
+            "config": {"filter_subject": f"{SUBSCRIPTION_NAME}.prefill"},
+            "delivered": {"consumer_seq": 3, "stream_seq": 3},
+            "num_ack_pending": 0,
+            "num_pending": 0,
+        }
+    ),
+]
+
+FIRST_MESSAGE_TIME = "2023-11-09T11:15:52.616061123Z"
+STREAM_MSG_GET_RESPONSE = json.dumps(
+    {"type": "io.nats.jetstream.api.v1.stream_msg_get_response", "message": {"seq": 1, "time": FIRST_MESSAGE_TIME}}
+).encode()
+
 MQMESSAGE = MQMessage(
     subject="",
     reply=REPLY,
@@ -174,6 +239,7 @@ kv_sub_info.value = (
     b'{"name": "0f084f8c-1093-4024-b215-55fe8631ddf6", '
     b'"realms_topics": [{"realm": "udm", "topic": "groups/group"}], '
     b'"request_prefill": true, '
+    b'"partitions": 1, '
     b'"prefill_queue_status": "done"}'
 )
 kv_sub_info.revision = 12
@@ -185,3 +251,69 @@ kv_password.value = CONSUMER_HASHED_PASSWORD.encode()
 CREDENTIALS = HTTPBasicCredentials(username="dev-user", password="dev-password")
 
 SUBSCRIPTIONS = {REALM: {GROUPS_TOPIC: {Subscription.model_validate(SUBSCRIPTION_INFO)}}}
+
+# UDM objects as sent by the udm-transformer
+USER_OBJECT = {
+    "dn": "uid=jdoe,cn=users,dc=univention-organization,dc=intranet",
+    "objectType": USERS_TOPIC,
+    "id": "jdoe",
+    "uuid": "b5d5b4b6-3dc4-103e-9ba8-5f4b5c8e9d7a",
+    "uri": "http://udm-rest-api/udm/users/user/uid=jdoe,cn=users,dc=univention-organization,dc=intranet",
+    "position": "cn=users,dc=univention-organization,dc=intranet",
+    "superordinate": None,
+    "options": {"pki": False, "default": True},
+    "policies": {"policies/pwhistory": [], "policies/umc": [], "policies/desktop": []},
+    "properties": {
+        "username": "jdoe",
+        "firstname": "John",
+        "lastname": "Doe",
+        "displayName": "John Doe",
+        "description": "",
+        "mailPrimaryAddress": "jdoe@univention-organization.intranet",
+        "mailAlternativeAddress": ["john.doe@univention-organization.intranet"],
+        "e-mail": ["jdoe@example.org"],
+        "primaryGroup": "cn=Domain Users,cn=groups,dc=univention-organization,dc=intranet",
+        "groups": [
+            "cn=Domain Users,cn=groups,dc=univention-organization,dc=intranet",
+            "cn=staff,cn=groups,dc=univention-organization,dc=intranet",
+        ],
+        "uidNumber": 2001,
+        "gidNumber": 5001,
+        "homedrive": "",
+        "unixhome": "/home/jdoe",
+        "shell": "/bin/bash",
+        "locked": False,
+        "disabled": False,
+        "accountActivationDate": {"date": None, "time": None, "timezone": None},
+        "userexpiry": None,
+        "passwordexpiry": None,
+        "pwdChangeNextLogin": None,
+        "preferredLanguage": "en-US",
+        "univentionObjectIdentifier": "f5c8e4b1-6f6a-4d4c-9f0a-2b1a3c4d5e6f",
+        "jpegPhoto": None,
+    },
+}
+GROUP_OBJECT = {
+    "dn": "cn=staff,cn=groups,dc=univention-organization,dc=intranet",
+    "objectType": GROUPS_TOPIC,
+    "id": "staff",
+    "uuid": "c6e6c5c7-3dc4-103e-9ba9-5f4b5c8e9d7a",
+    "uri": "http://udm-rest-api/udm/groups/group/cn=staff,cn=groups,dc=univention-organization,dc=intranet",
+    "position": "cn=groups,dc=univention-organization,dc=intranet",
+    "superordinate": None,
+    "options": {"posix": True, "samba": True},
+    "policies": {"policies/umc": []},
+    "properties": {
+        "name": "staff",
+        "description": "All staff members",
+        "gidNumber": 5001,
+        "sambaRID": 5001,
+        "mailAddress": "staff@univention-organization.intranet",
+        "groupType": "-2147483646",
+        "users": ["uid=jdoe,cn=users,dc=univention-organization,dc=intranet"],
+        "nestedGroup": [],
+        "memberOf": [],
+        "allowedEmailUsers": [],
+        "allowedEmailGroups": [],
+    },
+}
@@ -1,8 +1,11 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 
-from typing import Any, Optional
-from unittest.mock import AsyncMock
+import contextlib
+import sys
+import types
+from typing import Any, Iterator, Optional
+from unittest.mock import AsyncMock, MagicMock, patch
 
 from nats.aio.msg import Msg
 from nats.js.errors import KeyNotFoundError
@@ -13,7 +16,16 @@ from server.core.app.config import AppSettings
 from server.services.port import Port
 from univention.provisioning.models.subscription import Bucket
 
-from .mock_data import MSG, SUBSCRIPTION_NAME, kv_password, kv_sub_info
+from .mock_data import (
+    CONSUMER_INFO,
+    CONSUMERS_INFO,
+    MSG,
+    STREAM_INFO,
+    STREAM_MSG_GET_RESPONSE,
+    SUBSCRIPTION_NAME,
+    kv_password,
+    kv_sub_info,
+)
 
 
 class FakeMessageQueue(AsyncMock):
@@ -30,6 +42,8 @@ class FakeKvStore(AsyncMock):
         self.bucket = bucket
         if self.bucket == Bucket.credentials:
             self._values = {SUBSCRIPTION_NAME: kv_password}
+        elif self.bucket == Bucket.partition_leases:
+            self._values = {}
         else:
             self._values = {SUBSCRIPTION_NAME: kv_sub_info}
 
@@ -62,6 +76,10 @@ class FakeJs(AsyncMock):
     async def pull_subscribe(cls, subject: str, durable: str, stream: str, config):
         return cls.sub
 
+    @classmethod
+    async def pull_subscribe_bind(cls, durable: str, stream: str):
+        return cls.sub
+
     @classmethod
     async def key_value(cls, bucket: str):
         return FakeKvStore(bucket)
@@ -79,6 +97,10 @@ class MockNatsMQAdapter(NatsMQAdapter):
         super().__init__()
         self._nats = AsyncMock()
         self._js = FakeJs()
+        self._js.stream_info = AsyncMock(return_value=STREAM_INFO)
+        self._js.consumer_info = AsyncMock(return_value=CONSUMER_INFO)
+        self._js.consumers_info = AsyncMock(return_value=CONSUMERS_INFO)
+        self._nats.request = AsyncMock(return_value=MagicMock(data=STREAM_MSG_GET_RESPONSE))
         self._message_queue = FakeMessageQueue()
 
 
@@ -87,3 +109,82 @@ class MockNatsKVAdapter(NatsKVAdapter):
         super().__init__()
         self._nats = AsyncMock()
         self._js = FakeJs()
+
+
+class FakeLDAPAccess:
+    """Mock of univention.admin.uldap.access, which only records its connection parameters"""
+
+    def __init__(self, **kwargs: Any):
+        self.connection_params = kwargs
+
+
+@contextlib.contextmanager
+def udm_modules_mock() -> Iterator[None]:
+    """
+    Mock the UDM and LDAP modules, which are only installed in the image of the udm-transformer.
+
+    The modules imported within the context, like `udm_transformer.service.udm`, are forgotten when it is left.
+    """
+    import univention
+
+    modules = {
+        name: types.ModuleType(name)
+        for name in (
+            "univention.admin",
+            "univention.admin.uldap",
+            "univention.admin.rest",
+            "univention.admin.rest.module",
+            "univention.management",
+            "univention.management.console",
+            "univention.management.console.log",
+            "univention.management.console.modules",
+            "univention.management.console.modules.udm",
+            "univention.management.console.modules.udm.udm_ldap",
+        )
+    }
+    modules["univention.admin.uldap"].access = FakeLDAPAccess
+    modules["univention.admin.uldap"].position = MagicMock()
+    modules["univention.admin.rest.module"].Object = MagicMock()
+    modules["univention.management.console.log"].MODULE = MagicMock()
+    modules["univention.management.console.modules.udm.udm_ldap"].UDM_Module = MagicMock()
+    for name, module in modules.items():
+        parent, _, child = name.rpartition(".")
+        if parent in modules:
+            setattr(modules[parent], child, module)
+
+    with (
+        patch.dict(sys.modules, modules),
+        patch.object(univention, "admin", modules["univention.admin"], create=True),
+        patch.object(univention, "management", modules["univention.management"], create=True),
+    ):
+        yield
+
+
+def udm_transformer_port_mock(**settings: Any) -> MagicMock:
+    """Mock of udm_transformer.port.UDMTransformerPort with the given settings and an empty cache bucket"""
+    from udm_transformer.config import UDMTransformerSettings
+
+    port = MagicMock()
+    port.settings = UDMTransformerSettings(
+        log_level="DEBUG",
+        nats_user="udm-transformer",
+        nats_password="password",
+        nats_host="localhost",
+        nats_port=4222,
+        ldap_publisher_name="udm-listener",
+        events_username_udm="udm",
+        events_password_udm="password",
+        ldap_host="localhost",
+        ldap_port=389,
+        ldap_tls_mode="off",
+        ldap_base_dn="dc=univention-organization,dc=intranet",
+        ldap_bind_dn="cn=admin,dc=univention-organization,dc=intranet",
+        ldap_bind_pw="password",
+        provisioning_api_host="localhost",
+        provisioning_api_port=7777,
+        **settings,
+    )
+    port.retrieve = AsyncMock(return_value={})
+    port.store = AsyncMock()
+    port.send_event = AsyncMock()
+    return port
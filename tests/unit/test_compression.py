@@ -0,0 +1,90 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# SPDX-FileCopyrightText: 2024 Univention GmbH
+
+import gzip
+
+import httpx
+import pytest
+from fastapi import FastAPI, Response
+
+from server.core.app.compression import CompressionMiddleware
+from server.core.app.negotiation import negotiate
+
+BODY = b"x" * 2048
+
+
+@pytest.fixture
+async def client():
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, paths=[r"/compressed/[^/]+"], minimum_size=1024)
+
+    @app.get("/compressed/{size}")
+    def compressed(size: int) -> Response:
+        return Response(BODY[:size])
+
+    @app.get("/uncompressed")
+    def uncompressed() -> Response:
+        return Response(BODY)
+
+    async with httpx.AsyncClient(app=app, base_url="http://testserver") as client:
+        yield client
+
+
+@pytest.mark.parametrize(
+    "header,expected",
+    (
+        (None, "identity"),
+        ("gzip", "gzip"),
+        ("br, gzip, zstd", "gzip"),
+        ("gzip;q=0.5, zstd", "zstd"),
+        ("gzip;q=0", "identity"),
+        ("*", "identity"),
+    ),
+)
+def test_negotiate(header, expected):
+    assert negotiate(header, ("identity", "zstd", "gzip")) == expected
+
+
+@pytest.mark.anyio
+class TestCompressionMiddleware:
+    async def test_gzip(self, client: httpx.AsyncClient):
+        response = await client.get("/compressed/2048", headers={"Accept-Encoding": "gzip"})
+
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.headers["vary"] == "Accept-Encoding"
+        assert int(response.headers["content-length"]) < len(BODY)
+        assert response.content == BODY
+
+    async def test_zstd(self, client: httpx.AsyncClient):
+        zstandard = pytest.importorskip("zstandard")
+
+        async with client.stream("GET", "/compressed/2048", headers={"Accept-Encoding": "zstd"}) as response:
+            raw = b"".join([chunk async for chunk in response.aiter_raw()])
+
+        assert response.headers["content-encoding"] == "zstd"
+        assert zstandard.ZstdDecompressor().decompress(raw) == BODY
+
+    async def test_below_minimum_size(self, client: httpx.AsyncClient):
+        response = await client.get("/compressed/1000", headers={"Accept-Encoding": "gzip"})
+
+        assert "content-encoding" not in response.headers
+        assert response.headers["vary"] == "Accept-Encoding"
+        assert response.content == BODY[:1000]
+
+    async def test_not_accepted(self, client: httpx.AsyncClient):
+        response = await client.get("/compressed/2048", headers={"Accept-Encoding": "identity"})
+
+        assert "content-encoding" not in response.headers
+        assert response.content == BODY
+
+    async def test_other_path(self, client: httpx.AsyncClient):
+        response = await client.get("/uncompressed", headers={"Accept-Encoding": "gzip"})
+
+        assert "content-encoding" not in response.headers
+        assert response.content == BODY
+
+    async def test_gzip_is_decodable(self, client: httpx.AsyncClient):
+        async with client.stream("GET", "/compressed/2048", headers={"Accept-Encoding": "gzip"}) as response:
+            raw = b"".join([chunk async for chunk in response.aiter_raw()])
+
+        assert gzip.decompress(raw) == BODY
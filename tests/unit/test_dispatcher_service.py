@@ -6,9 +6,10 @@ from unittest.mock import AsyncMock, call
 import pytest
 
 from server.core.dispatcher.service.dispatcher import DispatcherService
-from univention.provisioning.models import DISPATCHER_SUBJECT_TEMPLATE
+from univention.provisioning.models import DISPATCHER_SUBJECT_TEMPLATE, Subscription
+from univention.provisioning.models.queue import Body
 
-from ..mock_data import MESSAGE, MQMESSAGE, SUBSCRIPTION_INFO, SUBSCRIPTIONS
+from ..mock_data import MESSAGE, MQMESSAGE, SPAN_ID, SUBSCRIPTION_INFO, SUBSCRIPTIONS, TRACE_CONTEXT, TRACE_ID
 from ..unit import EscapeLoopException
 
 
@@ -45,7 +46,55 @@ class TestDispatcherService:
             dispatcher_service.update_subscriptions_mapping
         )
         dispatcher_service._port.wait_for_event.assert_has_calls([call(), call()])
-        dispatcher_service._port.send_message_to_subscription.assert_called_once_with(
-            SUBSCRIPTION_INFO["name"], self.main_subject, MESSAGE
+        dispatcher_service._port.send_message_to_subscriptions.assert_called_once_with(
+            [(SUBSCRIPTION_INFO["name"], self.main_subject)], MESSAGE, None
         )
         dispatcher_service._port.acknowledge_message.assert_called_once_with(MQMESSAGE)
+
+    async def test_handle_message_keeps_message_id(self, dispatcher_service: DispatcherService):
+        dispatcher_service._subscriptions = {
+            MESSAGE.realm: {MESSAGE.topic: {Subscription.model_validate(SUBSCRIPTION_INFO)}}
+        }
+        message = MQMESSAGE.model_copy(update={"headers": {"Nats-Msg-Id": "ldif-producer:42"}})
+
+        await dispatcher_service.handle_message(message)
+
+        dispatcher_service._port.send_message_to_subscriptions.assert_called_once_with(
+            [(SUBSCRIPTION_INFO["name"], self.main_subject)], MESSAGE, "ldif-producer:42"
+        )
+
+    async def test_handle_message_continues_trace(self, dispatcher_service: DispatcherService, span_exporter):
+        dispatcher_service._subscriptions = {
+            MESSAGE.realm: {MESSAGE.topic: {Subscription.model_validate(SUBSCRIPTION_INFO)}}
+        }
+
+        await dispatcher_service.handle_message(MQMESSAGE.model_copy(update={"headers": TRACE_CONTEXT}))
+
+        [dispatch_span] = span_exporter.get_finished_spans()
+        assert dispatch_span.name == "dispatch"
+        assert dispatch_span.context.trace_id == TRACE_ID
+        assert dispatch_span.parent.span_id == SPAN_ID
+        assert dispatch_span.attributes["provisioning.subscriptions"] == 1
+
+    def test_subscription_subject(self):
+        subscription = Subscription.model_validate(SUBSCRIPTION_INFO)
+
+        assert DispatcherService.subscription_subject(subscription, MESSAGE) == self.main_subject
+
+    def test_partitioned_subscription_subject(self):
+        subscription = Subscription.model_validate({**SUBSCRIPTION_INFO, "partitions": 8})
+        subjects = set()
+        for i in range(32):
+            obj = {"dn": f"cn=group{i},dc=example,dc=org", "uuid": f"uuid-{i}"}
+            moved_obj = {"dn": f"cn=group{i},ou=moved,dc=example,dc=org", "uuid": f"uuid-{i}"}
+            created, moved, deleted = (
+                MESSAGE.model_copy(update={"body": Body(old=old, new=new)})
+                for old, new in (({}, obj), (obj, moved_obj), (moved_obj, {}))
+            )
+            subject = DispatcherService.subscription_subject(subscription, created)
+            assert DispatcherService.subscription_subject(subscription, moved) == subject
+            assert DispatcherService.subscription_subject(subscription, deleted) == subject
+            subjects.add(subject)
+
+        assert subjects <= {f"{SUBSCRIPTION_INFO['name']}.main.{partition}" for partition in range(8)}
+        assert len(subjects) > 1
@@ -5,20 +5,34 @@ from unittest.mock import AsyncMock, call, patch
 
 import pytest
 
-from server.services.messages import MessageService
+from server.services.messages import InvalidPartition, MessageService, PartitionNotLeased
 from univention.provisioning.models import (
     DISPATCHER_STREAM,
     DISPATCHER_SUBJECT_TEMPLATE,
     PREFILL_SUBJECT_TEMPLATE,
     FillQueueStatus,
+    MessageProcessingStatus,
+    Subscription,
 )
 
-from ..mock_data import MESSAGE, MESSAGE_PROCESSING_SEQ_ID, MESSAGE_PROCESSING_STATUS, SUBSCRIPTION_NAME
+from ..mock_data import (
+    MESSAGE,
+    MESSAGE_PROCESSING_SEQ_ID,
+    MESSAGE_PROCESSING_STATUS,
+    REPLY,
+    SUBSCRIPTION_INFO,
+    SUBSCRIPTION_NAME,
+)
 
 
 @pytest.fixture
 def sub_service() -> AsyncMock:
-    yield patch("server.services.messages.SubscriptionService").start().return_value
+    with patch("server.services.messages.SubscriptionService") as sub_service_class:
+        sub_service = sub_service_class.return_value
+        sub_service.get_subscription = AsyncMock(return_value=Subscription.model_validate(SUBSCRIPTION_INFO))
+        sub_service.get_subscription_partitions = AsyncMock(return_value=1)
+        sub_service.is_partition_leased = AsyncMock(return_value=True)
+        yield sub_service
 
 
 @pytest.fixture
@@ -44,13 +58,65 @@ class TestMessageService:
 
     async def test_get_next_message_from_prefill_subject(self, message_service: MessageService, sub_service):
         sub_service.get_subscription_queue_status = AsyncMock(return_value=FillQueueStatus.done)
+        message_service._port.get_subject_message_count = AsyncMock(return_value=3)
         message_service._port.get_message = AsyncMock(return_value=MESSAGE)
 
         result = await message_service.get_next_message(SUBSCRIPTION_NAME, timeout=5, pop=True)
 
         sub_service.get_subscription_queue_status.assert_called_once_with(SUBSCRIPTION_NAME)
+        message_service._port.get_subject_message_count.assert_called_once_with(SUBSCRIPTION_NAME, self.prefill_subject)
         message_service._port.get_message.assert_called_once_with(SUBSCRIPTION_NAME, self.prefill_subject, 5, True)
         assert result == MESSAGE
+        assert not message_service._subscription_prefill_done.get(SUBSCRIPTION_NAME)
+
+    async def test_get_next_message_prefill_message_not_yet_acknowledged(
+        self, message_service: MessageService, sub_service
+    ):
+        sub_service.get_subscription_queue_status = AsyncMock(return_value=FillQueueStatus.done)
+        message_service._port.get_subject_message_count = AsyncMock(return_value=1)
+        message_service._port.get_message = AsyncMock(return_value=None)
+
+        result = await message_service.get_next_message(SUBSCRIPTION_NAME, timeout=5, pop=False)
+
+        message_service._port.get_message.assert_called_once_with(SUBSCRIPTION_NAME, self.prefill_subject, 5, False)
+        assert result is None
+        assert not message_service._subscription_prefill_done.get(SUBSCRIPTION_NAME)
+
+    async def test_get_next_message_switches_to_main_subject(self, message_service: MessageService, sub_service):
+        sub_service.get_subscription_queue_status = AsyncMock(return_value=FillQueueStatus.done)
+        message_service._port.get_subject_message_count = AsyncMock(return_value=0)
+        message_service._port.get_message = AsyncMock(return_value=MESSAGE)
+
+        result = await message_service.get_next_message(SUBSCRIPTION_NAME, timeout=5, pop=True)
+
+        message_service._port.get_message.assert_called_once_with(SUBSCRIPTION_NAME, self.main_subject, 5, True)
+        assert result == MESSAGE
+        assert message_service._subscription_prefill_done[SUBSCRIPTION_NAME] is True
+
+    async def test_get_next_message_as_msgpack(self, message_service: MessageService, sub_service):
+        message_service._port.get_message_msgpack = AsyncMock(return_value=b"\x80")
+        message_service._subscription_prefill_done[SUBSCRIPTION_NAME] = True
+
+        result = await message_service.get_next_message(
+            SUBSCRIPTION_NAME, timeout=5, pop=False, validate=False, as_msgpack=True
+        )
+
+        message_service._port.get_message_msgpack.assert_called_once_with(
+            SUBSCRIPTION_NAME, self.main_subject, 5, False
+        )
+        message_service._port.get_message_json.assert_not_called()
+        assert result == b"\x80"
+
+    async def test_get_next_message_without_validation(self, message_service: MessageService, sub_service):
+        sub_service.get_subscription_queue_status = AsyncMock(return_value=FillQueueStatus.done)
+        message_service._port.get_message_json = AsyncMock(return_value=b"{}")
+        message_service._subscription_prefill_done[SUBSCRIPTION_NAME] = True
+
+        result = await message_service.get_next_message(SUBSCRIPTION_NAME, timeout=5, pop=False, validate=False)
+
+        message_service._port.get_message_json.assert_called_once_with(SUBSCRIPTION_NAME, self.main_subject, 5, False)
+        message_service._port.get_message.assert_not_called()
+        assert result == b"{}"
 
     async def test_get_next_message_from_main_subject(self, message_service: MessageService, sub_service):
         sub_service.get_subscription_queue_status = AsyncMock(return_value=FillQueueStatus.done)
@@ -60,6 +126,7 @@ class TestMessageService:
         result = await message_service.get_next_message(SUBSCRIPTION_NAME, timeout=5, pop=True)
 
         sub_service.get_subscription_queue_status.assert_not_called()
+        message_service._port.get_subject_message_count.assert_not_called()
         message_service._port.get_message.assert_has_calls(
             [
                 call(SUBSCRIPTION_NAME, self.main_subject, 5, True),
@@ -67,6 +134,43 @@ class TestMessageService:
         )
         assert result == MESSAGE
 
+    async def test_get_next_message_from_partition(self, message_service: MessageService, sub_service):
+        sub_service.get_subscription_partitions = AsyncMock(return_value=4)
+        message_service._port.get_message = AsyncMock(return_value=MESSAGE)
+        message_service._subscription_prefill_done[SUBSCRIPTION_NAME] = True
+
+        result = await message_service.get_next_message(
+            SUBSCRIPTION_NAME, timeout=5, pop=True, partition=2, lease_id="lease"
+        )
+
+        sub_service.is_partition_leased.assert_called_once_with(SUBSCRIPTION_NAME, 2, "lease")
+        message_service._port.get_message.assert_called_once_with(
+            SUBSCRIPTION_NAME, f"{SUBSCRIPTION_NAME}.main.2", 5, True
+        )
+        assert result == MESSAGE
+
+    async def test_get_next_message_from_partition_not_leased(self, message_service: MessageService, sub_service):
+        sub_service.get_subscription_partitions = AsyncMock(return_value=4)
+        sub_service.is_partition_leased = AsyncMock(return_value=False)
+
+        with pytest.raises(PartitionNotLeased):
+            await message_service.get_next_message(
+                SUBSCRIPTION_NAME, timeout=5, pop=True, partition=2, lease_id="other"
+            )
+
+        message_service._port.get_message.assert_not_called()
+
+    @pytest.mark.parametrize("partitions,partition", [(1, 0), (4, None), (4, 4)])
+    async def test_get_next_message_invalid_partition(
+        self, message_service: MessageService, sub_service, partitions, partition
+    ):
+        sub_service.get_subscription_partitions = AsyncMock(return_value=partitions)
+
+        with pytest.raises(InvalidPartition):
+            await message_service.get_next_message(SUBSCRIPTION_NAME, timeout=5, pop=True, partition=partition)
+
+        message_service._port.get_message.assert_not_called()
+
     async def test_post_message_status(self, message_service: MessageService):
         message_service._port.delete_message = AsyncMock()
 
@@ -77,7 +181,32 @@ class TestMessageService:
         message_service._port.delete_message.assert_called_once_with(SUBSCRIPTION_NAME, 1)
         assert result is None
 
+    async def test_post_message_status_with_ack_token(self, message_service: MessageService):
+        result = await message_service.post_message_status(
+            SUBSCRIPTION_NAME, MESSAGE_PROCESSING_SEQ_ID, MessageProcessingStatus.ok, REPLY
+        )
+
+        message_service._port.acknowledge_message.assert_called_once_with(SUBSCRIPTION_NAME, 1, REPLY)
+        message_service._port.delete_message.assert_not_called()
+        assert result is None
+
+    async def test_post_message_status_failed(self, message_service: MessageService):
+        await message_service.post_message_status(
+            SUBSCRIPTION_NAME, MESSAGE_PROCESSING_SEQ_ID, MessageProcessingStatus.failed, REPLY, 2.5
+        )
+
+        message_service._port.acknowledge_message_negatively.assert_called_once_with(SUBSCRIPTION_NAME, 1, REPLY, 2.5)
+        message_service._port.acknowledge_message.assert_not_called()
+
+    async def test_post_message_status_in_progress(self, message_service: MessageService):
+        await message_service.post_message_status(
+            SUBSCRIPTION_NAME, MESSAGE_PROCESSING_SEQ_ID, MessageProcessingStatus.in_progress, REPLY
+        )
+
+        message_service._port.acknowledge_message_in_progress.assert_called_once_with(SUBSCRIPTION_NAME, 1, REPLY)
+        message_service._port.acknowledge_message.assert_not_called()
+
     async def test_add_live_message(self, message_service: MessageService):
         await message_service.add_live_event(MESSAGE)
 
-        message_service._port.add_message.assert_called_once_with(DISPATCHER_STREAM, DISPATCHER_STREAM, MESSAGE)
+        message_service._port.add_message.assert_called_once_with(DISPATCHER_STREAM, DISPATCHER_STREAM, MESSAGE, None)
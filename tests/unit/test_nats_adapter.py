@@ -2,15 +2,31 @@
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 
 import asyncio
+import dataclasses
 import json
 from contextlib import nullcontext
+from datetime import datetime, timezone
 from unittest.mock import AsyncMock, Mock, call
 
+import msgpack
 import pytest
-from nats.js.errors import BucketNotFoundError, NotFoundError
+from nats.errors import NoRespondersError
+from nats.js.api import (
+    ConsumerConfig,
+    DeliverPolicy,
+    DiscardPolicy,
+    RetentionPolicy,
+    StorageType,
+    StoreCompression,
+    StreamConfig,
+)
+from nats.js.errors import BucketNotFoundError, KeyWrongLastSequenceError, NotFoundError
+from prometheus_client import REGISTRY
 
-from server.adapters.nats_adapter import NatsKeys, UpdateConflict
-from univention.provisioning.models import Bucket
+from server.adapters.nats_adapter import ConsumerState, Empty, NatsKeys, OutgoingMessage, UpdateConflict
+from server.stream_policy import StreamPolicy
+from server.tracing import tracer
+from univention.provisioning.models import Bucket, ProvisioningMessage
 
 from ..mock_data import (
     CREDENTIALS,
@@ -20,7 +36,12 @@ from ..mock_data import (
     MSG,
     NATS_SERVER,
     PROVISIONING_MESSAGE,
+    REPLY,
+    SPAN_ID,
+    STREAM_INFO,
     SUBSCRIPTION_NAME,
+    TRACE_CONTEXT,
+    TRACE_ID,
     SUBSCRIPTION_INFO_dumpable,
     kv_sub_info,
 )
@@ -53,7 +74,7 @@ def mock_nats_kv_adapter(mock_kv) -> MockNatsKVAdapter:
 def mock_fetch(mock_nats_mq_adapter):
     sub = AsyncMock()
     sub.fetch = AsyncMock(return_value=[MSG])
-    mock_nats_mq_adapter._js.pull_subscribe = AsyncMock(return_value=sub)
+    mock_nats_mq_adapter._js.pull_subscribe_bind = AsyncMock(return_value=sub)
     return sub.fetch
 
 
@@ -113,6 +134,18 @@ class TestNatsKVAdapter:
         mock_kv.get.assert_called_once_with(SUBSCRIPTION_NAME)
         assert result == (json.dumps(SUBSCRIPTION_INFO_dumpable), 12)
 
+    async def test_get_binary_value(self, mock_nats_kv_adapter, mock_kv):
+        result = await mock_nats_kv_adapter.get_binary_value(SUBSCRIPTION_NAME, Bucket.subscriptions)
+
+        mock_nats_kv_adapter._js.key_value.assert_called_once_with(Bucket.subscriptions)
+        mock_kv.get.assert_called_once_with(SUBSCRIPTION_NAME)
+        assert result == kv_sub_info.value
+
+    async def test_get_binary_value_by_unknown_key(self, mock_nats_kv_adapter, mock_kv):
+        result = await mock_nats_kv_adapter.get_binary_value("unknown", Bucket.subscriptions)
+
+        assert result is None
+
     async def test_get_value_by_unknown_key(self, mock_nats_kv_adapter, mock_kv):
         result = await mock_nats_kv_adapter.get_value("unknown", Bucket.subscriptions)
 
@@ -130,6 +163,12 @@ class TestNatsKVAdapter:
         mock_kv.put.assert_called_once_with("test_put_value", kv_sub_info.value)
         assert result is None
 
+    async def test_put_binary_value(self, mock_nats_kv_adapter, mock_kv):
+        result = await mock_nats_kv_adapter.put_value("test_put_binary_value", b"\x01\xff", Bucket.subscriptions)
+
+        mock_kv.put.assert_called_once_with("test_put_binary_value", b"\x01\xff")
+        assert result is None
+
     @pytest.mark.parametrize("revision,expectation", ((12, nullcontext(None)), (13, pytest.raises(UpdateConflict))))
     async def test_put_value_with_revision(self, mock_nats_kv_adapter, mock_kv, revision, expectation):
         with expectation as exc_info:
@@ -146,6 +185,19 @@ class TestNatsKVAdapter:
         mock_kv.update.assert_called_once_with(SUBSCRIPTION_NAME, kv_sub_info.value, revision)
         assert result is None
 
+    async def test_put_value_with_revision_zero_creates_key(self, mock_nats_kv_adapter, mock_kv):
+        await mock_nats_kv_adapter.put_value("test_create_value", SUBSCRIPTION_INFO_dumpable, Bucket.subscriptions, 0)
+
+        mock_kv.create.assert_called_once_with("test_create_value", kv_sub_info.value)
+        mock_kv.update.assert_not_called()
+        mock_kv.put.assert_not_called()
+
+    async def test_put_value_with_revision_zero_existing_key(self, mock_nats_kv_adapter, mock_kv):
+        mock_kv.create = AsyncMock(side_effect=KeyWrongLastSequenceError)
+
+        with pytest.raises(UpdateConflict):
+            await mock_nats_kv_adapter.put_value(SUBSCRIPTION_NAME, SUBSCRIPTION_INFO_dumpable, Bucket.subscriptions, 0)
+
     async def test_put_empty_value(self, mock_nats_kv_adapter, mock_kv):
         await mock_nats_kv_adapter.put_value("test_put_empty_value", SUBSCRIPTION_INFO_dumpable, Bucket.subscriptions)
         assert "test_put_empty_value" in mock_kv._fake_kv._values
@@ -189,51 +241,151 @@ class TestNatsMQAdapter:
             self.subject,
             FLAT_MESSAGE_ENCODED,
             stream=NatsKeys.stream(SUBSCRIPTION_NAME),
+            headers=None,
         )
         assert result is None
 
+    async def test_add_message_with_msg_id(self, mock_nats_mq_adapter):
+        await mock_nats_mq_adapter.add_message(SUBSCRIPTION_NAME, self.subject, MESSAGE, msg_id="ldap-producer:42")
+
+        mock_nats_mq_adapter._js.publish.assert_called_once_with(
+            self.subject,
+            FLAT_MESSAGE_ENCODED,
+            stream=NatsKeys.stream(SUBSCRIPTION_NAME),
+            headers={"Nats-Msg-Id": "ldap-producer:42"},
+        )
+
+    async def test_add_message_sends_trace_context(self, mock_nats_mq_adapter, span_exporter):
+        with tracer().start_as_current_span("test") as span:
+            await mock_nats_mq_adapter.add_message(SUBSCRIPTION_NAME, self.subject, MESSAGE)
+
+        [publish_span, _] = span_exporter.get_finished_spans()
+        assert publish_span.parent.span_id == span.get_span_context().span_id
+        headers = mock_nats_mq_adapter._js.publish.call_args.kwargs["headers"]
+        trace_id = span.get_span_context().trace_id
+        assert headers["traceparent"].startswith(f"00-{trace_id:032x}-{publish_span.context.span_id:016x}-")
+
+    async def test_add_messages(self, mock_nats_mq_adapter):
+        in_flight = 0
+        max_in_flight = 0
+
+        async def publish(*args, **kwargs):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(in_flight, max_in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            if args[0] == "failing":
+                raise NoRespondersError
+            return Mock(duplicate=False)
+
+        mock_nats_mq_adapter._js.publish = AsyncMock(side_effect=publish)
+        messages = [
+            OutgoingMessage(SUBSCRIPTION_NAME, self.subject, MESSAGE, "ldap-producer:1"),
+            OutgoingMessage(SUBSCRIPTION_NAME, "failing", MESSAGE),
+            OutgoingMessage(SUBSCRIPTION_NAME, self.subject, MESSAGE),
+            OutgoingMessage(SUBSCRIPTION_NAME, self.subject, MESSAGE),
+        ]
+
+        result = await mock_nats_mq_adapter.add_messages(messages, max_in_flight=2)
+
+        assert [call_args.args[0] for call_args in mock_nats_mq_adapter._js.publish.call_args_list] == [
+            self.subject,
+            "failing",
+            self.subject,
+            self.subject,
+        ]
+        mock_nats_mq_adapter._js.publish.assert_any_call(
+            self.subject,
+            FLAT_MESSAGE_ENCODED,
+            stream=NatsKeys.stream(SUBSCRIPTION_NAME),
+            headers={"Nats-Msg-Id": "ldap-producer:1"},
+        )
+        assert max_in_flight == 2
+        assert result[0] is None
+        assert isinstance(result[1], NoRespondersError)
+        assert result[2:] == [None, None]
+
     async def test_get_messages(self, mock_nats_mq_adapter, mock_fetch):
-        consumer_mock = Mock()
         mock_nats_mq_adapter.delete_message = AsyncMock()
-        mock_nats_mq_adapter._js.consumer_info = AsyncMock(return_value=consumer_mock)
 
         result = await mock_nats_mq_adapter.get_message(SUBSCRIPTION_NAME, self.subject, timeout=5, pop=False)
 
         mock_nats_mq_adapter._js.stream_info.assert_called_once_with(NatsKeys.stream(SUBSCRIPTION_NAME))
         mock_nats_mq_adapter._js.consumer_info.assert_called_once_with(
-            NatsKeys.stream(SUBSCRIPTION_NAME), NatsKeys.durable_name(SUBSCRIPTION_NAME)
+            NatsKeys.stream(SUBSCRIPTION_NAME), NatsKeys.subject_durable_name(self.subject)
         )
-        mock_nats_mq_adapter._js.pull_subscribe.assert_called_once_with(
-            self.subject,
-            durable=f"durable_name:{SUBSCRIPTION_NAME}",
+        mock_nats_mq_adapter._js.add_consumer.assert_not_called()
+        mock_nats_mq_adapter._js.pull_subscribe_bind.assert_called_once_with(
+            durable=NatsKeys.subject_durable_name(self.subject),
             stream=NatsKeys.stream(SUBSCRIPTION_NAME),
-            config=consumer_mock,
         )
         mock_fetch.assert_called_once_with(1, 5)
         mock_nats_mq_adapter.delete_message.assert_not_called()
         assert result == PROVISIONING_MESSAGE
 
+    async def test_get_message_json(self, mock_nats_mq_adapter, mock_fetch):
+        result = await mock_nats_mq_adapter.get_message_json(SUBSCRIPTION_NAME, self.subject, timeout=5, pop=False)
+
+        mock_fetch.assert_called_once_with(1, 5)
+        assert json.loads(result) == PROVISIONING_MESSAGE.model_dump(mode="json")
+        assert ProvisioningMessage.model_validate_json(result) == PROVISIONING_MESSAGE
+
+    async def test_get_message_msgpack(self, mock_nats_mq_adapter, mock_fetch):
+        result = await mock_nats_mq_adapter.get_message_msgpack(SUBSCRIPTION_NAME, self.subject, timeout=5, pop=False)
+
+        mock_fetch.assert_called_once_with(1, 5)
+        assert msgpack.unpackb(result) == PROVISIONING_MESSAGE.model_dump(mode="json")
+
+    async def test_get_message_json_timeout(self, mock_nats_mq_adapter, mock_fetch):
+        mock_fetch.side_effect = asyncio.TimeoutError
+
+        result = await mock_nats_mq_adapter.get_message_json(SUBSCRIPTION_NAME, self.subject, timeout=5, pop=False)
+
+        assert result is None
+
     async def test_get_messages_with_removing(self, mock_nats_mq_adapter, mock_fetch):
-        consumer_mock = Mock()
         mock_nats_mq_adapter.delete_message = AsyncMock()
-        mock_nats_mq_adapter._js.consumer_info = AsyncMock(return_value=consumer_mock)
 
         result = await mock_nats_mq_adapter.get_message(SUBSCRIPTION_NAME, self.subject, timeout=5, pop=True)
 
         mock_nats_mq_adapter._js.stream_info.assert_called_once_with(NatsKeys.stream(SUBSCRIPTION_NAME))
-        mock_nats_mq_adapter._js.consumer_info.assert_called_once_with(
-            NatsKeys.stream(SUBSCRIPTION_NAME), NatsKeys.durable_name(SUBSCRIPTION_NAME)
-        )
-        mock_nats_mq_adapter._js.pull_subscribe.assert_called_once_with(
-            self.subject,
-            durable=f"durable_name:{SUBSCRIPTION_NAME}",
+        mock_nats_mq_adapter._js.pull_subscribe_bind.assert_called_once_with(
+            durable=NatsKeys.subject_durable_name(self.subject),
             stream=NatsKeys.stream(SUBSCRIPTION_NAME),
-            config=consumer_mock,
         )
         mock_fetch.assert_called_once_with(1, 5)
         MSG.ack.assert_called_with()
         assert result == PROVISIONING_MESSAGE
 
+    async def test_get_messages_creates_filtered_consumer(self, mock_nats_mq_adapter, mock_fetch):
+        mock_nats_mq_adapter._js.consumer_info = AsyncMock(side_effect=NotFoundError)
+
+        result = await mock_nats_mq_adapter.get_message(SUBSCRIPTION_NAME, self.subject, timeout=5, pop=False)
+
+        mock_nats_mq_adapter._js.add_consumer.assert_called_once()
+        stream_name, consumer_config = mock_nats_mq_adapter._js.add_consumer.call_args.args
+        assert stream_name == NatsKeys.stream(SUBSCRIPTION_NAME)
+        assert consumer_config.durable_name == NatsKeys.subject_durable_name(self.subject)
+        assert consumer_config.filter_subject == self.subject
+        mock_fetch.assert_called_once_with(1, 5)
+        assert result == PROVISIONING_MESSAGE
+
+    async def test_get_messages_continues_unfiltered_consumer(self, mock_nats_mq_adapter, mock_fetch):
+        unfiltered_info = Mock()
+        unfiltered_info.delivered.stream_seq = 41
+        mock_nats_mq_adapter._js.consumer_info = AsyncMock(side_effect=[NotFoundError, NotFoundError, unfiltered_info])
+
+        await mock_nats_mq_adapter.get_message(SUBSCRIPTION_NAME, self.subject, timeout=5, pop=False)
+
+        mock_nats_mq_adapter._js.consumer_info.assert_called_with(
+            NatsKeys.stream(SUBSCRIPTION_NAME), NatsKeys.durable_name(SUBSCRIPTION_NAME)
+        )
+        consumer_config = mock_nats_mq_adapter._js.add_consumer.call_args.args[1]
+        assert consumer_config.filter_subject == self.subject
+        assert consumer_config.deliver_policy == DeliverPolicy.BY_START_SEQUENCE
+        assert consumer_config.opt_start_seq == 42
+
     async def test_get_messages_without_stream(self, mock_nats_mq_adapter, mock_fetch):
         mock_nats_mq_adapter._js.stream_info = AsyncMock(side_effect=NotFoundError)
         mock_nats_mq_adapter.delete_message = AsyncMock()
@@ -241,36 +393,102 @@ class TestNatsMQAdapter:
         result = await mock_nats_mq_adapter.get_message(SUBSCRIPTION_NAME, self.subject, timeout=5, pop=False)
 
         mock_nats_mq_adapter._js.stream_info.assert_called_once_with(NatsKeys.stream(SUBSCRIPTION_NAME))
-        mock_nats_mq_adapter._js.pull_subscribe.assert_not_called()
+        mock_nats_mq_adapter._js.pull_subscribe_bind.assert_not_called()
         mock_nats_mq_adapter._js.consumer_info.assert_not_called()
         mock_fetch.assert_not_called()
         mock_nats_mq_adapter.delete_message.assert_not_called()
         assert result is None
 
+    async def test_get_messages_sets_queue_depth(self, mock_nats_mq_adapter, mock_fetch):
+        msg = dataclasses.replace(MSG, _metadata=dataclasses.replace(MSG.metadata, num_pending=7))
+        mock_fetch.return_value = [msg]
+        labels = {"subscription": SUBSCRIPTION_NAME, "subject": self.subject}
+
+        await mock_nats_mq_adapter.get_message(SUBSCRIPTION_NAME, self.subject, timeout=5, pop=False)
+        assert REGISTRY.get_sample_value("provisioning_subscription_queue_depth", labels) == 7
+
+        mock_fetch.side_effect = asyncio.TimeoutError
+        await mock_nats_mq_adapter.get_message(SUBSCRIPTION_NAME, self.subject, timeout=5, pop=False)
+        assert REGISTRY.get_sample_value("provisioning_subscription_queue_depth", labels) == 0
+
+    async def test_get_messages_continues_trace(self, mock_nats_mq_adapter, mock_fetch, span_exporter):
+        mock_fetch.return_value = [dataclasses.replace(MSG, headers=TRACE_CONTEXT)]
+
+        result = await mock_nats_mq_adapter.get_message(SUBSCRIPTION_NAME, self.subject, timeout=5, pop=False)
+
+        [deliver_span] = span_exporter.get_finished_spans()
+        assert deliver_span.context.trace_id == TRACE_ID
+        assert deliver_span.parent.span_id == SPAN_ID
+        assert result.trace_context["traceparent"].startswith(
+            f"00-{TRACE_ID:032x}-{deliver_span.context.span_id:016x}-"
+        )
+
     async def test_get_messages_timeout_error(self, mock_nats_mq_adapter):
         sub = AsyncMock()
-        consumer_mock = Mock()
         sub.fetch = AsyncMock(side_effect=asyncio.TimeoutError)
-        mock_nats_mq_adapter._js.pull_subscribe = AsyncMock(return_value=sub)
+        mock_nats_mq_adapter._js.pull_subscribe_bind = AsyncMock(return_value=sub)
         mock_nats_mq_adapter.delete_message = AsyncMock()
-        mock_nats_mq_adapter._js.consumer_info = AsyncMock(return_value=consumer_mock)
 
         result = await mock_nats_mq_adapter.get_message(SUBSCRIPTION_NAME, self.subject, timeout=5, pop=False)
 
         mock_nats_mq_adapter._js.stream_info.assert_called_once_with(NatsKeys.stream(SUBSCRIPTION_NAME))
-        mock_nats_mq_adapter._js.consumer_info.assert_called_once_with(
-            NatsKeys.stream(SUBSCRIPTION_NAME), NatsKeys.durable_name(SUBSCRIPTION_NAME)
-        )
-        mock_nats_mq_adapter._js.pull_subscribe.assert_called_once_with(
-            self.subject,
-            durable=NatsKeys.durable_name(SUBSCRIPTION_NAME),
+        mock_nats_mq_adapter._js.pull_subscribe_bind.assert_called_once_with(
+            durable=NatsKeys.subject_durable_name(self.subject),
             stream=NatsKeys.stream(SUBSCRIPTION_NAME),
-            config=consumer_mock,
         )
         sub.fetch.assert_called_once_with(1, 5)
         mock_nats_mq_adapter.delete_message.assert_not_called()
         assert result is None
 
+    @pytest.mark.parametrize("subject,count", ((f"{SUBSCRIPTION_NAME}.main", 1), (f"{SUBSCRIPTION_NAME}.prefill", 0)))
+    async def test_get_subject_message_count(self, mock_nats_mq_adapter, subject, count):
+        result = await mock_nats_mq_adapter.get_subject_message_count(SUBSCRIPTION_NAME, subject)
+
+        mock_nats_mq_adapter._js.stream_info.assert_called_once_with(
+            NatsKeys.stream(SUBSCRIPTION_NAME), subjects_filter=subject
+        )
+        assert result == count
+
+    async def test_get_subject_message_count_without_stream(self, mock_nats_mq_adapter):
+        mock_nats_mq_adapter._js.stream_info = AsyncMock(side_effect=NotFoundError)
+
+        result = await mock_nats_mq_adapter.get_subject_message_count(SUBSCRIPTION_NAME, self.subject)
+
+        assert result == 0
+
+    async def test_get_stream_stats(self, mock_nats_mq_adapter):
+        result = await mock_nats_mq_adapter.get_stream_stats(SUBSCRIPTION_NAME)
+
+        mock_nats_mq_adapter._js.stream_info.assert_called_once_with(
+            NatsKeys.stream(SUBSCRIPTION_NAME), subjects_filter=">"
+        )
+        assert result.subject_messages == {f"{SUBSCRIPTION_NAME}.main": 1}
+        assert result.first_message_time == datetime(2023, 11, 9, 11, 15, 52, 616061, tzinfo=timezone.utc)
+        assert result.consumers == [
+            ConsumerState(subject=f"{SUBSCRIPTION_NAME}.main", num_pending=0, num_ack_pending=1, delivered=7),
+            ConsumerState(subject=f"{SUBSCRIPTION_NAME}.prefill", num_pending=0, num_ack_pending=0, delivered=3),
+        ]
+
+    async def test_get_stream_stats_empty_stream(self, mock_nats_mq_adapter):
+        mock_nats_mq_adapter._js.stream_info = AsyncMock(
+            return_value=dataclasses.replace(
+                STREAM_INFO, state=dataclasses.replace(STREAM_INFO.state, messages=0, subjects=None)
+            )
+        )
+
+        result = await mock_nats_mq_adapter.get_stream_stats(SUBSCRIPTION_NAME)
+
+        mock_nats_mq_adapter._nats.request.assert_not_called()
+        assert result.subject_messages == {}
+        assert result.first_message_time is None
+
+    async def test_get_stream_stats_without_stream(self, mock_nats_mq_adapter):
+        mock_nats_mq_adapter._js.stream_info = AsyncMock(side_effect=NotFoundError)
+
+        result = await mock_nats_mq_adapter.get_stream_stats(SUBSCRIPTION_NAME)
+
+        assert result is None
+
     async def test_delete_message(self, mock_nats_mq_adapter):
         result = await mock_nats_mq_adapter.delete_message(SUBSCRIPTION_NAME, 1)
 
@@ -289,6 +507,255 @@ class TestNatsMQAdapter:
         mock_nats_mq_adapter._js.get_msg.assert_called_once_with(NatsKeys.stream(SUBSCRIPTION_NAME), 1)
         mock_nats_mq_adapter._js.delete_msg.assert_not_called()
 
+    async def test_acknowledge_subscription_message(self, mock_nats_mq_adapter):
+        result = await mock_nats_mq_adapter.acknowledge_subscription_message(SUBSCRIPTION_NAME, 1, REPLY)
+
+        mock_nats_mq_adapter._nats.request.assert_called_once_with(REPLY, timeout=1.0)
+        mock_nats_mq_adapter._js.delete_msg.assert_not_called()
+        assert result is None
+
+    async def test_acknowledge_subscription_message_unknown_consumer(self, mock_nats_mq_adapter):
+        mock_nats_mq_adapter._nats.request = AsyncMock(side_effect=NoRespondersError)
+
+        with pytest.raises(ValueError, match="could not be acknowledged"):
+            await mock_nats_mq_adapter.acknowledge_subscription_message(SUBSCRIPTION_NAME, 1, REPLY)
+
+    @pytest.mark.parametrize(
+        "stream,seq_num",
+        (("other-subscription", 1), (SUBSCRIPTION_NAME, 2)),
+    )
+    async def test_acknowledge_subscription_message_foreign_token(self, mock_nats_mq_adapter, stream, seq_num):
+        with pytest.raises(ValueError, match="does not match"):
+            await mock_nats_mq_adapter.acknowledge_subscription_message(stream, seq_num, REPLY)
+
+        mock_nats_mq_adapter._nats.request.assert_not_called()
+
+    async def test_acknowledge_subscription_message_negatively(self, mock_nats_mq_adapter):
+        await mock_nats_mq_adapter.acknowledge_subscription_message_negatively(SUBSCRIPTION_NAME, 1, REPLY, 2)
+
+        mock_nats_mq_adapter._nats.publish.assert_called_once_with(REPLY, b'-NAK {"delay": 2000000000}')
+
+    async def test_acknowledge_subscription_message_in_progress(self, mock_nats_mq_adapter):
+        await mock_nats_mq_adapter.acknowledge_subscription_message_in_progress(SUBSCRIPTION_NAME, 1, REPLY)
+
+        mock_nats_mq_adapter._nats.publish.assert_called_once_with(REPLY, b"+WPI")
+
+    async def test_get_message_batch(self, mock_nats_mq_adapter):
+        mock_nats_mq_adapter.pull_subscription = AsyncMock()
+        mock_nats_mq_adapter.pull_subscription.fetch = AsyncMock(return_value=[MSG, MSG])
+
+        result = await mock_nats_mq_adapter.get_messages(10, timeout=5)
+
+        mock_nats_mq_adapter.pull_subscription.fetch.assert_called_once_with(10, timeout=5)
+        assert [message for message, _ in result] == [MQMESSAGE, MQMESSAGE]
+        assert result[0][1].acknowledge_message == MSG.ack
+
+    async def test_get_message_batch_empty(self, mock_nats_mq_adapter):
+        mock_nats_mq_adapter.pull_subscription = AsyncMock()
+        mock_nats_mq_adapter.pull_subscription.fetch = AsyncMock(side_effect=asyncio.TimeoutError)
+
+        with pytest.raises(Empty):
+            await mock_nats_mq_adapter.get_messages(10, timeout=5)
+
+    async def test_ensure_consumer_updates_max_ack_pending(self, mock_nats_mq_adapter):
+        current = ConsumerConfig(durable_name=NatsKeys.durable_name(SUBSCRIPTION_NAME), ack_wait=30, max_ack_pending=1)
+        mock_nats_mq_adapter._js.consumer_info = AsyncMock(return_value=Mock(config=current))
+
+        await mock_nats_mq_adapter.ensure_consumer(SUBSCRIPTION_NAME, max_ack_pending=10)
+
+        stream_name, consumer_config = mock_nats_mq_adapter._js.add_consumer.call_args.args
+        assert stream_name == NatsKeys.stream(SUBSCRIPTION_NAME)
+        assert consumer_config.durable_name == NatsKeys.durable_name(SUBSCRIPTION_NAME)
+        assert consumer_config.max_ack_pending == 10
+        assert consumer_config.ack_wait == 30
+
+    async def test_ensure_consumer_updates_ack_wait(self, mock_nats_mq_adapter):
+        subject = f"{SUBSCRIPTION_NAME}.main"
+        current = ConsumerConfig(
+            durable_name=NatsKeys.subject_durable_name(subject),
+            filter_subject=subject,
+            deliver_policy=DeliverPolicy.BY_START_SEQUENCE,
+            opt_start_seq=42,
+            ack_wait=30,
+            max_ack_pending=1,
+        )
+        mock_nats_mq_adapter._js.consumer_info = AsyncMock(return_value=Mock(config=current))
+
+        await mock_nats_mq_adapter.ensure_consumer(SUBSCRIPTION_NAME, filter_subject=subject, ack_wait=120)
+
+        consumer_config = mock_nats_mq_adapter._js.add_consumer.call_args.args[1]
+        assert consumer_config.ack_wait == 120
+        assert consumer_config.max_ack_pending == 1
+        # the deliver policy of an existing consumer cannot be changed
+        assert (consumer_config.deliver_policy, consumer_config.opt_start_seq) == (DeliverPolicy.BY_START_SEQUENCE, 42)
+
+    async def test_ensure_consumer_unchanged(self, mock_nats_mq_adapter):
+        current = ConsumerConfig(durable_name=NatsKeys.durable_name(SUBSCRIPTION_NAME), ack_wait=30, max_ack_pending=1)
+        mock_nats_mq_adapter._js.consumer_info = AsyncMock(return_value=Mock(config=current))
+
+        await mock_nats_mq_adapter.ensure_consumer(SUBSCRIPTION_NAME)
+        await mock_nats_mq_adapter.ensure_consumer(SUBSCRIPTION_NAME, ack_wait=30)
+
+        mock_nats_mq_adapter._js.add_consumer.assert_not_called()
+
+    async def test_ensure_subscription_stream_new(self, mock_nats_mq_adapter):
+        mock_nats_mq_adapter._js.stream_info = AsyncMock(side_effect=NotFoundError)
+        mock_nats_mq_adapter._js.consumer_info = AsyncMock(side_effect=NotFoundError)
+        subjects = [f"{SUBSCRIPTION_NAME}.main", f"{SUBSCRIPTION_NAME}.prefill"]
+
+        await mock_nats_mq_adapter.ensure_subscription_stream(SUBSCRIPTION_NAME, subjects, ack_wait=30)
+
+        stream_config = mock_nats_mq_adapter._js.add_stream.call_args.args[0]
+        assert stream_config.retention == RetentionPolicy.INTEREST
+        assert stream_config.subjects == subjects
+        consumer_configs = [c.args[1] for c in mock_nats_mq_adapter._js.add_consumer.call_args_list]
+        assert [c.filter_subject for c in consumer_configs] == subjects
+        assert all(c.ack_wait == 30 for c in consumer_configs)
+        mock_nats_mq_adapter._js.delete_consumer.assert_not_called()
+
+    async def test_ensure_subscription_stream_migration(self, mock_nats_mq_adapter):
+        mock_nats_mq_adapter._js.consumer_info = AsyncMock(side_effect=NotFoundError)
+        subjects = [f"{SUBSCRIPTION_NAME}.main", f"{SUBSCRIPTION_NAME}.prefill"]
+        manager = Mock()
+        manager.attach_mock(mock_nats_mq_adapter._js.add_consumer, "add_consumer")
+        manager.attach_mock(mock_nats_mq_adapter._js.delete_consumer, "delete_consumer")
+        manager.attach_mock(mock_nats_mq_adapter._js.update_stream, "update_stream")
+
+        await mock_nats_mq_adapter.ensure_subscription_stream(SUBSCRIPTION_NAME, subjects)
+
+        # the unfiltered consumer must only be removed after the subject consumers exist
+        assert [c[0] for c in manager.mock_calls] == [
+            "add_consumer",
+            "add_consumer",
+            "delete_consumer",
+            "update_stream",
+        ]
+        mock_nats_mq_adapter._js.delete_consumer.assert_called_once_with(
+            NatsKeys.stream(SUBSCRIPTION_NAME), NatsKeys.durable_name(SUBSCRIPTION_NAME)
+        )
+        assert mock_nats_mq_adapter._js.update_stream.call_args.args[0].retention == RetentionPolicy.INTEREST
+
+    async def test_ensure_stream_with_duplicate_window(self, mock_nats_mq_adapter):
+        mock_nats_mq_adapter._js.stream_info = AsyncMock(side_effect=NotFoundError)
+
+        await mock_nats_mq_adapter.ensure_stream(SUBSCRIPTION_NAME, False, duplicate_window=600)
+
+        assert mock_nats_mq_adapter._js.add_stream.call_args.args[0].duplicate_window == 600
+
+    async def test_ensure_stream_keeps_duplicate_window(self, mock_nats_mq_adapter):
+        mock_nats_mq_adapter._js.stream_info = AsyncMock(return_value=Mock(config=StreamConfig(duplicate_window=600)))
+
+        await mock_nats_mq_adapter.ensure_stream(SUBSCRIPTION_NAME, False)
+
+        assert mock_nats_mq_adapter._js.update_stream.call_args.args[0].duplicate_window == 600
+
+    async def test_ensure_stream_with_policy(self, mock_nats_mq_adapter):
+        mock_nats_mq_adapter._js.stream_info = AsyncMock(side_effect=NotFoundError)
+        policy = StreamPolicy(
+            storage="memory", replicas=3, max_bytes=1024, max_messages=10, max_age=60, compression=True, discard="new"
+        )
+
+        await mock_nats_mq_adapter.ensure_stream(SUBSCRIPTION_NAME, False, policy=policy)
+
+        config = mock_nats_mq_adapter._js.add_stream.call_args.args[0]
+        assert config.storage == StorageType.MEMORY
+        assert config.num_replicas == 3
+        assert (config.max_bytes, config.max_msgs, config.max_age) == (1024, 10, 60)
+        assert config.compression == StoreCompression.S2
+        assert config.discard == DiscardPolicy.NEW
+
+    async def test_ensure_stream_default_policy(self, mock_nats_mq_adapter):
+        mock_nats_mq_adapter._js.stream_info = AsyncMock(side_effect=NotFoundError)
+
+        await mock_nats_mq_adapter.ensure_stream(SUBSCRIPTION_NAME, False)
+
+        config = mock_nats_mq_adapter._js.add_stream.call_args.args[0]
+        assert config.storage == StorageType.FILE
+        assert config.num_replicas == 1
+        assert (config.max_bytes, config.max_msgs, config.max_age) == (-1, -1, 0)
+        assert config.compression == StoreCompression.NONE
+        assert config.discard == DiscardPolicy.OLD
+
+    async def test_ensure_stream_keeps_storage(self, mock_nats_mq_adapter):
+        mock_nats_mq_adapter._js.stream_info = AsyncMock(
+            return_value=Mock(config=StreamConfig(storage=StorageType.FILE))
+        )
+
+        await mock_nats_mq_adapter.ensure_stream(SUBSCRIPTION_NAME, False, policy=StreamPolicy(storage="memory"))
+
+        assert mock_nats_mq_adapter._js.update_stream.call_args.args[0].storage == StorageType.FILE
+
+    async def test_ensure_stream_unchanged(self, mock_nats_mq_adapter):
+        await mock_nats_mq_adapter.ensure_stream(SUBSCRIPTION_NAME, False)
+        config = mock_nats_mq_adapter._js.update_stream.call_args.args[0]
+        mock_nats_mq_adapter._js.update_stream.reset_mock()
+        mock_nats_mq_adapter.forget_stream(NatsKeys.stream(SUBSCRIPTION_NAME))
+        mock_nats_mq_adapter._js.stream_info = AsyncMock(
+            return_value=Mock(config=StreamConfig.from_response(config.as_dict()))
+        )
+
+        await mock_nats_mq_adapter.ensure_stream(SUBSCRIPTION_NAME, False)
+
+        mock_nats_mq_adapter._js.stream_info.assert_called_once()
+        mock_nats_mq_adapter._js.update_stream.assert_not_called()
+
+    async def test_ensure_stream_is_cached(self, mock_nats_mq_adapter):
+        mock_nats_mq_adapter._js.stream_info = AsyncMock(side_effect=NotFoundError)
+
+        await mock_nats_mq_adapter.ensure_stream(SUBSCRIPTION_NAME, False)
+        await mock_nats_mq_adapter.ensure_stream(SUBSCRIPTION_NAME, False)
+        await mock_nats_mq_adapter.ensure_stream(SUBSCRIPTION_NAME, False, duplicate_window=600)
+
+        assert mock_nats_mq_adapter._js.stream_info.call_count == 2
+        assert mock_nats_mq_adapter._js.add_stream.call_count == 2
+
+    async def test_ensure_stream_with_other_storage_is_not_cached(self, mock_nats_mq_adapter):
+        mock_nats_mq_adapter._js.stream_info = AsyncMock(
+            return_value=Mock(config=StreamConfig(storage=StorageType.FILE))
+        )
+
+        await mock_nats_mq_adapter.ensure_stream(SUBSCRIPTION_NAME, False, policy=StreamPolicy(storage="memory"))
+        await mock_nats_mq_adapter.ensure_stream(SUBSCRIPTION_NAME, False, policy=StreamPolicy(storage="memory"))
+
+        assert mock_nats_mq_adapter._js.stream_info.call_count == 2
+
+    async def test_ensure_consumer_cache_matches_server(self, mock_nats_mq_adapter):
+        await mock_nats_mq_adapter.ensure_consumer(SUBSCRIPTION_NAME, ack_wait=120)
+        await mock_nats_mq_adapter.ensure_consumer(SUBSCRIPTION_NAME, ack_wait=120)
+
+        mock_nats_mq_adapter._js.consumer_info.assert_called_once()
+        assert mock_nats_mq_adapter._js.add_consumer.call_args.args[1].ack_wait == 120
+
+    async def test_ensure_stream_after_delete_stream(self, mock_nats_mq_adapter):
+        mock_nats_mq_adapter._js.stream_info = AsyncMock(side_effect=NotFoundError)
+        await mock_nats_mq_adapter.ensure_stream(SUBSCRIPTION_NAME, False)
+        await mock_nats_mq_adapter.ensure_consumer(SUBSCRIPTION_NAME)
+
+        await mock_nats_mq_adapter.delete_stream(SUBSCRIPTION_NAME)
+        await mock_nats_mq_adapter.ensure_stream(SUBSCRIPTION_NAME, False)
+        await mock_nats_mq_adapter.ensure_consumer(SUBSCRIPTION_NAME)
+
+        assert mock_nats_mq_adapter._js.add_stream.call_count == 2
+        assert mock_nats_mq_adapter._js.consumer_info.call_count == 2
+
+    async def test_ensure_consumer_is_cached(self, mock_nats_mq_adapter):
+        mock_nats_mq_adapter._js.consumer_info = AsyncMock(side_effect=NotFoundError)
+
+        await mock_nats_mq_adapter.ensure_consumer(SUBSCRIPTION_NAME)
+        await mock_nats_mq_adapter.ensure_consumer(SUBSCRIPTION_NAME)
+        await mock_nats_mq_adapter.ensure_consumer(SUBSCRIPTION_NAME, max_ack_pending=10)
+
+        assert mock_nats_mq_adapter._js.consumer_info.call_count == 2
+
+    async def test_ensure_subscription_stream_migrates_once(self, mock_nats_mq_adapter):
+        subjects = [f"{SUBSCRIPTION_NAME}.main", f"{SUBSCRIPTION_NAME}.prefill"]
+
+        await mock_nats_mq_adapter.ensure_subscription_stream(SUBSCRIPTION_NAME, subjects)
+        await mock_nats_mq_adapter.ensure_subscription_stream(SUBSCRIPTION_NAME, subjects)
+
+        mock_nats_mq_adapter._js.delete_consumer.assert_called_once()
+        mock_nats_mq_adapter._js.update_stream.assert_called_once()
+
     async def test_delete_stream(self, mock_nats_mq_adapter):
         result = await mock_nats_mq_adapter.delete_stream(SUBSCRIPTION_NAME)
 
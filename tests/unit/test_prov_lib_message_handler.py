@@ -1,15 +1,28 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 
+import asyncio
+from datetime import datetime, timedelta, timezone
 from unittest.mock import AsyncMock, call, patch
 
 import aiohttp
 import pytest
 
 from univention.provisioning.consumer import MessageHandler, ProvisioningConsumerClient
-from univention.provisioning.models import Message
+from univention.provisioning.consumer.config import MessageHandlerSettings
+from univention.provisioning.models import Message, MessageProcessingStatus, PartitionLease, Subscription
 
-from ..mock_data import PROVISIONING_MESSAGE, SUBSCRIPTION_NAME
+from ..mock_data import (
+    PROVISIONING_MESSAGE,
+    REPLY,
+    SPAN_ID,
+    SUBSCRIPTION_INFO,
+    SUBSCRIPTION_NAME,
+    TRACE_CONTEXT,
+    TRACE_ID,
+)
+
+SUBSCRIPTION_INFO_PARTITIONED = {**SUBSCRIPTION_INFO, "partitions": 4}
 
 
 @pytest.fixture
@@ -41,9 +54,23 @@ class TestMessageHandler:
         ).run()
 
         async_client.get_subscription_message.assert_called_once_with(SUBSCRIPTION_NAME, timeout=10)
-        async_client.set_message_status.assert_called_once()
+        async_client.set_message_status.assert_called_once_with(
+            SUBSCRIPTION_NAME, PROVISIONING_MESSAGE.sequence_number, MessageProcessingStatus.ok, REPLY
+        )
         assert len(result) == 1
 
+    async def test_handle_message_continues_trace(self, async_client: ProvisioningConsumerClient, span_exporter):
+        message = PROVISIONING_MESSAGE.model_copy(update={"trace_context": TRACE_CONTEXT})
+        async_client.settings.provisioning_api_username = SUBSCRIPTION_NAME
+        handler = MessageHandler(async_client, [lambda message: self.callback([], message)])
+
+        await handler.handle_message(message)
+
+        [handle_span] = span_exporter.get_finished_spans()
+        assert handle_span.context.trace_id == TRACE_ID
+        assert handle_span.parent.span_id == SPAN_ID
+        assert handle_span.attributes["provisioning.subscription"] == SUBSCRIPTION_NAME
+
     async def test_get_multiple_message(self, async_client: ProvisioningConsumerClient):
         async_client.get_subscription_message = AsyncMock(
             side_effect=[
@@ -90,3 +117,169 @@ class TestMessageHandler:
         assert async_client.set_message_status.call_count == 4
         assert len(result) == 1
         assert mock_sleep.call_count == 3
+
+    async def test_partitioned(self, async_client: ProvisioningConsumerClient):
+        lease = PartitionLease(
+            partition=2, lease_id="lease", expires=datetime.now(timezone.utc) + timedelta(seconds=30)
+        )
+        async_client.lease_partition = AsyncMock(return_value=lease)
+        async_client.release_partition = AsyncMock()
+        async_client.get_subscription_message = AsyncMock(side_effect=[None, PROVISIONING_MESSAGE])
+        async_client.set_message_status = AsyncMock()
+        result = []
+
+        async_client.settings.provisioning_api_username = SUBSCRIPTION_NAME
+        await MessageHandler(
+            async_client,
+            [lambda message: self.callback(result, message)],
+            settings=MessageHandlerSettings(max_acknowledgement_retries=3, partitioned=True),
+            message_limit=1,
+        ).run()
+
+        async_client.lease_partition.assert_called_once_with(SUBSCRIPTION_NAME, None)
+        async_client.get_subscription_message.assert_has_calls(
+            [
+                call(SUBSCRIPTION_NAME, timeout=10, partition=2, lease_id="lease"),
+                call(SUBSCRIPTION_NAME, timeout=10, partition=2, lease_id="lease"),
+            ]
+        )
+        async_client.release_partition.assert_called_once_with(SUBSCRIPTION_NAME, "lease")
+        assert len(result) == 1
+
+    async def test_partitioned_renews_lease(self, async_client: ProvisioningConsumerClient):
+        expiring = PartitionLease(partition=1, lease_id="lease", expires=datetime.now(timezone.utc))
+        renewed = PartitionLease(
+            partition=1, lease_id="lease", expires=datetime.now(timezone.utc) + timedelta(seconds=30)
+        )
+        async_client.lease_partition = AsyncMock(side_effect=[expiring, renewed])
+        async_client.release_partition = AsyncMock()
+        async_client.get_subscription_message = AsyncMock(side_effect=[None, PROVISIONING_MESSAGE])
+        async_client.set_message_status = AsyncMock()
+
+        async_client.settings.provisioning_api_username = SUBSCRIPTION_NAME
+        await MessageHandler(
+            async_client,
+            [AsyncMock()],
+            settings=MessageHandlerSettings(max_acknowledgement_retries=3, partitioned=True),
+            message_limit=1,
+        ).run()
+
+        async_client.lease_partition.assert_has_calls([call(SUBSCRIPTION_NAME, None), call(SUBSCRIPTION_NAME, "lease")])
+
+    async def test_prefetching(self, async_client: ProvisioningConsumerClient):
+        messages = [PROVISIONING_MESSAGE.model_copy(update={"sequence_number": i}) for i in range(1, 6)]
+        async_client.get_subscription_message = AsyncMock(side_effect=[messages[0], None, *messages[1:]])
+        async_client.set_message_status = AsyncMock()
+        result = []
+
+        async_client.settings.provisioning_api_username = SUBSCRIPTION_NAME
+        await MessageHandler(
+            async_client,
+            [lambda message: self.callback(result, message)],
+            settings=MessageHandlerSettings(max_acknowledgement_retries=3, prefetch_count=2),
+            message_limit=5,
+        ).run()
+
+        assert result == messages
+        async_client.set_message_status.assert_has_calls(
+            [
+                call(SUBSCRIPTION_NAME, message.sequence_number, MessageProcessingStatus.ok, REPLY)
+                for message in messages
+            ]
+        )
+
+    @staticmethod
+    async def slow_acknowledgement(*args):
+        await asyncio.sleep(0.01)
+
+    async def test_prefetching_error(self, async_client: ProvisioningConsumerClient):
+        messages = [PROVISIONING_MESSAGE.model_copy(update={"sequence_number": i}) for i in range(1, 4)]
+        async_client.get_subscription_message = AsyncMock(
+            side_effect=[*messages, aiohttp.ClientConnectionError("connection lost")]
+        )
+        async_client.set_message_status = AsyncMock(side_effect=self.slow_acknowledgement)
+        result = []
+
+        async_client.settings.provisioning_api_username = SUBSCRIPTION_NAME
+        with pytest.raises(aiohttp.ClientConnectionError, match="connection lost"):
+            await MessageHandler(
+                async_client,
+                [lambda message: self.callback(result, message)],
+                settings=MessageHandlerSettings(max_acknowledgement_retries=3, prefetch_count=2),
+            ).run()
+
+        assert result == messages
+        assert async_client.set_message_status.call_args_list == [
+            call(SUBSCRIPTION_NAME, message.sequence_number, MessageProcessingStatus.ok, REPLY) for message in messages
+        ]
+
+    async def test_prefetching_callback_error(self, async_client: ProvisioningConsumerClient):
+        messages = [PROVISIONING_MESSAGE.model_copy(update={"sequence_number": i}) for i in range(1, 4)]
+        async_client.get_subscription_message = AsyncMock(side_effect=messages)
+        async_client.set_message_status = AsyncMock(side_effect=self.slow_acknowledgement)
+
+        async def callback(message: Message):
+            if message.sequence_number == 3:
+                raise ValueError("callback failed")
+
+        async_client.settings.provisioning_api_username = SUBSCRIPTION_NAME
+        with pytest.raises(ValueError, match="callback failed"):
+            await MessageHandler(
+                async_client,
+                [callback],
+                settings=MessageHandlerSettings(max_acknowledgement_retries=3, prefetch_count=2),
+            ).run()
+
+        assert async_client.set_message_status.call_args_list == [
+            call(SUBSCRIPTION_NAME, message.sequence_number, MessageProcessingStatus.ok, REPLY)
+            for message in messages[:2]
+        ]
+
+    async def test_workers(self, async_client: ProvisioningConsumerClient):
+        expires = datetime.now(timezone.utc) + timedelta(seconds=30)
+        async_client.get_subscription = AsyncMock(
+            return_value=Subscription.model_validate(SUBSCRIPTION_INFO_PARTITIONED)
+        )
+        async_client.lease_partition = AsyncMock(
+            side_effect=[PartitionLease(partition=i, lease_id=f"lease{i}", expires=expires) for i in range(3)]
+        )
+        async_client.release_partition = AsyncMock()
+        async_client.get_subscription_message = AsyncMock(return_value=PROVISIONING_MESSAGE)
+        async_client.set_message_status = AsyncMock()
+        barrier = asyncio.Barrier(3)
+
+        async def callback(message: Message):
+            # only returns when all three workers handle a message at the same time
+            await asyncio.wait_for(barrier.wait(), 1)
+
+        async_client.settings.provisioning_api_username = SUBSCRIPTION_NAME
+        await MessageHandler(
+            async_client,
+            [callback],
+            settings=MessageHandlerSettings(max_acknowledgement_retries=3, workers=3),
+            message_limit=1,
+        ).run()
+
+        assert sorted(c.kwargs["partition"] for c in async_client.get_subscription_message.call_args_list) == [0, 1, 2]
+        assert async_client.set_message_status.call_count == 3
+        async_client.release_partition.assert_has_calls(
+            [call(SUBSCRIPTION_NAME, f"lease{i}") for i in range(3)], any_order=True
+        )
+
+    async def test_workers_unpartitioned_subscription(self, async_client: ProvisioningConsumerClient):
+        async_client.get_subscription = AsyncMock(return_value=Subscription.model_validate(SUBSCRIPTION_INFO))
+        async_client.lease_partition = AsyncMock()
+        async_client.get_subscription_message = AsyncMock(return_value=PROVISIONING_MESSAGE)
+        async_client.set_message_status = AsyncMock()
+        result = []
+
+        async_client.settings.provisioning_api_username = SUBSCRIPTION_NAME
+        await MessageHandler(
+            async_client,
+            [lambda message: self.callback(result, message)],
+            settings=MessageHandlerSettings(max_acknowledgement_retries=3, workers=3),
+            message_limit=2,
+        ).run()
+
+        async_client.lease_partition.assert_not_called()
+        assert len(result) == 2
@@ -1,15 +1,19 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # SPDX-FileCopyrightText: 2024 Univention GmbH
 
+import time
 from copy import deepcopy
+from datetime import datetime, timedelta, timezone
+from typing import Optional
 from unittest.mock import AsyncMock, call
 
 import pytest
 from fastapi import HTTPException
 
+from server.adapters.nats_adapter import ConsumerState, StreamStats, UpdateConflict
 from server.services.subscriptions import SubscriptionService
 from univention.provisioning.models import FillQueueStatus, NewSubscription, RealmTopic
-from univention.provisioning.models.subscription import Bucket, Subscription
+from univention.provisioning.models.subscription import Bucket, Subscription, SubscriptionStats
 
 from ..mock_data import (
     CONSUMER_HASHED_PASSWORD,
@@ -101,13 +105,13 @@ class TestSubscriptionService:
     async def test_add_subscription(self, sub_service: SubscriptionService):
         sub_service._port.get_dict_value = AsyncMock(return_value=None)
         sub_service._port.get_list_value = AsyncMock(return_value=[])
-        sub_service._port.ensure_stream = AsyncMock()
-        sub_service._port.ensure_consumer = AsyncMock()
-
         await sub_service.register_subscription(self.new_subscription)
 
         sub_service._port.get_dict_value.assert_called_once_with(SUBSCRIPTION_NAME, Bucket.subscriptions)
         assert sub_service._port.put_value.call_count == 2  # credentials, subscription
+        sub_service._port.ensure_subscription_stream.assert_called_once_with(
+            SUBSCRIPTION_NAME, [f"{SUBSCRIPTION_NAME}.main", f"{SUBSCRIPTION_NAME}.prefill"]
+        )
 
     async def test_get_subscription_not_found(self, sub_service):
         sub_service._port.get_dict_value = AsyncMock(return_value=None)
@@ -173,5 +177,299 @@ class TestSubscriptionService:
             [
                 call(SUBSCRIPTION_NAME, Bucket.credentials),
                 call(SUBSCRIPTION_NAME, Bucket.subscriptions),
+                call(SUBSCRIPTION_NAME, Bucket.partition_leases),
             ]
         )
+
+    async def test_add_partitioned_subscription(self, sub_service: SubscriptionService):
+        sub_service._port.get_dict_value = AsyncMock(return_value=None)
+        new_sub = deepcopy(self.new_subscription)
+        new_sub.partitions = 3
+
+        await sub_service.register_subscription(new_sub)
+
+        sub_service._port.ensure_subscription_stream.assert_called_once_with(
+            SUBSCRIPTION_NAME,
+            [
+                f"{SUBSCRIPTION_NAME}.main.0",
+                f"{SUBSCRIPTION_NAME}.main.1",
+                f"{SUBSCRIPTION_NAME}.main.2",
+                f"{SUBSCRIPTION_NAME}.prefill",
+            ],
+        )
+
+
+@pytest.mark.anyio
+class TestPartitionLeases:
+    @pytest.fixture(autouse=True)
+    def partitioned_subscription(self, sub_service: SubscriptionService):
+        sub_service._port.get_dict_value = AsyncMock(return_value={**SUBSCRIPTION_INFO, "partitions": 3})
+        SubscriptionService._leases_cache.clear()
+        yield
+        SubscriptionService._leases_cache.clear()
+
+    @staticmethod
+    def leases(*lease_ids: str, expires: float = None) -> dict:
+        expires = time.time() + 30 if expires is None else expires
+        return {str(p): {"lease_id": lease_id, "expires": expires} for p, lease_id in enumerate(lease_ids)}
+
+    async def test_lease_first_partition(self, sub_service: SubscriptionService):
+        sub_service._port.get_dict_value_with_revision = AsyncMock(return_value=None)
+
+        lease = await sub_service.lease_partition(SUBSCRIPTION_NAME, 30)
+
+        assert lease.partition == 0
+        stored = sub_service._port.put_value.call_args.args
+        assert stored[1] == {"0": {"lease_id": lease.lease_id, "expires": pytest.approx(lease.expires.timestamp())}}
+        assert stored[2:] == (Bucket.partition_leases, 0)
+
+    async def test_lease_free_partition(self, sub_service: SubscriptionService):
+        sub_service._port.get_dict_value_with_revision = AsyncMock(return_value=(self.leases("a", "b"), 7))
+
+        lease = await sub_service.lease_partition(SUBSCRIPTION_NAME, 30)
+
+        assert lease.partition == 2
+        leases = sub_service._port.put_value.call_args.args[1]
+        assert set(leases) == {"0", "1", "2"}
+        assert sub_service._port.put_value.call_args.args[3] == 7
+
+    async def test_lease_expired_partition(self, sub_service: SubscriptionService):
+        sub_service._port.get_dict_value_with_revision = AsyncMock(
+            return_value=(self.leases("a", "b", "c", expires=time.time() - 1), 7)
+        )
+
+        lease = await sub_service.lease_partition(SUBSCRIPTION_NAME, 30)
+
+        assert lease.partition == 0
+
+    async def test_renew_lease(self, sub_service: SubscriptionService):
+        sub_service._port.get_dict_value_with_revision = AsyncMock(return_value=(self.leases("a", "b", "c"), 7))
+
+        lease = await sub_service.lease_partition(SUBSCRIPTION_NAME, 30, "b")
+
+        assert lease.partition == 1
+        assert lease.lease_id == "b"
+
+    async def test_renew_expired_lease_keeps_partition(self, sub_service: SubscriptionService):
+        leases = self.leases("a", "b")
+        leases["1"]["expires"] = time.time() - 1
+        sub_service._port.get_dict_value_with_revision = AsyncMock(return_value=(leases, 7))
+
+        lease = await sub_service.lease_partition(SUBSCRIPTION_NAME, 30, "b")
+
+        assert lease.partition == 1
+
+    async def test_all_partitions_leased(self, sub_service: SubscriptionService):
+        sub_service._port.get_dict_value_with_revision = AsyncMock(return_value=(self.leases("a", "b", "c"), 7))
+
+        with pytest.raises(HTTPException) as exc_info:
+            await sub_service.lease_partition(SUBSCRIPTION_NAME, 30)
+
+        assert exc_info.value.status_code == 409
+        sub_service._port.put_value.assert_not_called()
+
+    async def test_lease_retries_on_concurrent_change(self, sub_service: SubscriptionService):
+        sub_service._port.get_dict_value_with_revision = AsyncMock(
+            side_effect=[(self.leases("a"), 7), (self.leases("a", "b"), 8)]
+        )
+        sub_service._port.put_value = AsyncMock(side_effect=[UpdateConflict, None])
+
+        lease = await sub_service.lease_partition(SUBSCRIPTION_NAME, 30)
+
+        assert lease.partition == 2
+        assert sub_service._port.put_value.call_count == 2
+
+    async def test_release_lease(self, sub_service: SubscriptionService):
+        sub_service._port.get_dict_value_with_revision = AsyncMock(return_value=(self.leases("a", "b"), 7))
+
+        await sub_service.release_partition(SUBSCRIPTION_NAME, "b")
+
+        leases = self.leases("a", "b")
+        leases["1"]["expires"] = 0
+        stored = sub_service._port.put_value.call_args.args
+        assert stored[1]["1"] == leases["1"]
+        assert stored[1]["0"]["lease_id"] == "a"
+        assert stored[2:] == (Bucket.partition_leases, 7)
+
+    async def test_lease_unpartitioned_subscription(self, sub_service: SubscriptionService):
+        sub_service._port.get_dict_value = AsyncMock(return_value=SUBSCRIPTION_INFO)
+
+        with pytest.raises(HTTPException) as exc_info:
+            await sub_service.lease_partition(SUBSCRIPTION_NAME, 30)
+
+        assert exc_info.value.status_code == 422
+        sub_service._port.put_value.assert_not_called()
+
+    @pytest.mark.parametrize(
+        "partition,lease_id,expected",
+        [(1, "b", True), (1, "a", False), (1, None, False), (2, "c", False)],
+    )
+    async def test_is_partition_leased(self, sub_service: SubscriptionService, partition, lease_id, expected):
+        sub_service._port.get_dict_value = AsyncMock(return_value=self.leases("a", "b"))
+
+        assert await sub_service.is_partition_leased(SUBSCRIPTION_NAME, partition, lease_id) is expected
+
+    async def test_is_expired_partition_leased(self, sub_service: SubscriptionService):
+        sub_service._port.get_dict_value = AsyncMock(return_value=self.leases("a", expires=time.time() - 1))
+
+        assert await sub_service.is_partition_leased(SUBSCRIPTION_NAME, 0, "a") is False
+
+    async def test_is_partition_leased_is_cached(self, sub_service: SubscriptionService):
+        sub_service._port.get_dict_value = AsyncMock(return_value=self.leases("a", "b"))
+
+        assert await sub_service.is_partition_leased(SUBSCRIPTION_NAME, 1, "b") is True
+        assert await sub_service.is_partition_leased(SUBSCRIPTION_NAME, 1, "b") is True
+
+        sub_service._port.get_dict_value.assert_called_once_with(SUBSCRIPTION_NAME, Bucket.partition_leases)
+
+    async def test_cached_lease_expires(self, sub_service: SubscriptionService):
+        sub_service._port.get_dict_value = AsyncMock(return_value=self.leases("a", expires=time.time() + 0.05))
+
+        assert await sub_service.is_partition_leased(SUBSCRIPTION_NAME, 0, "a") is True
+        time.sleep(0.06)
+
+        assert await sub_service.is_partition_leased(SUBSCRIPTION_NAME, 0, "a") is False
+
+    async def test_released_lease_is_not_cached(self, sub_service: SubscriptionService):
+        sub_service._port.get_dict_value = AsyncMock(return_value=self.leases("a", "b"))
+        assert await sub_service.is_partition_leased(SUBSCRIPTION_NAME, 1, "b") is True
+        released = self.leases("a", "b")
+        released["1"]["expires"] = 0
+        sub_service._port.get_dict_value_with_revision = AsyncMock(return_value=(self.leases("a", "b"), 7))
+        sub_service._port.get_dict_value = AsyncMock(return_value=released)
+
+        await sub_service.release_partition(SUBSCRIPTION_NAME, "b")
+
+        assert await sub_service.is_partition_leased(SUBSCRIPTION_NAME, 1, "b") is False
+
+
+@pytest.mark.anyio
+class TestSubscriptionPartitions:
+    @pytest.fixture(autouse=True)
+    def clear_partitions(self):
+        SubscriptionService._partitions_cache.clear()
+        yield
+        SubscriptionService._partitions_cache.clear()
+
+    async def test_get_subscription_partitions_is_cached(self, sub_service: SubscriptionService):
+        sub_service._port.get_dict_value = AsyncMock(return_value={**SUBSCRIPTION_INFO, "partitions": 3})
+
+        assert await sub_service.get_subscription_partitions(SUBSCRIPTION_NAME) == 3
+        assert await sub_service.get_subscription_partitions(SUBSCRIPTION_NAME) == 3
+
+        sub_service._port.get_dict_value.assert_called_once_with(SUBSCRIPTION_NAME, Bucket.subscriptions)
+
+    async def test_delete_subscription_forgets_partitions(self, sub_service: SubscriptionService):
+        sub_service._port.get_dict_value = AsyncMock(return_value=SUBSCRIPTION_INFO)
+        sub_service._port.get_list_value = AsyncMock(return_value=[SUBSCRIPTION_NAME])
+        SubscriptionService._partitions_cache[SUBSCRIPTION_NAME] = 3
+
+        await sub_service.delete_subscription(SUBSCRIPTION_NAME)
+
+        assert SUBSCRIPTION_NAME not in SubscriptionService._partitions_cache
+
+    async def test_register_subscription_forgets_partitions(self, sub_service: SubscriptionService):
+        sub_service._port.get_dict_value = AsyncMock(return_value=None)
+        SubscriptionService._partitions_cache[SUBSCRIPTION_NAME] = 1
+        new_sub = NewSubscription(
+            name=SUBSCRIPTION_NAME,
+            realms_topics=GROUPS_REALMS_TOPICS,
+            request_prefill=True,
+            password="password",
+            partitions=3,
+        )
+
+        await sub_service.register_subscription(new_sub)
+
+        assert SUBSCRIPTION_NAME not in SubscriptionService._partitions_cache
+
+
+@pytest.mark.anyio
+class TestSubscriptionStats:
+    @pytest.fixture(autouse=True)
+    def clear_stats(self):
+        SubscriptionService._stats_cache.clear()
+        SubscriptionService._delivery_samples.clear()
+        yield
+        SubscriptionService._stats_cache.clear()
+        SubscriptionService._delivery_samples.clear()
+
+    @staticmethod
+    def stream_stats(delivered: int, first_message_time: Optional[datetime] = None) -> StreamStats:
+        return StreamStats(
+            subject_messages={f"{SUBSCRIPTION_NAME}.main": 3, f"{SUBSCRIPTION_NAME}.prefill": 2},
+            first_message_time=first_message_time,
+            consumers=[
+                ConsumerState(
+                    subject=f"{SUBSCRIPTION_NAME}.main", num_pending=2, num_ack_pending=1, delivered=delivered
+                ),
+                ConsumerState(subject=f"{SUBSCRIPTION_NAME}.prefill", num_pending=2, num_ack_pending=0, delivered=0),
+            ],
+        )
+
+    async def test_get_subscription_stats(self, sub_service: SubscriptionService):
+        first_message_time = datetime.now(timezone.utc) - timedelta(seconds=60)
+        sub_service._port.get_stream_stats = AsyncMock(return_value=self.stream_stats(10, first_message_time))
+
+        stats = await sub_service.get_subscription_stats(SUBSCRIPTION_NAME)
+
+        sub_service._port.get_stream_stats.assert_called_once_with(SUBSCRIPTION_NAME)
+        assert stats.pending_messages == 4
+        assert stats.unacknowledged_messages == 1
+        assert stats.prefill_backlog == 2
+        assert stats.main_backlog == 3
+        assert 60 <= stats.oldest_message_age < 70
+        assert stats.delivery_rate is None
+
+    async def test_get_subscription_stats_delivery_rate(self, sub_service: SubscriptionService):
+        sub_service._port.get_stream_stats = AsyncMock(side_effect=[self.stream_stats(10), self.stream_stats(30)])
+        SubscriptionService._delivery_samples[SUBSCRIPTION_NAME] = (0, time.monotonic() - 10)
+
+        first = await sub_service.get_subscription_stats(SUBSCRIPTION_NAME)
+        second = await sub_service.get_subscription_stats(SUBSCRIPTION_NAME)
+
+        assert 0.9 < first.delivery_rate <= 1.0
+        assert second.delivery_rate > first.delivery_rate
+
+    async def test_get_subscription_stats_recreated_consumers(self, sub_service: SubscriptionService):
+        sub_service._port.get_stream_stats = AsyncMock(return_value=self.stream_stats(5))
+        SubscriptionService._delivery_samples[SUBSCRIPTION_NAME] = (100, time.monotonic() - 10)
+
+        stats = await sub_service.get_subscription_stats(SUBSCRIPTION_NAME)
+
+        assert stats.delivery_rate is None
+
+    async def test_get_subscription_stats_without_stream(self, sub_service: SubscriptionService):
+        sub_service._port.get_stream_stats = AsyncMock(return_value=None)
+
+        stats = await sub_service.get_subscription_stats(SUBSCRIPTION_NAME)
+
+        assert stats == SubscriptionStats(
+            name=SUBSCRIPTION_NAME,
+            pending_messages=0,
+            unacknowledged_messages=0,
+            prefill_backlog=0,
+            main_backlog=0,
+            oldest_message_age=None,
+            delivery_rate=None,
+        )
+
+    async def test_get_subscriptions_stats_is_cached(self, sub_service: SubscriptionService):
+        sub_service._port.get_bucket_keys = AsyncMock(return_value=[SUBSCRIPTION_NAME])
+        sub_service._port.get_stream_stats = AsyncMock(return_value=self.stream_stats(10))
+
+        first = await sub_service.get_subscriptions_stats()
+        second = await sub_service.get_subscriptions_stats()
+
+        assert [stats.name for stats in first] == [SUBSCRIPTION_NAME]
+        assert second is first
+        sub_service._port.get_stream_stats.assert_called_once_with(SUBSCRIPTION_NAME)
+
+    async def test_get_subscriptions_stats_forgets_deleted_subscriptions(self, sub_service: SubscriptionService):
+        sub_service._port.get_bucket_keys = AsyncMock(return_value=[SUBSCRIPTION_NAME])
+        sub_service._port.get_stream_stats = AsyncMock(return_value=self.stream_stats(10))
+        SubscriptionService._delivery_samples["deleted"] = (10, time.monotonic())
+
+        await sub_service.get_subscriptions_stats()
+
+        assert list(SubscriptionService._delivery_samples) == [SUBSCRIPTION_NAME]
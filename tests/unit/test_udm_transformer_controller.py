@@ -0,0 +1,87 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# SPDX-FileCopyrightText: 2024 Univention GmbH
+
+import importlib
+from datetime import datetime
+from unittest.mock import AsyncMock
+
+import pytest
+from opentelemetry.context import Context
+
+from univention.provisioning.models import Bucket, Message
+
+from ..mocks import udm_modules_mock, udm_transformer_port_mock
+from .test_udm_transformer_service import ldap_entry, ldap_to_udm
+
+
+@pytest.fixture(scope="module")
+def controller_module():
+    """The module `udm_transformer.controller`, imported with mocked UDM and LDAP modules"""
+    with udm_modules_mock():
+        yield importlib.import_module("udm_transformer.controller")
+
+
+@pytest.fixture
+def controller(controller_module):
+    controller = controller_module.UDMTransformerController(udm_transformer_port_mock(cache_size=10))
+    controller._udm_service.ldap_to_udm = ldap_to_udm
+    yield controller
+    controller._udm_service._executor.shutdown()
+
+
+def ldap_message(new: dict, old: dict) -> tuple[Message, AsyncMock, None, Context]:
+    message = Message(
+        publisher_name="udm-listener",
+        ts=datetime.now(),
+        realm="ldap",
+        topic="ldap",
+        body={"new": new, "old": old},
+    )
+    return message, AsyncMock(), None, Context()
+
+
+@pytest.mark.anyio
+class TestUDMTransformerController:
+    async def test_handle_messages(self, controller):
+        messages = [ldap_message(ldap_entry("a"), {}), ldap_message(ldap_entry("b"), {})]
+
+        await controller.handle_messages(messages)
+
+        assert controller._port.send_event.call_count == 2
+        assert [c.args for c in controller._port.store.call_args_list] == [
+            ("a", ldap_to_udm(ldap_entry("a")), Bucket.cache),
+            ("b", ldap_to_udm(ldap_entry("b")), Bucket.cache),
+        ]
+        for _, acks, _, _ in messages:
+            acks.acknowledge_message.assert_called_once()
+
+    async def test_handle_messages_stores_only_published_objects(self, controller):
+        messages = [
+            ldap_message(ldap_entry("a", "1"), {}),
+            ldap_message(ldap_entry("a", "2"), ldap_entry("a", "1")),
+            ldap_message(ldap_entry("b"), {}),
+        ]
+        controller._port.send_event.side_effect = [None, Exception("publishing failed"), None]
+
+        with pytest.raises(Exception):
+            await controller.handle_messages(messages)
+
+        controller._port.store.assert_called_once_with("a", ldap_to_udm(ldap_entry("a", "1")), Bucket.cache)
+        messages[0][1].acknowledge_message.assert_called_once()
+        for _, acks, _, _ in messages[1:]:
+            acks.acknowledge_message_negatively.assert_called_once()
+            acks.acknowledge_message.assert_not_called()
+
+    async def test_redelivered_message_is_transformed_against_stored_object(self, controller):
+        controller._port.send_event.side_effect = [None, Exception("publishing failed")]
+        with pytest.raises(Exception):
+            await controller.handle_messages(
+                [ldap_message(ldap_entry("a", "1"), {}), ldap_message(ldap_entry("a", "2"), ldap_entry("a", "1"))]
+            )
+        controller._port.send_event.side_effect = None
+
+        await controller.handle_messages([ldap_message(ldap_entry("a", "2"), ldap_entry("a", "1"))])
+
+        body = controller._port.send_event.call_args.args[0].body
+        assert body.old == ldap_to_udm(ldap_entry("a", "1"))
+        assert body.new == ldap_to_udm(ldap_entry("a", "2"))
@@ -0,0 +1,33 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# SPDX-FileCopyrightText: 2024 Univention GmbH
+
+import json
+
+import pytest
+
+from udm_transformer.port import COMPACT_CACHE_ENTRY_PREFIX, cache_entry_decoder, cache_entry_encoder
+
+from ..mock_data import USER_OBJECT
+
+
+@pytest.mark.parametrize("compact", [True, False])
+def test_cache_entry_round_trip(compact: bool):
+    assert cache_entry_decoder(cache_entry_encoder(USER_OBJECT, compact)) == USER_OBJECT
+
+
+def test_compact_cache_entry_has_prefix():
+    data = cache_entry_encoder(USER_OBJECT)
+
+    assert data.startswith(COMPACT_CACHE_ENTRY_PREFIX)
+    assert len(data) < len(json.dumps(USER_OBJECT))
+
+
+def test_json_cache_entry_has_no_prefix():
+    data = cache_entry_encoder(USER_OBJECT, compact=False)
+
+    assert not data.startswith(COMPACT_CACHE_ENTRY_PREFIX)
+    assert json.loads(data) == USER_OBJECT
+
+
+def test_decode_legacy_cache_entry():
+    assert cache_entry_decoder(json.dumps(USER_OBJECT).encode("utf-8")) == USER_OBJECT
@@ -0,0 +1,300 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+# SPDX-FileCopyrightText: 2024 Univention GmbH
+
+import asyncio
+import importlib
+import threading
+import time
+from typing import Optional
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from univention.provisioning.models import Bucket
+
+from ..mocks import FakeLDAPAccess, udm_modules_mock, udm_transformer_port_mock
+
+
+@pytest.fixture(scope="module")
+def udm():
+    """The module `udm_transformer.service.udm`, imported with mocked UDM and LDAP modules"""
+    with udm_modules_mock():
+        yield importlib.import_module("udm_transformer.service.udm")
+
+
+@pytest.fixture
+def udm_service(udm):
+    service = udm.UDMMessagingService(udm_transformer_port_mock())
+    service.ldap_to_udm = ldap_to_udm
+    yield service
+    service._executor.shutdown()
+
+
+def ldap_entry(uuid: str, description: str = "", object_type: str = "users/user") -> dict:
+    return {
+        "entryUUID": [uuid.encode()],
+        "entryDN": [f"uid={uuid},dc=univention-organization,dc=intranet".encode()],
+        "univentionObjectType": [object_type.encode()],
+        "description": [description.encode()],
+    }
+
+
+def ldap_to_udm(entry: dict, lo=None, position=None) -> Optional[dict]:
+    """Transformation of LDAP objects in place of UDM"""
+    return {
+        "uuid": entry["entryUUID"][0].decode(),
+        "dn": entry["entryDN"][0].decode(),
+        "objectType": entry["univentionObjectType"][0].decode(),
+        "properties": {"description": entry["description"][0].decode()},
+    }
+
+
+@pytest.mark.anyio
+class TestTransformBatch:
+    async def test_transform_batch_does_not_store(self, udm_service):
+        old = ldap_to_udm(ldap_entry("a"))
+        udm_service._messaging_port.retrieve.return_value = old
+
+        result = await udm_service.transform_batch(
+            [(ldap_entry("a", "1"), ldap_entry("a")), (ldap_entry("b", "1"), None)]
+        )
+
+        assert result == [(ldap_to_udm(ldap_entry("a", "1")), old), (ldap_to_udm(ldap_entry("b", "1")), {})]
+        udm_service._messaging_port.store.assert_not_called()
+
+    async def test_transform_batch_takes_old_objects_from_earlier_changes(self, udm_service):
+        result = await udm_service.transform_batch(
+            [(ldap_entry("a", "1"), None), (ldap_entry("a", "2"), ldap_entry("a", "1"))]
+        )
+
+        assert result[1] == (ldap_to_udm(ldap_entry("a", "2")), ldap_to_udm(ldap_entry("a", "1")))
+        udm_service._messaging_port.retrieve.assert_not_called()
+
+    async def test_transform_changes_stores(self, udm_service):
+        new, old = await udm_service.transform_changes(ldap_entry("a", "1"), None)
+
+        assert new == ldap_to_udm(ldap_entry("a", "1"))
+        assert old == {}
+        udm_service._messaging_port.store.assert_called_once_with("a", new, Bucket.cache)
+
+
+@pytest.fixture
+def pooled_udm_service(udm):
+    service = udm.UDMMessagingService(udm_transformer_port_mock(transform_workers=2))
+    yield service
+    service._executor.shutdown()
+
+
+@pytest.mark.anyio
+class TestThreadPoolTransform:
+    async def test_thread_ldap_connection(self, pooled_udm_service):
+        barrier = threading.Barrier(2)
+
+        def connections():
+            barrier.wait(timeout=5)
+            return pooled_udm_service._thread_ldap_connection(), pooled_udm_service._thread_ldap_connection()
+
+        futures = [pooled_udm_service._executor.submit(connections) for _ in range(2)]
+        (first, again), (other, _) = [future.result() for future in futures]
+
+        assert first[0] is again[0]
+        assert first[0] is not other[0]
+        assert isinstance(first[0], FakeLDAPAccess)
+        assert first[0] is not pooled_udm_service
+        assert first[0].connection_params["base"] == "dc=univention-organization,dc=intranet"
+
+    async def test_ldap_to_udm_uses_connection_of_thread(self, pooled_udm_service):
+        connections = {}
+        lock = threading.Lock()
+
+        def transform(entry: dict, lo=None, position=None) -> dict:
+            with lock:
+                connections.setdefault(threading.get_ident(), set()).add(id(lo))
+            time.sleep(0.01)
+            return ldap_to_udm(entry)
+
+        pooled_udm_service.ldap_to_udm = transform
+
+        await pooled_udm_service.ldap_to_udm_in_executor([ldap_entry(str(i)) for i in range(10)])
+
+        assert all(len(ids) == 1 for ids in connections.values())
+        assert len(set.union(*connections.values())) == len(connections)
+        assert id(pooled_udm_service) not in set.union(*connections.values())
+
+    async def test_get_module_per_connection(self, udm, pooled_udm_service):
+        lo, other_lo, position = FakeLDAPAccess(), FakeLDAPAccess(), MagicMock()
+
+        with patch.object(udm, "UDM_Module", side_effect=lambda *args, **kwargs: MagicMock(**kwargs)) as udm_module:
+            module = pooled_udm_service._get_module("users/user", lo, position)
+            same_module = pooled_udm_service._get_module("users/user", lo, position)
+            other_module = pooled_udm_service._get_module("users/user", other_lo, position)
+
+        assert module is same_module
+        assert other_module is not module
+        assert udm_module.call_count == 2
+        assert module.ldap_connection is lo
+        assert other_module.ldap_connection is other_lo
+
+    async def test_get_module_of_closed_connection_is_not_reused(self, udm, pooled_udm_service):
+        def udm_module(object_type, ldap_connection, ldap_position):
+            return MagicMock(connection_id=id(ldap_connection))
+
+        with patch.object(udm, "UDM_Module", udm_module):
+            module = pooled_udm_service._get_module("users/user", FakeLDAPAccess(), MagicMock())
+            # Only the cache refers to the first connection now, its id would otherwise be free for the next one
+            lo = FakeLDAPAccess()
+            other_module = pooled_udm_service._get_module("users/user", lo, MagicMock())
+
+        assert other_module is not module
+        assert other_module.connection_id == id(lo)
+
+    async def test_ldap_to_udm_in_executor_keeps_order(self, pooled_udm_service):
+        def transform(entry: dict, lo=None, position=None) -> dict:
+            # Later entries are transformed faster
+            time.sleep(0.05 / (int(entry["description"][0]) + 1))
+            return ldap_to_udm(entry)
+
+        pooled_udm_service.ldap_to_udm = transform
+        entries = [ldap_entry(str(i), str(i)) for i in range(6)]
+
+        result = await pooled_udm_service.ldap_to_udm_in_executor(entries)
+
+        assert result == [ldap_to_udm(entry) for entry in entries]
+
+
+@pytest.mark.anyio
+class TestLocalCache:
+    @pytest.fixture
+    def cached_udm_service(self, udm):
+        service = udm.UDMMessagingService(udm_transformer_port_mock(cache_size=2))
+        yield service
+        service._executor.shutdown()
+
+    async def test_retrieve_stored_object(self, cached_udm_service):
+        obj = ldap_to_udm(ldap_entry("a"))
+
+        await cached_udm_service.store(obj)
+
+        assert await cached_udm_service.retrieve("a") == obj
+        cached_udm_service._messaging_port.retrieve.assert_not_called()
+        assert (cached_udm_service.cache_hits, cached_udm_service.cache_misses) == (1, 0)
+
+    async def test_retrieve_missing_object(self, cached_udm_service):
+        obj = ldap_to_udm(ldap_entry("a"))
+        cached_udm_service._messaging_port.retrieve.return_value = obj
+
+        assert await cached_udm_service.retrieve("a") == obj
+        assert await cached_udm_service.retrieve("a") == obj
+
+        cached_udm_service._messaging_port.retrieve.assert_called_once_with("a", Bucket.cache)
+        assert (cached_udm_service.cache_hits, cached_udm_service.cache_misses) == (1, 1)
+        assert cached_udm_service.cache_hit_rate == 0.5
+
+    async def test_least_recently_used_object_is_evicted(self, cached_udm_service):
+        for uuid in ("a", "b"):
+            await cached_udm_service.store(ldap_to_udm(ldap_entry(uuid)))
+        await cached_udm_service.retrieve("a")
+        await cached_udm_service.store(ldap_to_udm(ldap_entry("c")))
+
+        assert set(cached_udm_service._cache) == {"a", "c"}
+        await cached_udm_service.retrieve("b")
+        cached_udm_service._messaging_port.retrieve.assert_called_once_with("b", Bucket.cache)
+
+    async def test_store_replaces_cached_object(self, cached_udm_service):
+        await cached_udm_service.store(ldap_to_udm(ldap_entry("a", "1")))
+        await cached_udm_service.store(ldap_to_udm(ldap_entry("a", "2")))
+
+        assert await cached_udm_service.retrieve("a") == ldap_to_udm(ldap_entry("a", "2"))
+
+    async def test_cached_objects_are_not_changed_by_callers(self, cached_udm_service):
+        obj = ldap_to_udm(ldap_entry("a", "1"))
+        await cached_udm_service.store(obj)
+        obj["properties"]["description"] = "changed after storing"
+
+        retrieved = await cached_udm_service.retrieve("a")
+        retrieved["properties"]["description"] = "changed after retrieving"
+
+        assert await cached_udm_service.retrieve("a") == ldap_to_udm(ldap_entry("a", "1"))
+
+    async def test_cache_is_disabled_by_default(self, udm_service):
+        assert udm_service._cache is None
+
+    async def test_failed_store_is_not_cached(self, cached_udm_service):
+        cached_udm_service._messaging_port.store.side_effect = Exception("storing failed")
+
+        with pytest.raises(Exception, match="storing failed"):
+            await cached_udm_service.store(ldap_to_udm(ldap_entry("a")))
+
+        assert "a" not in cached_udm_service._cache
+
+    async def test_cache_disabled(self, udm):
+        service = udm.UDMMessagingService(udm_transformer_port_mock(cache_size=0))
+        service._messaging_port.retrieve.return_value = ldap_to_udm(ldap_entry("a"))
+
+        await service.store(ldap_to_udm(ldap_entry("a")))
+        await service.retrieve("a")
+
+        service._messaging_port.retrieve.assert_called_once_with("a", Bucket.cache)
+        assert (service.cache_hits, service.cache_misses) == (0, 0)
+
+
+@pytest.mark.anyio
+class TestUDMReload:
+    reload_trigger = {"objectType": "settings/extended_attribute"}
+
+    @pytest.fixture
+    def reload_udm_service(self, udm):
+        service = udm.UDMMessagingService(udm_transformer_port_mock(udm_reload_delay=0.1))
+        service.ldap_to_udm = ldap_to_udm
+        with patch.object(udm, "importlib") as importlib_mock:
+            service.reload_module = importlib_mock.reload
+            yield service
+        if service._udm_reload_task:
+            service._udm_reload_task.cancel()
+        service._executor.shutdown()
+
+    async def test_requests_are_coalesced(self, reload_udm_service):
+        for _ in range(3):
+            reload_udm_service.request_udm_reload(self.reload_trigger)
+            await asyncio.sleep(0.02)
+        reload_udm_service.reload_module.assert_not_called()
+
+        await asyncio.sleep(0.2)
+
+        reload_udm_service.reload_module.assert_called_once()
+        assert reload_udm_service.udm_reloads == 1
+        assert reload_udm_service._udm_reload_requests == 0
+        assert reload_udm_service._udm_reload_task is None
+
+    async def test_other_objects_do_not_request_reload(self, reload_udm_service):
+        reload_udm_service.request_udm_reload(ldap_to_udm(ldap_entry("a")))
+
+        await asyncio.sleep(0.2)
+
+        reload_udm_service.reload_module.assert_not_called()
+        assert reload_udm_service._udm_reload_task is None
+
+    async def test_request_during_reload_causes_another_reload(self, reload_udm_service):
+        def request_again(module):
+            if reload_udm_service.reload_module.call_count == 1:
+                reload_udm_service.request_udm_reload(self.reload_trigger)
+
+        reload_udm_service.reload_module.side_effect = request_again
+        reload_udm_service.request_udm_reload(self.reload_trigger)
+
+        await asyncio.sleep(0.15)
+        assert reload_udm_service.reload_module.call_count == 1
+        assert reload_udm_service._udm_reload_requests == 1
+
+        await asyncio.sleep(0.15)
+        assert reload_udm_service.reload_module.call_count == 2
+        assert reload_udm_service._udm_reload_requests == 0
+
+    async def test_transformation_reloads_before_transforming(self, reload_udm_service):
+        reload_udm_service.request_udm_reload(self.reload_trigger)
+
+        await reload_udm_service.transform_batch([(ldap_entry("a"), None)])
+
+        reload_udm_service.reload_module.assert_called_once()
+        await asyncio.sleep(0.2)
+        reload_udm_service.reload_module.assert_called_once()